@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""End-to-end transport benchmarks against local stand-in servers."""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+
+from omnisync.main import OmniSync, parse_arguments
+from omnisync.configuration import Configuration
+from omnisync import standins
+
+# The synchronisations each benchmark runs, in order: copying the source to an empty
+# destination, synchronising again without any changes, after changing some of the files and
+# after deleting a directory.
+SCENARIOS = ("copy", "unchanged", "modified", "deleted")
+# The transports that can be benchmarked.
+TARGETS = ("file", "sftp", "s3")
+# The fraction of the small files the "modified" scenario changes.
+MODIFIED_FRACTION = 0.1
+
+
+def run_sync(*args):
+    """Run a synchronisation with the given command-line arguments, and return the OmniSync
+       instance."""
+    omnisync = OmniSync()
+    (options, args) = parse_arguments(omnisync, ["-q"] + list(args))
+    omnisync.config = Configuration(options)
+    omnisync.sync(*args)
+    return omnisync
+
+
+def make_tree(directory, directory_count, file_count, file_size, large_count, large_size):
+    """Fill _directory_ with _directory_count_ directories of _file_count_ files of
+       _file_size_ bytes each, and _large_count_ files of _large_size_ bytes at the top."""
+    for directory_counter in range(directory_count):
+        subdirectory = os.path.join(directory, "d%s" % directory_counter)
+        os.makedirs(subdirectory)
+        for file_counter in range(file_count):
+            line = "%s/%s\n" % (directory_counter, file_counter)
+            open(os.path.join(subdirectory, "f%s" % file_counter), "wb").write(
+                (line * (file_size // len(line) + 1))[:file_size])
+    for counter in range(large_count):
+        open(os.path.join(directory, "large%s" % counter), "wb").write(os.urandom(large_size))
+
+
+def modify_tree(directory):
+    """Change some of the small files under _directory_."""
+    step = int(1 / MODIFIED_FRACTION)
+    for root, directory_names, file_names in os.walk(directory):
+        for file_name in sorted(file_names)[::step]:
+            if not file_name.startswith("large"):
+                open(os.path.join(root, file_name), "ab").write("modified\n")
+
+
+class Target(object):
+    """A destination to benchmark synchronising to, with the stand-in server behind it."""
+    def __init__(self, name, directory, latency=None):
+        self.name = name
+        self.server = None
+        self.options = []
+        if name == "file":
+            self.url = os.path.join(directory, "destination") + "/"
+        elif name == "sftp":
+            self.server = standins.SFTPStandIn(directory).start()
+            self.url = self.server.url("destination/")
+        elif name == "s3":
+            # The stand-in doesn't need boto, but the transport does.
+            import boto
+            self.server = standins.S3StandIn().start()
+            self.server.buckets["benchmark"] = {}
+            self.url = "s3://key:secret@benchmark/destination/"
+            self.options = ["--s3-endpoint", self.server.endpoint]
+        else:
+            raise ValueError, "Unknown benchmark target %s." % name
+        if latency is not None:
+            self.url = "slow+" + self.url
+            self.options.append("--slow-latency=%s" % latency)
+
+    def get_round_trips(self):
+        """Return the number of requests the server has received so far, or None if there is
+           no server."""
+        if self.server is None:
+            return None
+        return sum(self.server.request_counts.values())
+
+    def stop(self):
+        """Stop the server."""
+        if self.server is not None:
+            self.server.stop()
+
+
+def benchmark(target_name, directory_count=10, file_count=100, file_size=1024,
+              large_count=2, large_size=2**23, latency=None):
+    """Run the scenarios against a target, and return a list of (scenario, seconds, files,
+       bytes, round_trips) tuples, with None for the round trips of targets without a
+       server."""
+    directory = tempfile.mkdtemp()
+    target = None
+    try:
+        source = os.path.join(directory, "source")
+        os.makedirs(source)
+        make_tree(source, directory_count, file_count, file_size, large_count, large_size)
+        target = Target(target_name, directory, latency)
+        results = []
+        for scenario in SCENARIOS:
+            arguments = ["-r"] + target.options
+            if scenario == "modified":
+                modify_tree(source)
+            elif scenario == "deleted":
+                shutil.rmtree(os.path.join(source, "d0"))
+                arguments.append("--delete")
+            round_trips = target.get_round_trips()
+            start_time = time.time()
+            omnisync = run_sync(*(arguments + [source + "/", target.url]))
+            seconds = time.time() - start_time
+            if round_trips is not None:
+                round_trips = target.get_round_trips() - round_trips
+            results.append((scenario, seconds, omnisync.file_counter, omnisync.bytes_total,
+                            round_trips))
+        return results
+    finally:
+        if target is not None:
+            target.stop()
+        shutil.rmtree(directory)
+
+
+def format_result(target_name, result):
+    """Format a benchmark result as a line of the report."""
+    scenario, seconds, files, bytes, round_trips = result
+    seconds = max(seconds, 1e-6)
+    if round_trips is None:
+        round_trips = "-"
+    return "%-6s %-10s %8.2f s %10.1f ops/s %9.2f MB/s %10s round trips" % \
+           (target_name, scenario, seconds, files / seconds, bytes / seconds / 2**20,
+            round_trips)
+
+
+def main():
+    """Run the benchmarks given on the command line."""
+    parser = optparse.OptionParser(usage="%prog [options] [target ...]",
+                                   description="Benchmark synchronising to each target (%s) "
+                                               "against local stand-in servers." %
+                                               ", ".join(TARGETS))
+    parser.add_option("--directories", type="int", default=10,
+                      help="the number of directories of small files (default 10)")
+    parser.add_option("--files", type="int", default=100,
+                      help="the number of small files in each directory (default 100)")
+    parser.add_option("--file-size", type="int", default=1024,
+                      help="the size of the small files in bytes (default 1024)")
+    parser.add_option("--large-files", type="int", default=2,
+                      help="the number of large files (default 2)")
+    parser.add_option("--large-file-size", type="int", default=2**23,
+                      help="the size of the large files in bytes (default 8 MiB)")
+    parser.add_option("--latency", type="float",
+                      help="simulate a network with this latency in seconds, through the "
+                           "slow transport")
+    (options, args) = parser.parse_args()
+    for target_name in args or TARGETS:
+        if target_name not in TARGETS:
+            parser.error("Unknown target %s." % target_name)
+        try:
+            results = benchmark(target_name, options.directories, options.files,
+                                options.file_size, options.large_files,
+                                options.large_file_size, options.latency)
+        except ImportError, error:
+            print "%-6s skipped: %s" % (target_name, error)
+            continue
+        for result in results:
+            print format_result(target_name, result)
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -22,11 +22,25 @@ class Configuration:
             self.requested_attributes = set(options.attributes)
         else:
             self.requested_attributes = set()
-        self.dry_run = options.dry_run
+        # Planning changes is a dry run that records them.
+        self.dry_run = options.dry_run or bool(options.plan)
+        self.plan = options.plan
+        self.jobs = options.jobs
+        self.checksum = options.checksum
+        self.checksum_algorithm = options.checksum_algorithm
         self.update = options.update
         if self.update:
             self.requested_attributes.add("mtime")
         self.recursive = options.recursive
+        self.detect_renames = options.detect_renames
+        self.hard_links = options.hard_links
+        self.sparse = options.sparse
+        self.dedupe = options.dedupe
+        self.watch_delay = options.watch_delay
+        self.skip_unchanged_dirs = options.skip_unchanged_dirs
+        self.paranoid = options.paranoid
+        self.directory_cache = options.directory_cache
+        self.rescan_interval = options.rescan_interval
         if options.exclude_files:
             self.exclude_files = re.compile(options.exclude_files)
         else:
@@ -0,0 +1,51 @@
+"""The ETags S3 gives objects and the part sizes it uploads them in, for every transport."""
+
+import hashlib
+
+# S3 limits multipart uploads to this many parts.
+MAX_PARTS = 10000
+# ...and parts other than the last to at least this size.
+MIN_PART_SIZE = 5 * 2**20
+# The part size objects are uploaded with unless told otherwise, in megabytes.
+DEFAULT_PART_SIZE = 8
+
+
+def get_part_size(size, part_size):
+    """Return the part size to upload an object of _size_ bytes with, which is _part_size_ if
+       that fits the object in the allowed number of parts and the next larger whole number of
+       megabytes that does otherwise."""
+    part_size = max(part_size, MIN_PART_SIZE)
+    if size is not None and size > part_size * MAX_PARTS:
+        part_size = -(-size // MAX_PARTS)
+        part_size = -(-part_size // 2**20) * 2**20
+    return part_size
+
+
+def get_etag(file_handle, size, part_size, buffer_size=2**15):
+    """Return the ETag S3 gives an object of _size_ bytes read from _file_handle_ when we
+       upload it with a _part_size_ that get_part_size() hasn't been applied to.
+
+       That's the MD5 of the object if it fits in a single PUT, and the MD5 of the MD5s of the
+       parts followed by the number of parts if it's uploaded in several.
+    """
+    part_size = get_part_size(size, part_size)
+    part_digests = []
+    while True:
+        digest = hashlib.md5()
+        remaining = part_size
+        while remaining:
+            data = file_handle.read(min(buffer_size, remaining))
+            if not data:
+                break
+            digest.update(data)
+            remaining -= len(data)
+        if remaining == part_size and part_digests:
+            # The previous part ended exactly at the end of the object.
+            break
+        part_digests.append(digest)
+        if remaining:
+            break
+    if size < part_size:
+        return part_digests[0].hexdigest()
+    return "%s-%s" % (hashlib.md5("".join(x.digest() for x in part_digests)).hexdigest(),
+                      len(part_digests))
@@ -0,0 +1,122 @@
+"""Linux inotify bindings, for watching directory trees for changes."""
+
+import os
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+
+# Event flags, from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# The events that mean something in a directory has changed.
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR |
+              IN_DONT_FOLLOW)
+# The header of each event: the watch descriptor, mask, cookie and name length.
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyOverflow(Exception):
+    """Raised when the kernel's event queue overflowed and events have been lost."""
+
+
+class Inotify(object):
+    """Watch directory trees for changes.
+
+       Raises OSError if inotify is not available.
+    """
+    def __init__(self):
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            init = self._libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError, (errno.ENOSYS, "inotify is not available.")
+        self._fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError, (error, os.strerror(error))
+        # The directories being watched, in {watch_descriptor: path} format.
+        self._paths = {}
+
+    def add_watch(self, path):
+        """Watch a directory, but not the ones under it."""
+        descriptor = self._libc.inotify_add_watch(self._fd, path, WATCH_MASK)
+        if descriptor < 0:
+            error = ctypes.get_errno()
+            raise OSError, (error, os.strerror(error), path)
+        self._paths[descriptor] = path
+
+    def add_tree(self, path):
+        """Watch a directory and every directory under it. Directories that disappear while
+           we're at it are skipped."""
+        for directory, directory_names, file_names in os.walk(path):
+            try:
+                self.add_watch(directory)
+            except OSError, failure:
+                if failure.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+
+    def read_events(self, timeout=None):
+        """Wait up to _timeout_ seconds for events, and return a list of (path, mask) tuples,
+           or an empty list if there were none. Directories that are created or moved into a
+           watched tree are watched too.
+
+           Raises InotifyOverflow if events have been lost.
+        """
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+        events = []
+        overflow = False
+        while True:
+            try:
+                data = os.read(self._fd, 2**16)
+            except OSError, failure:
+                if failure.errno == errno.EAGAIN:
+                    break
+                raise
+            position = 0
+            while position < len(data):
+                descriptor, mask, cookie, length = EVENT_HEADER.unpack_from(data, position)
+                position += EVENT_HEADER.size
+                name = data[position:position + length].rstrip("\0")
+                position += length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                directory = self._paths.get(descriptor)
+                if directory is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self._paths[descriptor]
+                    continue
+                if name:
+                    path = os.path.join(directory, name)
+                else:
+                    path = directory
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                events.append((path, mask))
+        if overflow:
+            raise InotifyOverflow, "The inotify event queue overflowed."
+        return events
+
+    def close(self):
+        """Stop watching."""
+        os.close(self._fd)
@@ -7,6 +7,10 @@ import logging
 import optparse
 import time
 import locale
+import shelve
+import json
+import threading
+import Queue
 
 from omnisync.configuration import Configuration
 from omnisync.progress import Progress
@@ -14,10 +18,76 @@ from omnisync.progress import Progress
 from omnisync.version import VERSION
 from omnisync.transportmount import TransportInterface
 from omnisync.fileobject import FileObject
-from omnisync.urlfunctions import url_splice, url_split, url_join, normalise_url, append_slash
+from omnisync.inotify import Inotify, InotifyOverflow, IN_ISDIR, IN_CREATE, IN_DELETE, \
+                             IN_MOVED_FROM, IN_MOVED_TO
+from omnisync.urlfunctions import url_splice, url_split, url_join, normalise_url, append_slash, \
+                                  strip_credentials
 
 log = logging.getLogger("omnisync.main")
 
+# The number of destination attribute changes to queue before setting them, for transports that
+# can set attributes in batches.
+ATTRIBUTE_BATCH_SIZE = 256
+# The most data to hold in memory for small files waiting to be sent together, for transports
+# that can write many small files at once.
+SMALL_FILE_BATCH_SIZE = 2**23
+# The most small files to send together.
+SMALL_FILE_BATCH_COUNT = 1000
+# Evaluation attributes that need a file's contents to be read, which are only compared once
+# the others have all matched.
+HASH_ATTRIBUTES = set(("checksum", "etag"))
+# New files smaller than this are copied straight away with --detect-renames, rather than
+# held back to be matched against the files being deleted, since copying them costs about as
+# much as moving them.
+RENAME_MIN_SIZE = 2**16
+# Files smaller than this aren't hashed to find their duplicates with --dedupe.
+DUPLICATE_MIN_SIZE = 2**16
+# The directory this module was loaded from, resolved before anything changes the current
+# directory.
+MODULE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# When watching, keep collecting changes for at most this many debounce delays, so a steady
+# stream of changes can't hold off synchronising them forever.
+WATCH_MAX_DELAYS = 10
+# Where to record the source directories of successful synchronisations, for
+# --skip-unchanged-dirs.
+DIRECTORY_CACHE = os.path.join("~", ".omnisync", "directories")
+# Directories modified this many seconds before a synchronisation started or later might be
+# modified again without their mtime changing, so they are never skipped next time.
+RACY_MARGIN = 2
+# The version of the --plan file format, which --apply checks.
+PLAN_FORMAT = 1
+# The order the actions of a plan are applied in: deletions first, because a new directory
+# or file might be replacing what's deleted, then the directories the files are copied into,
+# and the attributes last, because copying files changes the mtime of their directories.
+PLAN_ACTIONS = ("remove", "rmtree", "mkdir", "copy", "setattr")
+# The inotify events that mean a directory appeared or disappeared.
+DIRECTORY_CHANGES = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+def get_top_paths(paths):
+    """Normalise a list of relative paths, and return them sorted and without duplicates or
+       the paths under other paths in the list. The empty path stands for everything."""
+    normalised_paths = set()
+    for path in paths:
+        path = path.strip("/")
+        while path.startswith("./"):
+            path = path[2:].lstrip("/")
+        if path == ".":
+            path = ""
+        if ".." in path.split("/"):
+            log.warning("Ignoring the path %s, which leads outside the source." % path)
+            continue
+        normalised_paths.add(path)
+    top_paths = []
+    for path in sorted(normalised_paths):
+        components = path.split("/")
+        if path and ("" in normalised_paths or
+                     [x for x in range(1, len(components))
+                      if "/".join(components[:x]) in normalised_paths]):
+            continue
+        top_paths.append(path)
+    return top_paths
+
+
 class OmniSync(object):
     """The main program class."""
     def __init__(self):
@@ -32,11 +102,52 @@ class OmniSync(object):
 
         self.file_counter = 0
         self.bytes_total = 0
+        # The number of files that could not be copied.
+        self.error_counter = 0
+
+        # Destination attribute changes waiting to be set in a batch.
+        self._pending_attributes = []
+        # Destination attributes retrieved in advance, in {url: attribute_dict} format.
+        self._prefetched_attributes = {}
+        # Small files waiting to be sent together, as (url, data, attribute_dict) tuples.
+        self._small_files = []
+        # The source directories of the last successful synchronisation, in
+        # {"source_url\0destination_url": (mtime, entry_count)} format, and the ones of this
+        # synchronisation, which replace them if it succeeds.
+        self._directory_cache = None
+        self._directory_records = {}
+        # The file --plan writes the changes to, and the last change written.
+        self._plan_file = None
+        self._last_plan_entry = None
+        # The number of planned changes that were skipped because their source changed.
+        self.skip_counter = 0
+        self._lock = threading.Lock()
+        # Whether the source is a directory, rather than a single file, when applying a plan.
+        self._source_isdir = True
+        self._small_files_size = 0
+        # With --detect-renames, the new files that are held back to be matched against the
+        # files being deleted, as (source, destination) FileObject tuples, the destination
+        # files and directories being deleted, and the files in them in {size: [FileObject]}
+        # format.
+        self._detect_renames = False
+        self._new_files = []
+        self._deleted_items = []
+        self._rename_candidates = {}
+        # The content hashes that are compared to confirm renames, besides the evaluation
+        # attributes.
+        self._rename_attributes = set()
+        # The number of files that were moved on the destination instead of being copied.
+        self.rename_counter = 0
+        # The destination URLs of the files copied so far that have hard links or, with
+        # --dedupe, duplicates in the source, in {content_key: url} format, and the number of
+        # files that were linked or copied from them on the destination.
+        self._copied_contents = {}
+        self.duplicate_counter = 0
 
         transp_dir = "transports"
         # If we have been imported, get the path.
         if __name__ != "__main__":
-            os_dir = os.path.dirname(os.path.join(os.getcwd(), __file__))
+            os_dir = MODULE_DIRECTORY
             basedir = os.path.join(os_dir, transp_dir)
             sys.path.append(os_dir)
         else:
@@ -73,6 +184,15 @@ class OmniSync(object):
                 kwargs["dest"] = kwargs["dest"] + transport.protocols[0]
                 parser.add_option(*args, **kwargs)
 
+    def get_transport(self, url):
+        """Instantiate the transport for a URL. Schemes such as "slow+sftp" wrap the transport
+           of the last protocol in those of the ones before it."""
+        protocols = url_split(url).scheme.split("+")
+        transport = self.transports[protocols.pop()]()
+        while protocols:
+            transport = self.transports[protocols.pop()](transport)
+        return transport
+
     def check_locations(self):
         """Check that the two locations are suitable for synchronisation."""
         if url_split(self.source).get_dict().keys == ["scheme"]:
@@ -119,23 +239,61 @@ class OmniSync(object):
         else:
             return True
 
-    def sync(self, source, destination):
-        """Synchronise two locations."""
-        start_time = time.time()
+    def sync(self, source, destination, paths=None):
+        """Synchronise two locations, or only the given _paths_ under them."""
+        if not self.start(source, destination):
+            return
+        if paths is None:
+            self.recurse()
+        else:
+            self.sync_paths(paths)
+        self.finish()
+
+    def start(self, source, destination):
+        """Connect to two locations and check that they can be synchronised.
+
+           Returns False if either location's protocol is not supported.
+        """
+        self._start_time = time.time()
+        if not self.connect(source, destination):
+            return False
+        if not self.check_locations():
+            self.exit(1)
+        if self.config.skip_unchanged_dirs:
+            self._directory_cache = self.open_directory_cache()
+        self._detect_renames = self.check_detect_renames()
+        if self.config.plan:
+            self._plan_file = open_plan(self.config.plan, "wb")
+            # Plans are written to disk, so leave passwords and keys out of them, to be given
+            # again when the plan is applied.
+            self._plan_file.write(json.dumps({"omnisync_plan": PLAN_FORMAT,
+                                              "source": self.get_public_url(self.source_transport,
+                                                                            self.source),
+                                              "destination": self.get_public_url(
+                                                  self.destination_transport, self.destination),
+                                              "time": self._start_time},
+                                             encoding="latin-1") + "\n")
+        return True
+
+    def connect(self, source, destination):
+        """Connect to two locations and work out which attributes to compare.
+
+           Returns False if either location's protocol is not supported.
+        """
         self.source = normalise_url(source)
         self.destination = normalise_url(destination)
 
         # Instantiate the transports.
         try:
-            self.source_transport = self.transports[url_split(self.source).scheme]()
+            self.source_transport = self.get_transport(self.source)
         except KeyError:
             log.error("Protocol not supported: %s." % url_split(self.source).scheme)
-            return
+            return False
         try:
-            self.destination_transport = self.transports[url_split(self.destination).scheme]()
+            self.destination_transport = self.get_transport(self.destination)
         except KeyError:
             log.error("Protocol not supported: %s." % url_split(self.destination).scheme)
-            return
+            return False
 
         # Give the transports a chance to connect to their servers.
         try:
@@ -155,21 +313,108 @@ class OmniSync(object):
 
         self.max_evaluation_attributes = (self.source_transport.evaluation_attributes &
                                           self.destination_transport.evaluation_attributes)
+        # Checksums are expensive, so only compare them if asked to.
+        if not self.config.checksum:
+            self.max_evaluation_attributes.discard("checksum")
+        # ETags are only worth computing if one of the transports lists them for free.
+        if "etag" not in (self.source_transport.listdir_attributes |
+                          self.destination_transport.listdir_attributes):
+            self.max_evaluation_attributes.discard("etag")
+        return True
 
-        if not self.check_locations():
-            self.exit(1)
+    def check_detect_renames(self):
+        """Check whether renames can be detected between our locations, if asked to."""
+        if not self.config.detect_renames:
+            return False
+        if not self.config.delete:
+            log.warning("Renames are only detected along with --delete, ignoring "
+                        "--detect-renames.")
+        elif self.config.plan:
+            log.warning("Renames can't be planned yet, ignoring --detect-renames.")
+        elif not hasattr(self.destination_transport, "rename"):
+            log.warning("The destination protocol does not support renaming files, ignoring "
+                        "--detect-renames.")
+        # Times only have a resolution of a second, so confirm matches with the contents of the
+        # files if we can, even if they aren't compared otherwise.
+        self._rename_attributes = (self.source_transport.evaluation_attributes &
+                                   self.destination_transport.evaluation_attributes &
+                                   self.source_transport.getattr_attributes &
+                                   self.destination_transport.getattr_attributes &
+                                   HASH_ATTRIBUTES) - self.max_evaluation_attributes
+        if not (self.max_evaluation_attributes | self._rename_attributes) & \
+           (HASH_ATTRIBUTES | set(("mtime", ))):
+            # Files of the same size aren't necessarily the same file.
+            log.warning("Files can only be compared by size, ignoring --detect-renames.")
+        else:
+            return True
+        return False
 
-        # Begin the actual synchronisation.
-        self.recurse()
+    def open_directory_cache(self):
+        """Open the record of the source directories of previous synchronisations, or return
+           None if it can't be opened."""
+        filename = os.path.expanduser(self.config.directory_cache or DIRECTORY_CACHE)
+        try:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            return shelve.open(filename)
+        except Exception, failure:
+            log.error("Could not open the directory cache %s: %s" % (filename, failure))
+            return None
 
+    def is_unchanged_directory(self, source, source_dir_list, dest_url):
+        """Check whether a source directory has the same mtime and number of entries as it did
+           when it was last synchronised to _dest_url_, and record them for next time."""
+        if self._directory_cache is None or \
+           "mtime" not in self.source_transport.getattr_attributes:
+            return False
+        source.populate_attributes(["mtime"])
+        if source.mtime is None:
+            return False
+        # The key is written to disk, so leave passwords and keys out of it.
+        key = "%s\0%s" % (strip_credentials(source.url, self.source_transport.uses_hostname),
+                           strip_credentials(dest_url, self.destination_transport.uses_hostname))
+        # Some transports list names as unicode, and shelves only take byte strings.
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        if source.mtime < self._start_time - RACY_MARGIN:
+            self._directory_records[key] = (source.mtime, len(source_dir_list))
+        else:
+            self._directory_records[key] = None
+        return self._directory_cache.get(key) == (source.mtime, len(source_dir_list))
+
+    def flush(self):
+        """Carry out the changes that are waiting to be sent in a batch."""
+        self.resolve_renames()
+        self.flush_small_files()
+        self.flush_destination_attributes()
+
+    def finish(self):
+        """Carry out any remaining changes, disconnect and report what was done."""
+        self.flush()
+        if self._directory_cache is not None:
+            # Only a successful synchronisation leaves the destination directories up to date.
+            if not self.error_counter and not self.config.dry_run:
+                self._directory_cache.update(self._directory_records)
+            self._directory_cache.close()
+            self._directory_cache = None
+        if self._plan_file is not None:
+            if self._plan_file is not sys.stdout:
+                self._plan_file.close()
+            self._plan_file = None
         self.source_transport.disconnect()
         self.destination_transport.disconnect()
-        total_time = time.time() - start_time
+        total_time = time.time() - self._start_time
         locale.setlocale(locale.LC_NUMERIC, '')
         try:
             bps = locale.format("%d", int(self.bytes_total / total_time), True)
         except ZeroDivisionError:
             bps = "inf"
+        if self.rename_counter:
+            log.info("Moved %s files on the destination instead of copying them." %
+                     locale.format("%d", self.rename_counter, True))
+        if self.duplicate_counter:
+            log.info("Linked or copied %s duplicate files on the destination." %
+                     locale.format("%d", self.duplicate_counter, True))
         log.info("Copied %s files (%s bytes) in %s sec (%s Bps)." % (
                       locale.format("%d", self.file_counter, True),
                       locale.format("%d", self.bytes_total, True),
@@ -180,36 +425,140 @@ class OmniSync(object):
         """Set the destination's attributes. This is a wrapper for the transport's _setattr_."""
         # The given attributes might not have any we're able to set, so just return if that's
         # the case.
-        if not self.config.dry_run and \
+        if self.config.dry_run and \
            set(attributes) & set(self.destination_transport.setattr_attributes):
-            self.destination_transport.setattr(destination, attributes)
+            self.plan_entry("setattr", destination, attributes)
+        elif not self.config.dry_run and \
+           set(attributes) & set(self.destination_transport.setattr_attributes):
+            if hasattr(self.destination_transport, "setattr_batch"):
+                # Queue the change so the transport can set many attributes in one go.
+                self._pending_attributes.append((destination, dict(attributes)))
+                if len(self._pending_attributes) >= ATTRIBUTE_BATCH_SIZE:
+                    self.flush_destination_attributes()
+            else:
+                self.destination_transport.setattr(destination, attributes)
+
+    def flush_destination_attributes(self):
+        """Set any destination attributes that have been queued for batching."""
+        if self._pending_attributes:
+            self.destination_transport.setattr_batch(self._pending_attributes)
+            self._pending_attributes = []
+
+    def prefetch_attributes(self, source_dir_list):
+        """Retrieve the attributes compare_and_copy() will need for the files in a source
+           directory in batches, for transports that support it. Content hashes are only
+           retrieved for the files whose other attributes match."""
+        self.prefetch_source_attributes(source_dir_list)
+        self.prefetch_destination_attributes(source_dir_list)
+        self.prefetch_hash_attributes(source_dir_list)
+
+    def prefetch_source_attributes(self, source_dir_list):
+        """Retrieve the source attributes other than content hashes that compare_and_copy()
+           will need for the files in a source directory in one batch, for transports that
+           support it."""
+        if not hasattr(self.source_transport, "getattr_batch"):
+            return
+        items = [item for item in source_dir_list if not item.isdir]
+        attribute_set = set()
+        for item in items:
+            attribute_set |= ((self.source_transport.getattr_attributes &
+                               self.max_evaluation_attributes) |
+                              self.config.requested_attributes) - item.attribute_set
+        attribute_set -= HASH_ATTRIBUTES
+        if not attribute_set:
+            return
+        attribute_list = self.source_transport.getattr_batch([item.url for item in items],
+                                                             attribute_set)
+        for item, attributes in zip(items, attribute_list):
+            item.attributes.update(attributes)
+
+    def prefetch_destination_attributes(self, source_dir_list):
+        """Retrieve the destination attributes other than content hashes of the files in a
+           source directory in one batch, for transports that support it, so compare_and_copy()
+           doesn't need to get them one file at a time."""
+        if not hasattr(self.destination_transport, "getattr_batch"):
+            return
+        attribute_set = (self.destination_transport.getattr_attributes &
+                         self.max_evaluation_attributes) - HASH_ATTRIBUTES
+        if not attribute_set:
+            return
+        dest_urls = [url_splice(self.source, item.url, self.destination)
+                     for item in source_dir_list if not item.isdir]
+        if not dest_urls:
+            return
+        attribute_list = self.destination_transport.getattr_batch(dest_urls, attribute_set)
+        self._prefetched_attributes.update(zip(dest_urls, attribute_list))
+
+    def prefetch_hash_attributes(self, source_dir_list):
+        """Retrieve the content hashes of the files in a source directory whose other
+           prefetched attributes match the destination's in one batch per transport, since
+           find_difference() only compares the hashes of those."""
+        hash_set = self.max_evaluation_attributes & HASH_ATTRIBUTES
+        if not hash_set:
+            return
+        candidates = []
+        for item in source_dir_list:
+            if item.isdir:
+                continue
+            dest_url = url_splice(self.source, item.url, self.destination)
+            dest_attributes = self._prefetched_attributes.get(dest_url)
+            if dest_attributes is None:
+                continue
+            keys = (self.max_evaluation_attributes - HASH_ATTRIBUTES) & set(dest_attributes)
+            # find_difference() would get these one at a time anyway.
+            missing = (keys & self.source_transport.getattr_attributes) - item.attribute_set
+            if missing:
+                item.populate_attributes(missing)
+            keys &= item.attribute_set
+            if not [key for key in keys if item.attributes[key] != dest_attributes[key]]:
+                candidates.append((item, dest_url))
+        if not candidates:
+            return
+        attribute_set = hash_set & self.source_transport.getattr_attributes
+        items = [item for item, dest_url in candidates if attribute_set - item.attribute_set]
+        if hasattr(self.source_transport, "getattr_batch") and attribute_set and items:
+            attribute_list = self.source_transport.getattr_batch([item.url for item in items],
+                                                                 attribute_set)
+            for item, attributes in zip(items, attribute_list):
+                item.attributes.update(attributes)
+        attribute_set = hash_set & self.destination_transport.getattr_attributes
+        if hasattr(self.destination_transport, "getattr_batch") and attribute_set:
+            dest_urls = [dest_url for item, dest_url in candidates]
+            attribute_list = self.destination_transport.getattr_batch(dest_urls, attribute_set)
+            for dest_url, attributes in zip(dest_urls, attribute_list):
+                self._prefetched_attributes[dest_url].update(attributes)
 
     def compare_directories(self, source, source_dir_list, dest_dir_url):
         """Compare the source's directory list with the destination's and perform any actions
            necessary, such as deleting files or creating directories."""
         dest_dir_list = self.destination_transport.listdir(dest_dir_url)
         if not dest_dir_list:
+            # Populate the item's attributes for the remote directory so we can set them.
+            attribute_set = self.max_evaluation_attributes & \
+                            self.destination_transport.setattr_attributes
+            attribute_set = attribute_set | self.config.requested_attributes
+            attribute_set = attribute_set ^ self.config.exclude_attributes
             if not self.config.dry_run:
                 self.destination_transport.mkdir(dest_dir_url)
-                # Populate the item's attributes for the remote directory so we can set them.
-                attribute_set = self.max_evaluation_attributes & \
-                                self.destination_transport.setattr_attributes
-                attribute_set = attribute_set | self.config.requested_attributes
-                attribute_set = attribute_set ^ self.config.exclude_attributes
                 source.populate_attributes(attribute_set)
 
                 self.set_destination_attributes(dest_dir_url, source.attributes)
+            elif self._plan_file is not None:
+                source.populate_attributes(attribute_set)
+                self.plan_entry("mkdir", dest_dir_url, source.attributes)
             dest_dir_list = []
         # Construct a dictionary of {filename: FileObject} items.
         dest_paths = dict([(url_split(append_slash(x.url, False),
                                       self.destination_transport.uses_hostname,
                                       True).file, x) for x in dest_dir_list])
         create_dirs = []
+        source_names = set()
         for item in source_dir_list:
             # Remove slashes so the splitter can get the filename.
             url = url_split(append_slash(item.url, False),
                             self.source_transport.uses_hostname,
                             True).file
+            source_names.add(url)
             # If the file exists and both the source and destination are of the same type...
             if url in dest_paths and dest_paths[url].isdir == item.isdir:
                 # ...if it's a directory, set its attributes as well...
@@ -227,14 +576,14 @@ class OmniSync(object):
                     create_dirs.append(item)
 
         if self.config.delete:
-            for item in dest_paths.values():
-                if item.isdir:
-                    if self.config.recursive:
-                        log.info("Deleting destination directory %s..." % item)
-                        self.recursively_delete(item)
+            for name, item in dest_paths.items():
+                if item.isdir and not self.config.recursive:
+                    continue
+                # Items whose name is being reused have to make way straight away.
+                if self._detect_renames and name not in source_names:
+                    self.defer_deletion(item)
                 else:
-                    log.info("Deleting destination file %s..." % item)
-                    self.destination_transport.remove(item.url)
+                    self.delete_destination(item)
 
         if self.config.dry_run:
             return
@@ -297,7 +646,11 @@ class OmniSync(object):
             return
 
         # If source is a directory...
-        directory_stack = [FileObject(self.source_transport, self.source, {"isdir": True})]
+        self.traverse(FileObject(self.source_transport, self.source, {"isdir": True}))
+
+    def traverse(self, directory):
+        """Synchronise a source directory and everything under it."""
+        directory_stack = [directory]
 
         # Depth-first tree traversal.
         while directory_stack:
@@ -319,15 +672,176 @@ class OmniSync(object):
                         log.debug("Skipping %s..." % (new_file))
                 dest = url_splice(self.source, item.url, self.destination)
                 dest = FileObject(self.destination_transport, dest)
-                log.debug("Comparing directories %s and %s..." % (item.url, dest.url))
-                self.compare_directories(item, new_dir_list, dest.url)
+                if self.is_unchanged_directory(item, new_dir_list, dest.url):
+                    # Nothing has been added to or removed from the directory since it was last
+                    # synchronised, so the destination directory has the same entries. Files
+                    # changed in place don't change the directory, so only --paranoid notices
+                    # them.
+                    log.debug("Directory %s is unchanged, skipping its files..." % item)
+                    if not self.config.paranoid:
+                        new_dir_list = [x for x in new_dir_list if x.isdir]
+                else:
+                    log.debug("Comparing directories %s and %s..." % (item.url, dest.url))
+                    self.compare_directories(item, new_dir_list, dest.url)
+                self.prefetch_attributes(new_dir_list)
                 directory_stack.extend(new_dir_list)
             else:
                 dest_url = url_splice(self.source, item.url, self.destination)
                 log.debug("Destination URL is %s." % dest_url)
-                dest = FileObject(self.destination_transport, dest_url)
+                dest = FileObject(self.destination_transport, dest_url,
+                                  self._prefetched_attributes.pop(dest_url, None))
                 self.compare_and_copy(item, dest)
 
+    def sync_paths(self, paths):
+        """Synchronise only the given paths, relative to the source and the destination, rather
+           than walking the whole tree. Directories are synchronised along with everything
+           under them, and paths that are missing from the source are deleted from the
+           destination if we are deleting.
+        """
+        created_directories = set()
+        # Files are compared in batches, so their attributes can be retrieved together.
+        files = []
+        for path in get_top_paths(paths):
+            if not path:
+                # The whole tree has changed.
+                self.recurse()
+                continue
+            if not self.include_path(path):
+                log.debug("Skipping %s..." % path)
+                continue
+            source = FileObject(self.source_transport, append_slash(self.source) + path)
+            destination = FileObject(self.destination_transport,
+                                     append_slash(self.destination) + path)
+            if not self.source_transport.exists(source.url):
+                if self.config.delete and self.destination_transport.exists(destination.url):
+                    if self._detect_renames:
+                        self.defer_deletion(destination)
+                    else:
+                        self.delete_destination(destination)
+                continue
+
+            # Create the parent directory, once per batch.
+            parent = path.rpartition("/")[0]
+            if parent not in created_directories:
+                if parent:
+                    parent_url = append_slash(self.destination) + parent
+                else:
+                    parent_url = self.destination
+                if self.config.dry_run:
+                    self.plan_entry("mkdir", parent_url)
+                else:
+                    self.destination_transport.mkdir(parent_url)
+                created_directories.add(parent)
+            if source.isdir:
+                if self.config.recursive:
+                    self.traverse(source)
+                else:
+                    log.info("Skipping directory %s..." % source)
+            else:
+                files.append(source)
+                if len(files) >= ATTRIBUTE_BATCH_SIZE:
+                    self.compare_files(files)
+                    files = []
+        self.compare_files(files)
+
+    def compare_files(self, files):
+        """Compare and copy a list of source files that aren't necessarily in the same
+           directory."""
+        self.prefetch_attributes(files)
+        for source in files:
+            dest_url = url_splice(self.source, source.url, self.destination)
+            self.compare_and_copy(source, FileObject(self.destination_transport, dest_url,
+                                  self._prefetched_attributes.pop(dest_url, None)))
+
+    def include_path(self, path):
+        """Check whether to include a path, relative to the source, given our exclusion
+           patterns for it and the directories it is in."""
+        components = path.split("/")
+        for counter in range(1, len(components)):
+            directory = FileObject(self.source_transport,
+                                   append_slash(self.source) + "/".join(components[:counter]),
+                                   {"isdir": True})
+            if not self.include_file(directory):
+                return False
+        return self.include_file(FileObject(self.source_transport,
+                                            append_slash(self.source) + path))
+
+    def watch(self, source, destination):
+        """Synchronise two locations, and then keep synchronising the paths that change in the
+           source until interrupted. Local sources are watched with inotify and rescanned every
+           now and then, in case changes were missed; others are only rescanned.
+        """
+        if not self.start(source, destination):
+            return
+        watcher = None
+        if url_split(self.source).scheme == "file":
+            source_path = url_split(self.source,
+                                    uses_hostname=self.source_transport.uses_hostname).path
+            try:
+                watcher = Inotify()
+                # Watch before the first synchronisation, so nothing changes unnoticed.
+                watcher.add_tree(source_path)
+            except OSError, failure:
+                log.warning("Cannot watch %s for changes: %s." % (source_path, failure))
+                watcher = None
+        if watcher is None:
+            log.warning("Rescanning the source every %s seconds instead of watching it." %
+                        self.config.rescan_interval)
+        try:
+            self.recurse()
+            self.flush()
+            last_scan = time.time()
+            while True:
+                timeout = max(0, last_scan + self.config.rescan_interval - time.time())
+                if watcher is None:
+                    time.sleep(timeout)
+                    paths = None
+                else:
+                    paths = self.wait_for_changes(watcher, source_path, timeout)
+                if paths is None:
+                    log.info("Rescanning %s..." % self.source)
+                    self.recurse()
+                    last_scan = time.time()
+                else:
+                    self.sync_paths(paths)
+                self.flush()
+        except KeyboardInterrupt:
+            pass
+        if watcher is not None:
+            watcher.close()
+        self.finish()
+
+    def wait_for_changes(self, watcher, source_path, timeout):
+        """Wait up to _timeout_ seconds for changes under _source_path_, and collect them
+           until none have been made for the debounce delay.
+
+           Returns a list of changed paths relative to the source, or None if the source
+           should be rescanned because the time is up or changes were lost.
+        """
+        try:
+            events = watcher.read_events(timeout)
+            if not events:
+                return None
+            deadline = time.time() + self.config.watch_delay * WATCH_MAX_DELAYS
+            new_events = events
+            while new_events and time.time() < deadline:
+                new_events = watcher.read_events(self.config.watch_delay)
+                events.extend(new_events)
+        except InotifyOverflow:
+            log.warning("Changes to the source were lost.")
+            return None
+        paths = []
+        for path, mask in events:
+            # Changes to directories themselves are left to the rescans, so their contents
+            # aren't synchronised all over again.
+            if mask & IN_ISDIR and not mask & DIRECTORY_CHANGES:
+                continue
+            path = os.path.relpath(path, source_path)
+            if path == ".":
+                continue
+            paths.append(path)
+        return paths
+
     def compare_and_copy(self, source, destination):
         """Compare the attributes of two files and copy if changed.
 
@@ -336,50 +850,18 @@ class OmniSync(object):
 
            Returns True if the file was copied, False otherwise.
         """
-        # Try to gather as many attributes of both files as possible.
-        our_src_attributes = (source.attribute_set & self.max_evaluation_attributes)
-        max_src_attributes = (self.source_transport.getattr_attributes &
-                              self.max_evaluation_attributes) | \
-                              self.config.requested_attributes
-        src_difference = max_src_attributes - our_src_attributes
-        if src_difference:
-            # If the set of useful attributes we have is smaller than the set of attributes the
-            # user requested and the ones we can gather through getattr(), get the rest.
-            log.debug("Source getattr for file %s and arguments %s deemed necessary." % \
-                          (source, src_difference))
-            source.populate_attributes(src_difference)
-            # We should now have all the attributes we're interested in, both for evaluating if
-            # the files are different and setting.
-
-        # We aren't interested in the user's requested arguments for the destination.
-        dest_difference = (self.destination_transport.getattr_attributes -
-                           destination.attribute_set) & self.max_evaluation_attributes
-        if dest_difference:
-            # Same for the destination.
-            log.debug("Destination getattr for %s deemed necessary." % destination)
-            destination.populate_attributes(dest_difference)
-
-        # Compare the evaluation keys that are common in both dictionaries. If one is different,
-        # copy the file.
-        evaluation_attributes = source.attribute_set & destination.attribute_set & \
-                                self.max_evaluation_attributes
-        log.debug("Checking evaluation attributes %s..." % evaluation_attributes)
-        for key in evaluation_attributes:
-            if getattr(source, key) != getattr(destination, key):
-                log.debug("Source and destination %s was different (%s vs %s)." %\
-                              (key, getattr(source, key), getattr(destination, key)))
-                if self.config.update and destination.mtime > source.mtime:
-                    log.info("Destination file is newer and --update specified, skipping...")
-                    break
-                log.info("Copying \"%s\"\n        to \"%s\"..." % (source, destination))
-                try:
-                    self.copy_file(source, destination)
-                except IOError:
-                    return
-                else:
-                    # If the file was successfully copied, set its attributes.
-                    self.set_destination_attributes(destination.url, source.attributes)
-                    break
+        key = self.find_difference(source, destination)
+        if key is not None:
+            if self.config.update and destination.mtime > source.mtime:
+                log.info("Destination file is newer and --update specified, skipping...")
+            elif self._detect_renames and destination.attributes.get("size", 0) is None and \
+                 source.size >= RENAME_MIN_SIZE:
+                # The file is new, so it might have been moved from somewhere we are deleting.
+                log.debug("Holding back %s to detect whether it was moved..." % source)
+                self._new_files.append((source, destination))
+                return
+            elif not self.copy_changed_file(source, destination):
+                return
         else:
             # The two files are identical, skip them...
             log.info("Files \"%s\"\n      and \"%s\" are identical, skipping..." %
@@ -388,11 +870,417 @@ class OmniSync(object):
             self.set_destination_attributes(destination.url, source.attributes)
         self.file_counter += 1
 
+    def copy_changed_file(self, source, destination):
+        """Copy a file whose destination is missing or different, and set its attributes.
+
+           Returns True if the file was copied or queued to be copied, False otherwise.
+        """
+        content_keys = self.get_content_keys(source)
+        for content_key in content_keys:
+            if content_key in self._copied_contents and \
+               self.copy_duplicate(self._copied_contents[content_key], source, destination,
+                                   content_key[0] == "inode"):
+                break
+        else:
+            log.info("Copying \"%s\"\n        to \"%s\"..." % (source, destination))
+            try:
+                queued = self.queue_small_file(source, destination)
+                if not queued:
+                    self.copy_file(source, destination)
+            except IOError:
+                self.error_counter += 1
+                return False
+            if not queued:
+                # If the file was successfully copied, set its attributes.
+                self.set_destination_attributes(destination.url, source.attributes)
+        # Hard links to the file are linked to this copy, even if it was copied from one of
+        # its duplicates.
+        for content_key in content_keys:
+            self._copied_contents.setdefault(content_key, destination.url)
+        return True
+
+    def get_content_keys(self, source):
+        """Return the keys that are the same for a source file and its hard links and, with
+           --dedupe, the files with the same contents."""
+        attributes = self.source_transport.getattr_attributes
+        keys = []
+        if self.config.hard_links and "inode" in attributes:
+            source.populate_attributes(["links", "inode"])
+            if source.links > 1:
+                keys.append(("inode", source.inode))
+        if self.config.dedupe and "checksum" in attributes:
+            source.populate_attributes(["size"])
+            if source.size >= DUPLICATE_MIN_SIZE:
+                source.populate_attributes(["checksum"])
+                keys.append(("checksum", source.size, source.checksum))
+        return keys
+
+    def copy_duplicate(self, original_url, source, destination, hard_link):
+        """Recreate a file from a copy of it that's already at the destination, as a hard link
+           to it if they are hard links in the source and the destination supports them, and
+           with a server-side copy otherwise.
+
+           Returns True if the file was recreated, False if it has to be copied.
+        """
+        link = hard_link and hasattr(self.destination_transport, "link")
+        if not link and not hasattr(self.destination_transport, "copy"):
+            return False
+        if link:
+            log.info("Linking \"%s\"\n        to \"%s\"..." % (destination, original_url))
+        else:
+            log.info("Copying \"%s\"\n        on the destination to \"%s\"..." %
+                     (original_url, destination))
+        if self.config.dry_run:
+            self.plan_entry("copy", destination.url, source.attributes)
+            self.duplicate_counter += 1
+            return True
+        # The original might still be waiting to be written.
+        if original_url in [url for url, data, attributes in self._small_files]:
+            self.flush_small_files()
+        if link:
+            done = self.destination_transport.link(original_url, destination.url)
+        else:
+            done = self.destination_transport.copy(original_url, destination.url)
+        if not done:
+            log.error("Could not recreate %s from %s, copying it instead..." %
+                      (destination, original_url))
+            return False
+        self.set_destination_attributes(destination.url, source.attributes)
+        self.duplicate_counter += 1
+        return True
+
+    def defer_deletion(self, item):
+        """Hold back deleting a destination file or directory until the new source files have
+           been matched against the files in it, which they might have been moved from.
+
+           item - A FileObject instance of the file or directory to delete.
+        """
+        self._deleted_items.append(item)
+        directory_stack = [item]
+        while directory_stack:
+            item = directory_stack.pop()
+            if item.isdir:
+                directory_stack.extend(self.destination_transport.listdir(item.url))
+                continue
+            item.populate_attributes(["size"])
+            if item.size >= RENAME_MIN_SIZE:
+                self._rename_candidates.setdefault(item.size, []).append(item)
+
+    def resolve_renames(self):
+        """Move the destination files we are deleting to the new paths of the source files
+           that have the same attributes, copy the rest of the new files and delete what's
+           left."""
+        new_files = self._new_files
+        self._new_files = []
+        moved_urls = set()
+        for source, destination in new_files:
+            candidates = self._rename_candidates.get(source.size, [])
+            for candidate in candidates:
+                if self.is_moved_file(source, candidate) and \
+                   self.rename_file(candidate, source, destination):
+                    candidates.remove(candidate)
+                    moved_urls.add(candidate.url)
+                    self.file_counter += 1
+                    break
+            else:
+                if self.copy_changed_file(source, destination):
+                    self.file_counter += 1
+        for item in self._deleted_items:
+            if item.url not in moved_urls:
+                self.delete_destination(item)
+        self._deleted_items = []
+        self._rename_candidates = {}
+
+    def is_moved_file(self, source, candidate):
+        """Check whether a destination file that is being deleted has the same attributes and,
+           where we can tell, contents as a new source file."""
+        if self.find_difference(source, candidate) is not None:
+            return False
+        for key in self._rename_attributes:
+            source.populate_attributes([key])
+            candidate.populate_attributes([key])
+            if getattr(source, key) != getattr(candidate, key):
+                return False
+        return True
+
+    def rename_file(self, candidate, source, destination):
+        """Move a destination file that is being deleted to where a new source file with the
+           same attributes is being copied, and set its attributes.
+
+           Returns True if the file was moved, False otherwise.
+        """
+        log.info("Moving \"%s\"\n        to \"%s\"..." % (candidate, destination))
+        if not self.config.dry_run:
+            if not self.destination_transport.rename(candidate.url, destination.url):
+                log.error("Could not move %s, copying instead..." % candidate)
+                return False
+            self.set_destination_attributes(destination.url, source.attributes)
+        self.rename_counter += 1
+        return True
+
+    def find_difference(self, source, destination):
+        """Return the first evaluation attribute that differs between two files, or None if
+           they are identical.
+
+           Content hashes are only gathered if all the other attributes match.
+        """
+        for attribute_set in (self.max_evaluation_attributes - HASH_ATTRIBUTES,
+                              self.max_evaluation_attributes & HASH_ATTRIBUTES):
+            # Try to gather as many attributes of both files as possible.
+            src_difference = ((self.source_transport.getattr_attributes & attribute_set) |
+                              self.config.requested_attributes) - source.attribute_set
+            if src_difference:
+                # If the set of useful attributes we have is smaller than the set of attributes
+                # the user requested and the ones we can gather through getattr(), get the rest.
+                log.debug("Source getattr for file %s and arguments %s deemed necessary." % \
+                              (source, src_difference))
+                source.populate_attributes(src_difference)
+                # We should now have all the attributes we're interested in, both for
+                # evaluating if the files are different and setting.
+
+            # We aren't interested in the user's requested arguments for the destination.
+            dest_difference = (self.destination_transport.getattr_attributes &
+                               attribute_set) - destination.attribute_set
+            if dest_difference:
+                # Same for the destination.
+                log.debug("Destination getattr for %s deemed necessary." % destination)
+                destination.populate_attributes(dest_difference)
+
+            # Compare the evaluation keys that are common in both dictionaries. If one is
+            # different, the files are.
+            evaluation_attributes = source.attribute_set & destination.attribute_set & \
+                                    attribute_set
+            log.debug("Checking evaluation attributes %s..." % evaluation_attributes)
+            for key in evaluation_attributes:
+                if getattr(source, key) != getattr(destination, key):
+                    log.debug("Source and destination %s was different (%s vs %s)." %\
+                                  (key, getattr(source, key), getattr(destination, key)))
+                    return key
+        return None
+
+    def plan_entry(self, action, url, attributes=None):
+        """Write a change to the --plan file, if there is one, as a JSON list of the action,
+           the path relative to the destination and the source attributes it expects. Strings
+           are written as Latin-1, so that any bytes in filenames survive the round trip."""
+        if self._plan_file is None:
+            return
+        path = self.get_relative_path(url)
+        # Copies set the attributes anyway.
+        if action == "setattr" and self._last_plan_entry == ("copy", path):
+            return
+        self._last_plan_entry = (action, path)
+        entry = [action, path]
+        if attributes is not None:
+            entry.append(dict((key, value) for key, value in attributes.items()
+                              if key != "isdir"))
+        self._plan_file.write(json.dumps(entry, separators=(",", ":"), encoding="latin-1") +
+                              "\n")
+
+    def get_relative_path(self, url):
+        """Return a destination URL's path relative to the destination."""
+        root = append_slash(self.destination)
+        if append_slash(url) == root:
+            return ""
+        assert url.startswith(root), "URL %s is not in the destination." % url
+        return url[len(root):]
+
+    def get_source_url(self, path):
+        """Return the source URL of a path relative to the source, which is the source itself
+           if it's a file."""
+        if not path or not self._source_isdir:
+            return self.source
+        return append_slash(self.source) + path
+
+    def get_destination_url(self, path):
+        """Return the destination URL of a path relative to the destination."""
+        if not path:
+            return self.destination
+        return append_slash(self.destination) + path
+
+    def source_changed(self, path, attributes):
+        """Check whether a source file no longer has the attributes it was planned with."""
+        url = self.get_source_url(path)
+        if not self.source_transport.exists(url):
+            return True
+        if attributes is None:
+            return False
+        keys = [key for key in attributes if key in self.max_evaluation_attributes and
+                key in self.source_transport.getattr_attributes]
+        if not keys:
+            return False
+        current = self.source_transport.getattr(url, keys)
+        return [key for key in keys if current.get(key) != attributes[key]] != []
+
+    def get_public_url(self, transport, url):
+        """Return a URL of _transport_ without the username and password in it."""
+        return strip_credentials(url, transport.uses_hostname)
+
+    def apply(self, filename, source=None, destination=None):
+        """Carry out the changes in a --plan file, skipping the ones whose source has changed
+           since it was written.
+
+           Plans don't record credentials, so _source_ and _destination_ can give the locations
+           the plan was made for again along with them. Otherwise the transports ask for them.
+        """
+        plan_file = open_plan(filename, "rb")
+        header = json.loads(plan_file.readline() or "{}")
+        if header.get("omnisync_plan") != PLAN_FORMAT:
+            log.error("%s is not an omnisync plan." % filename)
+            self.exit(1)
+        planned = (header["source"].encode("latin-1"), header["destination"].encode("latin-1"))
+        if source is None:
+            source, destination = planned
+        if not self.start(source, destination):
+            return
+        if (self.get_public_url(self.source_transport, self.source),
+            self.get_public_url(self.destination_transport, self.destination)) != planned:
+            log.error("%s was planned from %s to %s." % ((filename, ) + planned))
+            self.exit(1)
+        self._source_isdir = self.source_transport.isdir(self.source)
+        # Group the changes by action, keeping them in order within each group.
+        entries = dict((action, []) for action in PLAN_ACTIONS)
+        for line in plan_file:
+            entry = decode_plan_value(json.loads(line))
+            entries[entry[0]].append((entry[1], (entry[2:] or [None])[0]))
+        if plan_file is not sys.stdin:
+            plan_file.close()
+
+        for action in ("remove", "rmtree"):
+            for path, attributes in entries[action]:
+                if self.source_transport.exists(self.get_source_url(path)):
+                    log.warning("%s has reappeared in the source, not deleting it." % path)
+                    self.skip_counter += 1
+                    continue
+                self.delete_destination(FileObject(self.destination_transport,
+                                                   self.get_destination_url(path),
+                                                   {"isdir": action == "rmtree"}))
+        for path, attributes in entries["mkdir"]:
+            self.destination_transport.mkdir(self.get_destination_url(path))
+        self.apply_copies(entries["copy"])
+        for path, attributes in entries["mkdir"] + entries["setattr"]:
+            if attributes is None:
+                continue
+            if self.source_changed(path, attributes):
+                log.warning("%s has changed in the source since it was planned, skipping..." %
+                            path)
+                self.skip_counter += 1
+                continue
+            self.set_destination_attributes(self.get_destination_url(path), attributes)
+        if self.skip_counter:
+            log.warning("Skipped %s changes whose source has changed since they were planned." %
+                        self.skip_counter)
+        self.finish()
+
+    def apply_copies(self, entries):
+        """Copy the files of a plan, with --jobs threads in parallel sharing our transports."""
+        jobs = min(self.config.jobs, len(entries))
+        if jobs > 1 and not (getattr(self.source_transport, "thread_safe", False) and
+                             getattr(self.destination_transport, "thread_safe", False)):
+            log.warning("These protocols can't copy several files at once, ignoring --jobs.")
+            jobs = 1
+        if jobs <= 1:
+            for path, attributes in entries:
+                self.apply_copy(path, attributes)
+            return
+        queue = Queue.Queue()
+        for entry in entries:
+            queue.put(entry)
+        # The workers share our transports, and their sessions.
+        self.release_sessions()
+        threads = [threading.Thread(target=self.apply_worker, args=(queue, ))
+                   for counter in range(jobs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def apply_worker(self, queue):
+        """Copy files from the queue over our transports, until there are none left. Files
+           that fail are counted as errors rather than stopping the worker."""
+        # The worker has its own batches and counters, but shares our connections.
+        worker = OmniSync()
+        worker.config = self.config
+        for name in ("source", "destination", "source_transport", "destination_transport",
+                     "max_attributes", "max_evaluation_attributes", "_source_isdir"):
+            setattr(worker, name, getattr(self, name))
+        try:
+            while True:
+                try:
+                    path, attributes = queue.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    worker.apply_copy(path, attributes)
+                except Exception, failure:
+                    log.error("Could not copy %s: %s" % (path, failure))
+                    worker.error_counter += 1
+                finally:
+                    # There may be more workers than sessions, so only hold on to them for
+                    # one file at a time.
+                    worker.release_sessions()
+            try:
+                worker.flush()
+            except Exception, failure:
+                log.error("Could not finish copying: %s" % failure)
+                worker.error_counter += 1
+        finally:
+            worker.release_sessions()
+        self._lock.acquire()
+        try:
+            self.file_counter += worker.file_counter
+            self.bytes_total += worker.bytes_total
+            self.error_counter += worker.error_counter
+            self.skip_counter += worker.skip_counter
+        finally:
+            self._lock.release()
+
+    def release_sessions(self):
+        """Let other threads use the sessions of our transports the current thread has been
+           using, for transports that pool them."""
+        for transport in (self.source_transport, self.destination_transport):
+            if hasattr(transport, "release_session"):
+                transport.release_session()
+
+    def apply_copy(self, path, attributes):
+        """Copy a file of a plan, unless its source has changed since it was planned."""
+        if self.source_changed(path, attributes):
+            log.warning("%s has changed in the source since it was planned, skipping..." % path)
+            self.skip_counter += 1
+            return
+        source = FileObject(self.source_transport, self.get_source_url(path),
+                            dict(attributes or {}, isdir=False))
+        destination = FileObject(self.destination_transport, self.get_destination_url(path))
+        if self.copy_changed_file(source, destination):
+            self.file_counter += 1
+
+    def delete_destination(self, item):
+        """Delete a destination file or directory, or only plan to in a dry run.
+
+           item - A FileObject instance of the file or directory to delete.
+        """
+        if item.isdir:
+            log.info("Deleting destination directory %s..." % item)
+            if self.config.dry_run:
+                self.plan_entry("rmtree", item.url)
+            else:
+                self.recursively_delete(item)
+        else:
+            log.info("Deleting destination file %s..." % item)
+            if self.config.dry_run:
+                self.plan_entry("remove", item.url)
+            else:
+                self.destination_transport.remove(item.url)
+
     def recursively_delete(self, directory):
         """Recursively delete a directory from the destination transport.
 
            directory - A FileObject instance of the directory to delete.
         """
+        # Let the transport remove the whole tree in one go if it can, and fall back to
+        # removing what's left one item at a time if that fails.
+        if hasattr(self.destination_transport, "remove_tree") and \
+           self.destination_transport.remove_tree(directory.url):
+            return
         directory_stack = [directory]
         directory_names = []
 
@@ -412,6 +1300,70 @@ class OmniSync(object):
             item = directory_names.pop()
             self.destination_transport.rmdir(item.url)
 
+    def queue_small_file(self, source, destination):
+        """Read a small file and queue it to be sent along with others in one batch, if the
+           destination transport supports that.
+
+           Returns True if the file was queued, False if it should be copied on its own.
+        """
+        threshold = getattr(self.destination_transport, "small_file_threshold", 0)
+        if self.config.dry_run or not threshold or \
+           not hasattr(self.destination_transport, "write_small_files") or \
+           source.attributes.get("size") is None or source.size > threshold:
+            return False
+
+        try:
+            self.source_transport.open(source.url, "rb")
+        except IOError:
+            log.error("Could not open %s, skipping..." % source)
+            raise
+        data = []
+        chunk = self.source_transport.read(self.source_transport.buffer_size)
+        while chunk:
+            data.append(chunk)
+            chunk = self.source_transport.read(self.source_transport.buffer_size)
+        self.source_transport.close()
+        data = "".join(data)
+
+        self._small_files.append((destination.url, data, source.attributes))
+        self._small_files_size += len(data)
+        if self._small_files_size >= SMALL_FILE_BATCH_SIZE or \
+           len(self._small_files) >= SMALL_FILE_BATCH_COUNT:
+            self.flush_small_files()
+        return True
+
+    def flush_small_files(self):
+        """Send the queued small files to the destination, one at a time if the transport
+           can't send them together after all."""
+        if not self._small_files:
+            return
+        small_files = self._small_files
+        self._small_files = []
+        self._small_files_size = 0
+
+        if self.destination_transport.write_small_files(small_files):
+            written = small_files
+        else:
+            log.debug("Could not send %s small files together, copying them one by one..." %
+                      len(small_files))
+            written = []
+            for url, data, attributes in small_files:
+                self.destination_transport.remove(url)
+                try:
+                    self.destination_transport.open(url, "wb")
+                except IOError:
+                    log.error("Could not open %s, skipping..." % url)
+                    self.destination_transport.close()
+                    self.error_counter += 1
+                    continue
+                self.destination_transport.write(data)
+                self.destination_transport.close()
+                written.append((url, data, attributes))
+
+        for url, data, attributes in written:
+            self.bytes_total += len(data)
+            self.set_destination_attributes(url, attributes)
+
     def copy_file(self, source, destination):
         """Copy a file.
 
@@ -419,20 +1371,22 @@ class OmniSync(object):
            destination - A FileObject instance pointing to the source file.
         """
         if self.config.dry_run:
+            self.plan_entry("copy", destination.url, source.attributes)
             return
 
         # Select the smallest buffer size of the two, to avoid congestion.
         buffer_size = min(self.source_transport.buffer_size,
                           self.destination_transport.buffer_size)
         try:
-            self.source_transport.open(source.url, "rb")
+            self.source_transport.open(source.url, "rb", source.attributes.get("size"))
         except IOError:
             log.error("Could not open %s, skipping..." % source)
             raise
         # Remove the file before copying.
         self.destination_transport.remove(destination.url)
         try:
-            self.destination_transport.open(destination.url, "wb")
+            self.destination_transport.open(destination.url, "wb",
+                                            source.attributes.get("size"))
         except IOError:
             log.error("Could not open %s, skipping..." % destination)
             self.destination_transport.close()
@@ -444,14 +1398,60 @@ class OmniSync(object):
         else:
             prog = None
             
+        # Only copy the data extents of sparse files and skip the blocks of zeros, and seek past
+        # them at the destination, if it lets us.
+        sparse = self.config.sparse and hasattr(self.destination_transport, "seek") and \
+                 hasattr(self.destination_transport, "truncate")
+        extents = [(0, None)]
+        if sparse and hasattr(self.source_transport, "get_extents") and \
+           hasattr(self.source_transport, "seek"):
+            extents = self.source_transport.get_extents()
+
         bytes_done = 0
-        data = self.source_transport.read(buffer_size)
-        while data:
-            if not bytes_done % 5:
-                self.report_file_progress(prog, bytes_done)
-            bytes_done += len(data)
-            self.destination_transport.write(data)
-            data = self.source_transport.read(buffer_size)
+        # Where the data read from the source goes, and where the destination is at.
+        position = 0
+        dest_position = 0
+        try:
+            for offset, length in extents:
+                if offset != position:
+                    self.source_transport.seek(offset)
+                    position = offset
+                if length is None:
+                    length = -1
+                data = self.source_transport.read(buffer_size if length < 0 else
+                                                  min(buffer_size, length))
+                while data:
+                    if not bytes_done % 5:
+                        self.report_file_progress(prog, position)
+                    if not sparse or data.count("\0") != len(data):
+                        if dest_position != position:
+                            self.destination_transport.seek(position)
+                        bytes_done += len(data)
+                        self.destination_transport.write(data)
+                        dest_position = position + len(data)
+                    position += len(data)
+                    length -= len(data)
+                    if not length:
+                        break
+                    data = self.source_transport.read(buffer_size if length < 0 else
+                                                      min(buffer_size, length))
+            if sparse:
+                # Recreate the hole at the end of the file, if it has one.
+                size = source.attributes.get("size")
+                if size is None:
+                    size = position
+                if dest_position != size:
+                    self.destination_transport.truncate(size)
+        except:
+            failure = sys.exc_info()
+            if isinstance(failure[1], IOError):
+                log.error("Could not copy %s, skipping..." % source)
+            self.bytes_total += bytes_done
+            # Throw away what was written, if the transport lets us, rather than finish a
+            # truncated file.
+            getattr(self.destination_transport, "abort", self.destination_transport.close)()
+            self.source_transport.close()
+            raise failure[0], failure[1], failure[2]
         self.bytes_total += bytes_done
         self.destination_transport.close()
         self.source_transport.close()
@@ -463,6 +1463,8 @@ class OmniSync(object):
             prog - Progress instance to compute the progress
             bytes_done - how much of the file has been transferred already.
         """
+        if not self.config.full_options.verbosity:
+            return
         # The source file might not have a size attribute.
         if prog:
             done = prog.progress(bytes_done)
@@ -472,8 +1474,8 @@ class OmniSync(object):
             print "Copied %s bytes.\r" % (bytes_done),
 
 
-def parse_arguments(omnisync):
-    """Parse the command-line arguments."""
+def parse_arguments(omnisync, args=None):
+    """Parse the command-line arguments, or _args_ if given."""
     parser = optparse.OptionParser(
         usage="%prog [options] <source> <destination>",
         version="%%prog %s" % VERSION
@@ -511,6 +1513,18 @@ def parse_arguments(omnisync):
                       dest="dry_run",
                       help="show what would have been transferred"
                       )
+    parser.add_option("-c", "--checksum",
+                      action="store_true",
+                      dest="checksum",
+                      help="compare file checksums as well as sizes and times"
+                      )
+    parser.add_option("--checksum-algorithm",
+                      dest="checksum_algorithm",
+                      choices=("md5", "sha1", "sha256"),
+                      default="sha256",
+                      help="the checksum algorithm to use (md5, sha1 or sha256)",
+                      metavar="ALGORITHM"
+                      )
     parser.add_option("-p", "--perms",
                       action="append_const",
                       const="perms",
@@ -549,14 +1563,146 @@ def parse_arguments(omnisync):
                       help="don't exclude directories matching the PATTERN regex",
                       metavar="PATTERN"
                       )
+    parser.add_option("--plan",
+                      dest="plan",
+                      help="don't change anything, but write the changes to FILE, or the "
+                           "standard output if FILE is -, for --apply",
+                      metavar="FILE"
+                      )
+    parser.add_option("--apply",
+                      dest="apply",
+                      help="carry out the changes planned in FILE, or the standard input if "
+                           "FILE is -, between the locations they were planned for, skipping "
+                           "the ones whose source has changed since. Plans don't record "
+                           "usernames and passwords, so give the locations again with them or "
+                           "enter them when asked",
+                      metavar="FILE"
+                      )
+    parser.add_option("-j", "--jobs",
+                      dest="jobs",
+                      type="int",
+                      default=4,
+                      help="copy up to N files at once over separate connections when "
+                           "applying a plan (default 4)",
+                      metavar="N"
+                      )
+    parser.add_option("-S", "--sparse",
+                      action="store_true",
+                      dest="sparse",
+                      help="only copy the data of sparse files and leave holes in the "
+                           "destination files where the source files have holes or blocks of "
+                           "zeros, if the destination supports that"
+                      )
+    parser.add_option("-H", "--hard-links",
+                      action="store_true",
+                      dest="hard_links",
+                      help="copy the data of files that are hard links to each other once, "
+                           "and link or copy them to each other on the destination"
+                      )
+    parser.add_option("--dedupe",
+                      action="store_true",
+                      dest="dedupe",
+                      help="copy the data of source files with the same contents once, and "
+                           "copy them from each other on the destination where it can copy "
+                           "files by itself"
+                      )
+    parser.add_option("--detect-renames",
+                      action="store_true",
+                      dest="detect_renames",
+                      help="with --delete, move destination files that are being deleted to "
+                           "the new paths of source files of the same size and mtime or "
+                           "checksum, instead of copying them"
+                      )
+    parser.add_option("--skip-unchanged-dirs",
+                      action="store_true",
+                      dest="skip_unchanged_dirs",
+                      help="don't compare the files of source directories whose mtime and "
+                           "number of entries haven't changed since they were last "
+                           "synchronised, which misses files that were changed in place"
+                      )
+    parser.add_option("--paranoid",
+                      action="store_true",
+                      dest="paranoid",
+                      help="compare the files of unchanged directories with "
+                           "--skip-unchanged-dirs anyway"
+                      )
+    parser.add_option("--dir-cache",
+                      dest="directory_cache",
+                      help="record the synchronised directories for --skip-unchanged-dirs in "
+                           "FILE (default %s)" % DIRECTORY_CACHE,
+                      metavar="FILE"
+                      )
+    parser.add_option("--files-from",
+                      dest="files_from",
+                      help="only synchronise the paths listed in FILE, relative to the source, "
+                           "or those listed on the standard input if FILE is -",
+                      metavar="FILE"
+                      )
+    parser.add_option("-0", "--from0",
+                      action="store_true",
+                      dest="from0",
+                      help="the paths in the --files-from list are separated by null "
+                           "characters rather than new lines"
+                      )
+    parser.add_option("--watch",
+                      action="store_true",
+                      dest="watch",
+                      help="keep synchronising the changes to the source until interrupted"
+                      )
+    parser.add_option("--watch-delay",
+                      dest="watch_delay",
+                      type="float",
+                      default=1.0,
+                      help="wait until no changes have been made for SECONDS before "
+                           "synchronising them (default 1)",
+                      metavar="SECONDS"
+                      )
+    parser.add_option("--rescan-interval",
+                      dest="rescan_interval",
+                      type="float",
+                      default=3600,
+                      help="rescan the whole source every SECONDS when watching it, in case "
+                           "changes were missed (default 3600)",
+                      metavar="SECONDS"
+                      )
     # Allow the plugins to set their own options.
     omnisync.add_options(parser)
-    (options, args) = parser.parse_args()
-    if len(args) != 2:
+    (options, args) = parser.parse_args(args)
+    if len(args) != 2 and not (options.apply and not args):
         parser.print_help()
         sys.exit()
     return options, args
 
+def open_plan(filename, mode):
+    """Open a plan file, or the standard input or output if _filename_ is "-"."""
+    if filename == "-":
+        if mode.startswith("r"):
+            return sys.stdin
+        return sys.stdout
+    return open(filename, mode)
+
+def decode_plan_value(value):
+    """Turn the strings JSON decoded from a plan back into the bytes they were written as."""
+    if isinstance(value, unicode):
+        return value.encode("latin-1")
+    elif isinstance(value, list):
+        return [decode_plan_value(x) for x in value]
+    elif isinstance(value, dict):
+        return dict((decode_plan_value(x), decode_plan_value(y)) for x, y in value.items())
+    return value
+
+def read_paths(filename, null_separated=False):
+    """Read a list of paths from a file, or the standard input if _filename_ is "-". Paths are
+       separated by new lines, or by null characters if _null_separated_ is True, and blank
+       lines and lines starting with "#" are ignored."""
+    if filename == "-":
+        data = sys.stdin.read()
+    else:
+        data = open(filename, "rb").read()
+    if null_separated:
+        return [path for path in data.split("\0") if path]
+    return [path for path in data.splitlines() if path.strip() and not path.startswith("#")]
+
 def main():
     # Initialise the logger.
     logging.basicConfig(level=logging.INFO, format='%(message)s',
@@ -565,7 +1711,14 @@ def main():
     omnisync = OmniSync()
     (options, args) = parse_arguments(omnisync)
     omnisync.config = Configuration(options)
-    omnisync.sync(args[0], args[1])
+    if options.apply:
+        omnisync.apply(options.apply, *args)
+    elif options.watch:
+        omnisync.watch(args[0], args[1])
+    elif options.files_from:
+        omnisync.sync(args[0], args[1], read_paths(options.files_from, options.from0))
+    else:
+        omnisync.sync(args[0], args[1])
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,183 @@
+"""Operating system functions that Python's os module doesn't have."""
+
+import os
+import sys
+import errno
+import ctypes
+import ctypes.util
+
+# The lseek() whences that find the next data or hole in a file, which Python 2 doesn't
+# define. They are None where we don't know them.
+if sys.platform.startswith("linux") or sys.platform.startswith("freebsd") or \
+   sys.platform.startswith("sunos"):
+    SEEK_DATA = 3
+    SEEK_HOLE = 4
+elif sys.platform == "darwin":
+    SEEK_HOLE = 3
+    SEEK_DATA = 4
+else:
+    SEEK_DATA = SEEK_HOLE = None
+
+# posix_fadvise() advice, which is the same on every system that has it.
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+# Linux's sync_file_range() flags.
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+# The C library, or False if it hasn't been loaded yet.
+_libc = False
+
+
+def get_data_extents(fd, size):
+    """Return the (offset, length) extents of the open file _fd_ of _size_ bytes that hold
+       data, leaving out its holes. The whole file is one extent if the system or filesystem
+       can't tell where the holes are. The file position is reset to the start.
+    """
+    if SEEK_DATA is None:
+        return [(0, size)]
+    # A file that takes up as much space as its size has no holes.
+    statinfo = os.fstat(fd)
+    if getattr(statinfo, "st_blocks", None) is None or statinfo.st_blocks * 512 >= size:
+        return [(0, size)]
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError, failure:
+                # There is no data after the offset.
+                if failure.errno == errno.ENXIO:
+                    break
+                raise
+            end = min(os.lseek(fd, start, SEEK_HOLE), size)
+            if end > start:
+                extents.append((start, end - start))
+            offset = end
+    except OSError, failure:
+        if failure.errno in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+            extents = [(0, size)]
+        else:
+            raise
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+    return extents
+
+
+def _get_libc():
+    """Return the C library, loading it the first time, or None if it can't be loaded."""
+    global _libc
+    if _libc is False:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        except OSError:
+            _libc = None
+    return _libc
+
+
+def preallocate(fd, size):
+    """Allocate disk space for the first _size_ bytes of the open file _fd_, extending it to
+       that size if it's smaller, so that writing it doesn't fragment it.
+
+       Returns True if the space was allocated, False if the system or filesystem can't
+       allocate space in advance.
+    """
+    libc = _get_libc()
+    if libc is None:
+        return False
+    # Linux's fallocate() fails where the filesystem can't allocate space, rather than
+    # writing zeros to every block like glibc's posix_fallocate() falls back to.
+    if hasattr(libc, "fallocate64"):
+        function = libc.fallocate64
+        function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        return function(fd, 0, 0, size) == 0
+    if hasattr(libc, "posix_fallocate"):
+        function = libc.posix_fallocate
+        function.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        # posix_fallocate() returns the error number rather than setting errno.
+        return function(fd, 0, size) == 0
+    return False
+
+
+def sync_data(fd):
+    """Write the data of the open file _fd_ to disk, along with the metadata needed to read
+       it back."""
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def sync_filesystem(fd):
+    """Write everything that is waiting to be written to the filesystem the open file _fd_ is
+       on to disk, or to every filesystem where that can't be done for a single one."""
+    libc = _get_libc()
+    if libc is not None and hasattr(libc, "syncfs"):
+        if libc.syncfs(fd) != 0:
+            error = ctypes.get_errno()
+            raise OSError, (error, os.strerror(error))
+    elif libc is not None and hasattr(libc, "sync"):
+        libc.sync()
+    else:
+        os.fsync(fd)
+
+
+def advise(fd, offset, length, advice):
+    """Tell the system how the _length_ bytes of the open file _fd_ from _offset_ will be
+       accessed, where a _length_ of 0 means the rest of the file.
+
+       Returns True if the advice was taken, False if the system doesn't take advice.
+    """
+    libc = _get_libc()
+    if libc is None or not hasattr(libc, "posix_fadvise"):
+        return False
+    function = libc.posix_fadvise
+    function.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+    # posix_fadvise() returns the error number rather than setting errno.
+    return function(fd, offset, length, advice) == 0
+
+
+def sync_range(fd, offset, length, flags):
+    """Start writing the _length_ bytes of the open file _fd_ from _offset_ to disk, wait for
+       them to be written, or both, depending on the SYNC_FILE_RANGE_* _flags_.
+
+       Returns True if that was done, False if the system can't do it for part of a file.
+    """
+    libc = _get_libc()
+    if libc is None or not hasattr(libc, "sync_file_range"):
+        return False
+    function = libc.sync_file_range
+    function.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+    return function(fd, offset, length, flags) == 0
+
+
+def read_into(fd, address, size):
+    """Read up to _size_ bytes from the open file _fd_ into the memory at _address_, and
+       return the number of bytes read.
+
+       Raises OSError if the read failed.
+    """
+    function = _get_libc().read
+    function.restype = ctypes.c_ssize_t
+    count = function(fd, ctypes.c_void_p(address), ctypes.c_size_t(size))
+    if count < 0:
+        error = ctypes.get_errno()
+        raise OSError, (error, os.strerror(error))
+    return count
+
+
+def write_from(fd, address, size):
+    """Write the _size_ bytes at _address_ to the open file _fd_, and return the number of
+       bytes written.
+
+       Raises OSError if the write failed.
+    """
+    function = _get_libc().write
+    function.restype = ctypes.c_ssize_t
+    count = function(fd, ctypes.c_void_p(address), ctypes.c_size_t(size))
+    if count < 0:
+        error = ctypes.get_errno()
+        raise OSError, (error, os.strerror(error))
+    return count
@@ -0,0 +1,611 @@
+"""Local stand-in servers for testing and benchmarking the network transports."""
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import urlparse
+import urllib
+import cgi
+import hashlib
+import time
+import re
+import os
+import socket
+import subprocess
+from xml.sax.saxutils import escape, unescape
+
+try:
+    import paramiko
+    from paramiko.sftp import CMD_NAMES
+except ImportError:
+    paramiko = None
+
+# The most keys S3 returns in one listing page.
+S3_PAGE_SIZE = 1000
+
+
+def http_date(timestamp):
+    """Format a timestamp as an HTTP date."""
+    return time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(timestamp))
+
+def iso_date(timestamp):
+    """Format a timestamp as an ISO 8601 date, as S3 listings do."""
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(timestamp))
+
+
+class S3Object(object):
+    """An object stored in the S3 stand-in."""
+    def __init__(self, data, etag=None):
+        self.data = data
+        self.etag = etag or hashlib.md5(data).hexdigest()
+        self.last_modified = time.time()
+
+
+class S3RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handle requests to the S3 stand-in, in path-style addressing."""
+    protocol_version = "HTTP/1.1"
+    # Send each response in one go, so that small responses don't wait for delayed
+    # acknowledgements.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        """Don't log requests."""
+
+    def _parse(self):
+        """Split the request into the bucket, key and query arguments, and apply any fault
+           injected for it.
+
+           Returns False if the request has been answered with an injected error.
+        """
+        self.server.count_request(self.command)
+        split_path = urlparse.urlsplit(self.path)
+        parts = split_path.path.lstrip("/").split("/", 1)
+        self.bucket_name = urllib.unquote(parts[0])
+        if len(parts) > 1:
+            self.key_name = urllib.unquote(parts[1])
+        else:
+            self.key_name = ""
+        self.arguments = dict((x, y[0]) for x, y in
+                              cgi.parse_qs(split_path.query, keep_blank_values=True).items())
+        self.bucket = self.server.buckets.get(self.bucket_name)
+        delay, status = self.server.take_fault(self.command, self.key_name)
+        if delay:
+            time.sleep(delay)
+        if status:
+            # We haven't read the body, so the connection can't be reused.
+            self.close_connection = 1
+            self._respond(status, "<?xml version=\"1.0\" encoding=\"UTF-8\"?><Error><Code>"
+                                  "InjectedFault</Code><Message>InjectedFault</Message></Error>",
+                          {"Connection": "close"})
+            return False
+        return True
+
+    def _read_body(self):
+        """Read the request body."""
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _respond(self, status, body="", headers=None):
+        """Send a response."""
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+        """Send an S3 error response."""
+        self._respond(status, "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+                              "<Error><Code>%s</Code><Message>%s</Message></Error>" %
+                              (code, code))
+
+    def _object_headers(self, stored):
+        """Return the headers that describe an object."""
+        return {"ETag": "\"%s\"" % stored.etag,
+                "Last-Modified": http_date(stored.last_modified),
+                "Content-Type": "application/octet-stream"}
+
+    def do_HEAD(self):
+        """Check for a bucket or retrieve an object's metadata."""
+        if not self._parse():
+            return
+        if self.bucket is None:
+            self._respond(404)
+        elif not self.key_name:
+            self._respond(200)
+        elif self.key_name in self.bucket:
+            stored = self.bucket[self.key_name]
+            headers = self._object_headers(stored)
+            self.send_response(200)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.send_header("Content-Length", str(len(stored.data)))
+            self.end_headers()
+        else:
+            self._respond(404)
+
+    def do_GET(self):
+        """List a bucket or retrieve an object, or a range of it."""
+        if not self._parse():
+            return
+        if self.bucket is None:
+            return self._error(404, "NoSuchBucket")
+        if not self.key_name:
+            return self._list()
+        if self.key_name not in self.bucket:
+            return self._error(404, "NoSuchKey")
+        stored = self.bucket[self.key_name]
+        headers = self._object_headers(stored)
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(stored.data) - 1), len(stored.data) - 1)
+            headers["Content-Range"] = "bytes %s-%s/%s" % (start, end, len(stored.data))
+            self._respond(206, stored.data[start:end + 1], headers)
+        else:
+            self._respond(200, stored.data, headers)
+
+    def _list(self):
+        """Send a page of a bucket listing."""
+        self.server.count_request("LIST")
+        prefix = self.arguments.get("prefix", "")
+        delimiter = self.arguments.get("delimiter", "")
+        marker = self.arguments.get("marker", "")
+        max_keys = int(self.arguments.get("max-keys", S3_PAGE_SIZE))
+        contents = []
+        prefixes = []
+        truncated = False
+        for name in sorted(self.bucket):
+            if not name.startswith(prefix) or name <= marker:
+                continue
+            if len(contents) + len(prefixes) >= max_keys:
+                truncated = True
+                break
+            if delimiter and delimiter in name[len(prefix):]:
+                common_prefix = name[:name.index(delimiter, len(prefix)) + len(delimiter)]
+                if common_prefix not in prefixes:
+                    prefixes.append(common_prefix)
+                continue
+            stored = self.bucket[name]
+            contents.append("<Contents><Key>%s</Key><LastModified>%s</LastModified>"
+                            "<ETag>&quot;%s&quot;</ETag><Size>%s</Size>"
+                            "<StorageClass>STANDARD</StorageClass></Contents>" %
+                            (escape(name), iso_date(stored.last_modified), stored.etag,
+                             len(stored.data)))
+        body = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?><ListBucketResult>",
+                "<Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker>" %
+                (escape(self.bucket_name), escape(prefix), escape(marker)),
+                "<MaxKeys>%s</MaxKeys><IsTruncated>%s</IsTruncated>" %
+                (max_keys, truncated and "true" or "false")]
+        body.extend(contents)
+        body.extend("<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>" % escape(x)
+                    for x in prefixes)
+        body.append("</ListBucketResult>")
+        self._respond(200, "".join(body), {"Content-Type": "application/xml"})
+
+    def do_PUT(self):
+        """Create a bucket or store an object or a part of one."""
+        if not self._parse():
+            return
+        data = self._read_body()
+        if not self.key_name:
+            self.server.buckets.setdefault(self.bucket_name, {})
+            return self._respond(200)
+        if self.bucket is None:
+            return self._error(404, "NoSuchBucket")
+        if "uploadId" in self.arguments:
+            upload = self.server.uploads.get(self.arguments["uploadId"])
+            if upload is None:
+                return self._error(404, "NoSuchUpload")
+            part = S3Object(data)
+            upload[int(self.arguments["partNumber"])] = part
+            return self._respond(200, "", {"ETag": "\"%s\"" % part.etag})
+        copy_source = self.headers.get("x-amz-copy-source")
+        if copy_source is not None:
+            # A server-side copy of another object.
+            bucket_name, key_name = urllib.unquote(copy_source).lstrip("/").split("/", 1)
+            source = self.server.buckets.get(bucket_name, {}).get(key_name)
+            if source is None:
+                return self._error(404, "NoSuchKey")
+            stored = S3Object(source.data, source.etag)
+            self.bucket[self.key_name] = stored
+            return self._respond(200, "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+                                      "<CopyObjectResult><LastModified>%s</LastModified>"
+                                      "<ETag>&quot;%s&quot;</ETag></CopyObjectResult>" %
+                                      (iso_date(stored.last_modified), stored.etag))
+        stored = S3Object(data)
+        self.bucket[self.key_name] = stored
+        self._respond(200, "", {"ETag": "\"%s\"" % stored.etag})
+
+    def do_POST(self):
+        """Start or complete a multipart upload, or delete several objects."""
+        if not self._parse():
+            return
+        body = self._read_body()
+        if self.bucket is None:
+            return self._error(404, "NoSuchBucket")
+        if "delete" in self.arguments:
+            return self._delete_objects(body)
+        if "uploads" in self.arguments:
+            upload_id = self.server.new_upload()
+            return self._respond(200, "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+                                      "<InitiateMultipartUploadResult><Bucket>%s</Bucket>"
+                                      "<Key>%s</Key><UploadId>%s</UploadId>"
+                                      "</InitiateMultipartUploadResult>" %
+                                 (escape(self.bucket_name), escape(self.key_name), upload_id))
+        if "uploadId" in self.arguments:
+            upload = self.server.uploads.pop(self.arguments["uploadId"], None)
+            if upload is None:
+                return self._error(404, "NoSuchUpload")
+            numbers = [int(x) for x in re.findall(r"<PartNumber>(\d+)</PartNumber>", body)]
+            parts = [upload[x] for x in numbers]
+            # Multipart ETags are the MD5 of the parts' MD5s, followed by the part count.
+            etag = "%s-%s" % (hashlib.md5("".join(x.etag.decode("hex") for x in parts))
+                              .hexdigest(), len(parts))
+            stored = S3Object("".join(x.data for x in parts), etag)
+            self.bucket[self.key_name] = stored
+            return self._respond(200, "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+                                      "<CompleteMultipartUploadResult><Bucket>%s</Bucket>"
+                                      "<Key>%s</Key><ETag>&quot;%s&quot;</ETag>"
+                                      "</CompleteMultipartUploadResult>" %
+                                 (escape(self.bucket_name), escape(self.key_name), etag))
+        self._error(400, "InvalidRequest")
+
+    def _delete_objects(self, body):
+        """Delete the objects listed in a multi-object delete request."""
+        deleted = []
+        for key_name in re.findall(r"<Key>(.*?)</Key>", body, re.S):
+            key_name = unescape(key_name, {"&quot;": "\"", "&apos;": "'"})
+            self.bucket.pop(key_name, None)
+            deleted.append(key_name)
+        if re.search(r"<Quiet>true</Quiet>", body, re.I):
+            deleted = []
+        self._respond(200, "<?xml version=\"1.0\" encoding=\"UTF-8\"?><DeleteResult>%s"
+                           "</DeleteResult>" % "".join("<Deleted><Key>%s</Key></Deleted>" %
+                                                       escape(x) for x in deleted),
+                      {"Content-Type": "application/xml"})
+
+    def do_DELETE(self):
+        """Delete an object or abort a multipart upload."""
+        if not self._parse():
+            return
+        if self.bucket is None:
+            return self._error(404, "NoSuchBucket")
+        if "uploadId" in self.arguments:
+            self.server.uploads.pop(self.arguments["uploadId"], None)
+        else:
+            self.bucket.pop(self.key_name, None)
+        self._respond(204)
+
+
+class S3StandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """An in-memory, in-process S3-compatible HTTP server that the S3 transport can be
+       pointed at with --s3-endpoint.
+
+       It ignores authentication and only implements what the S3 transport uses.
+    """
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, S3RequestHandler)
+        # A dictionary of {bucket_name: {key_name: S3Object}} items.
+        self.buckets = {}
+        # A dictionary of {upload_id: {part_number: S3Object}} items.
+        self.uploads = {}
+        # The number of requests received, per HTTP method.
+        self.request_counts = {}
+        # Faults to inject, in {(method, key_name): [(delay, status), ...]} format. Each
+        # request for the key takes the next fault in its list, sleeping for _delay_ seconds
+        # first and then failing with the HTTP _status_ if it's not None.
+        self.faults = {}
+        self._lock = threading.Lock()
+        self._upload_counter = 0
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        """Return the URL to pass to --s3-endpoint."""
+        return "http://%s:%s" % self.server_address
+
+    def count_request(self, method):
+        """Count a request."""
+        self._lock.acquire()
+        try:
+            self.request_counts[method] = self.request_counts.get(method, 0) + 1
+        finally:
+            self._lock.release()
+
+    def take_fault(self, method, key_name):
+        """Return the (delay, status) of the next fault to inject into a request."""
+        self._lock.acquire()
+        try:
+            faults = self.faults.get((method, key_name))
+            if faults:
+                return faults.pop(0)
+        finally:
+            self._lock.release()
+        return None, None
+
+    def new_upload(self):
+        """Start a multipart upload and return its ID."""
+        self._lock.acquire()
+        try:
+            self._upload_counter += 1
+            upload_id = "upload%s" % self._upload_counter
+            self.uploads[upload_id] = {}
+        finally:
+            self._lock.release()
+        return upload_id
+
+    def start(self):
+        """Start serving in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        self.shutdown()
+        self.server_close()
+
+
+def set_file_attributes(filename, attributes):
+    """Set a file's SFTP attributes like paramiko.SFTPServer.set_file_attr() does, but without
+       emptying the file when its size is set."""
+    if attributes._flags & attributes.FLAG_SIZE:
+        resized_file = open(filename, "r+b")
+        try:
+            resized_file.truncate(attributes.st_size)
+        finally:
+            resized_file.close()
+        attributes._flags &= ~attributes.FLAG_SIZE
+    paramiko.SFTPServer.set_file_attr(filename, attributes)
+
+def sftp_error(function):
+    """Turn the OSErrors of an SFTP stand-in request into SFTP error codes."""
+    def wrapper(*args):
+        """Run the request."""
+        try:
+            return function(*args)
+        except (OSError, IOError), error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+
+if paramiko is not None:
+    class SFTPStandInServer(paramiko.ServerInterface):
+        """Accept any password and run commands in the stand-in's home directory."""
+        def __init__(self, standin):
+            self.standin = standin
+
+        def get_allowed_auths(self, username):
+            """Only offer password authentication."""
+            return "password"
+
+        def check_auth_password(self, username, password):
+            """Accept any password."""
+            return paramiko.AUTH_SUCCESSFUL
+
+        def check_channel_request(self, kind, chanid):
+            """Allow sessions."""
+            if kind == "session":
+                return paramiko.OPEN_SUCCEEDED
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+        def check_channel_exec_request(self, channel, command):
+            """Run a command through the shell, if the stand-in allows it."""
+            if not self.standin.allow_exec:
+                return False
+            self.standin.count_request("exec")
+            thread = threading.Thread(target=self._run, args=(channel, command))
+            thread.setDaemon(True)
+            thread.start()
+            return True
+
+        def _run(self, channel, command):
+            """Run a command, feeding it the channel's input and sending its output and exit
+               status back."""
+            process = subprocess.Popen(command, shell=True, cwd=self.standin.root,
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+
+            def feed():
+                """Copy the channel's input to the command."""
+                data = channel.recv(2**15)
+                while data:
+                    process.stdin.write(data)
+                    data = channel.recv(2**15)
+                process.stdin.close()
+            thread = threading.Thread(target=feed)
+            thread.setDaemon(True)
+            thread.start()
+            channel.sendall(process.stdout.read())
+            channel.send_exit_status(process.wait())
+            channel.close()
+
+    class SFTPStandInHandle(paramiko.SFTPHandle):
+        """An open file of the SFTP stand-in."""
+        @sftp_error
+        def stat(self):
+            """Return the attributes of the open file."""
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+        @sftp_error
+        def chattr(self, attributes):
+            """Set the attributes of the open file."""
+            set_file_attributes(self.filename, attributes)
+            return paramiko.SFTP_OK
+
+    class SFTPStandInInterface(paramiko.SFTPServerInterface):
+        """Carry out SFTP requests on the local filesystem, with relative paths resolved from
+           the stand-in's home directory."""
+        def __init__(self, server, standin):
+            paramiko.SFTPServerInterface.__init__(self, server)
+            self.standin = standin
+
+        def _get_filename(self, path):
+            """Return the local filename of an SFTP path."""
+            return os.path.join(self.standin.root, path)
+
+        @sftp_error
+        def list_folder(self, path):
+            """List a directory."""
+            directory = self._get_filename(path)
+            attribute_list = []
+            for name in os.listdir(directory):
+                attributes = paramiko.SFTPAttributes.from_stat(
+                    os.lstat(os.path.join(directory, name)))
+                attributes.filename = name
+                attribute_list.append(attributes)
+            return attribute_list
+
+        @sftp_error
+        def stat(self, path):
+            """Return the attributes of a file, following symbolic links."""
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._get_filename(path)))
+
+        @sftp_error
+        def lstat(self, path):
+            """Return the attributes of a file."""
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._get_filename(path)))
+
+        @sftp_error
+        def open(self, path, flags, attributes):
+            """Open a file."""
+            filename = self._get_filename(path)
+            descriptor = os.open(filename, flags, 0666)
+            if flags & os.O_WRONLY:
+                if flags & os.O_APPEND:
+                    mode = "ab"
+                else:
+                    mode = "wb"
+            elif flags & os.O_RDWR:
+                mode = "r+b"
+            else:
+                mode = "rb"
+            handle = SFTPStandInHandle(flags)
+            handle.filename = filename
+            handle.readfile = handle.writefile = os.fdopen(descriptor, mode)
+            return handle
+
+        @sftp_error
+        def remove(self, path):
+            """Remove a file."""
+            os.remove(self._get_filename(path))
+            return paramiko.SFTP_OK
+
+        @sftp_error
+        def rename(self, old_path, new_path):
+            """Rename a file."""
+            os.rename(self._get_filename(old_path), self._get_filename(new_path))
+            return paramiko.SFTP_OK
+        posix_rename = rename
+
+        @sftp_error
+        def mkdir(self, path, attributes):
+            """Create a directory."""
+            os.mkdir(self._get_filename(path))
+            return paramiko.SFTP_OK
+
+        @sftp_error
+        def rmdir(self, path):
+            """Remove a directory."""
+            os.rmdir(self._get_filename(path))
+            return paramiko.SFTP_OK
+
+        @sftp_error
+        def chattr(self, path, attributes):
+            """Set the attributes of a file."""
+            set_file_attributes(self._get_filename(path), attributes)
+            return paramiko.SFTP_OK
+
+        @sftp_error
+        def readlink(self, path):
+            """Return the target of a symbolic link."""
+            return os.readlink(self._get_filename(path))
+
+    class SFTPStandInSubsystem(paramiko.SFTPServer):
+        """An SFTP subsystem that counts the requests it receives."""
+        def _process(self, request_type, request_number, message):
+            """Count and carry out a request."""
+            self.server.standin.count_request(CMD_NAMES.get(request_type, request_type))
+            paramiko.SFTPServer._process(self, request_type, request_number, message)
+
+
+class SFTPStandIn(object):
+    """An in-process SFTP server on a local socket that the SFTP transport can connect to
+       with any username and password.
+
+       It serves the local filesystem, with relative paths and commands starting from the
+       _root_ directory, as the home directory of a real account would be. If _allow_exec_ is
+       False it refuses to run commands, like servers that only allow SFTP.
+    """
+    # The host key, which is slow to generate, so it's shared by all stand-ins.
+    _host_key = None
+
+    def __init__(self, root, allow_exec=True, address=("127.0.0.1", 0)):
+        if paramiko is None:
+            raise ImportError, "The SFTP stand-in needs the paramiko library."
+        self.root = root
+        self.allow_exec = allow_exec
+        if SFTPStandIn._host_key is None:
+            SFTPStandIn._host_key = paramiko.RSAKey.generate(1024)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(address)
+        self._socket.listen(16)
+        self.server_address = self._socket.getsockname()
+        # The number of requests received, per SFTP request type, and "exec" for commands.
+        self.request_counts = {}
+        self._lock = threading.Lock()
+        self._transports = []
+        self._thread = None
+
+    def url(self, path=""):
+        """Return the sftp:// URL of a path, relative to the home directory unless it starts
+           with a slash."""
+        return "sftp://user:password@%s:%s/%s" % (self.server_address + (path, ))
+
+    def count_request(self, request_type):
+        """Count a request."""
+        self._lock.acquire()
+        try:
+            self.request_counts[request_type] = self.request_counts.get(request_type, 0) + 1
+        finally:
+            self._lock.release()
+
+    def _serve(self):
+        """Accept connections until the stand-in is stopped."""
+        while True:
+            try:
+                connection = self._socket.accept()[0]
+            except socket.error:
+                return
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self._host_key)
+            transport.set_subsystem_handler("sftp", SFTPStandInSubsystem,
+                                            SFTPStandInInterface, self)
+            transport.start_server(server=SFTPStandInServer(self))
+            self._transports.append(transport)
+
+    def start(self):
+        """Start serving in a background thread."""
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
@@ -3,17 +3,261 @@
 from omnisync.transportmount import TransportInterface
 from omnisync.fileobject import FileObject
 from omnisync import urlfunctions
+from omnisync.osfunctions import get_data_extents, preallocate, sync_data, sync_filesystem, \
+                                 advise, sync_range, read_into, write_from, \
+                                 POSIX_FADV_SEQUENTIAL, POSIX_FADV_DONTNEED, \
+                                 SYNC_FILE_RANGE_WAIT_BEFORE, SYNC_FILE_RANGE_WRITE, \
+                                 SYNC_FILE_RANGE_WAIT_AFTER
+from omnisync.hashing import DEFAULT_PART_SIZE, get_etag
 
 import platform
 import os
+import stat
 import time
 import errno
+import hashlib
+import shutil
+import shelve
+import threading
+import multiprocessing
+import mmap
+import ctypes
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 if platform.system() == "Windows":
     OSERROR = WindowsError
 else:
     OSERROR = OSError
 
+# The smallest file read or written in bulk by default.
+BULK_MIN_SIZE = 2**26
+# The size of the aligned buffer of direct I/O, and of the ranges that are dropped from the
+# page cache at a time.
+BULK_CHUNK_SIZE = 2**23
+# What the offsets and sizes of direct I/O are multiples of.
+DIRECT_ALIGNMENT = 4096
+
+
+class _BulkFile(object):
+    """A file that is read or written sequentially in bulk without filling the page cache.
+
+       Read data is dropped from the cache once it has been consumed, and written data once it
+       has made it to disk, a chunk at a time, so that writing back one chunk overlaps with
+       writing the next. With _direct_, data bypasses the cache altogether, through an aligned
+       buffer, except for the unaligned ends of files, which are read and written normally.
+    """
+    def __init__(self, filename, mode="rb", direct=False):
+        self.name = filename
+        self._writing = not mode.startswith("r")
+        if self._writing:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        else:
+            flags = os.O_RDONLY
+        self._direct = direct and hasattr(os, "O_DIRECT")
+        self._fd = None
+        if self._direct:
+            try:
+                self._fd = os.open(filename, flags | os.O_DIRECT, 0666)
+            except OSERROR, failure:
+                # Not every filesystem supports direct I/O.
+                if failure.errno != errno.EINVAL:
+                    raise IOError, (failure.errno, failure.strerror, filename)
+                self._direct = False
+        if self._fd is None:
+            try:
+                self._fd = os.open(filename, flags, 0666)
+            except OSERROR, failure:
+                raise IOError, (failure.errno, failure.strerror, filename)
+        if self._direct:
+            # Anonymous maps are page-aligned.
+            self._buffer = mmap.mmap(-1, BULK_CHUNK_SIZE)
+            self._address = ctypes.addressof(ctypes.c_char.from_buffer(self._buffer))
+        else:
+            self._buffer = None
+            if not self._writing:
+                advise(self._fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        # The offset of the file descriptor, the data read into or waiting in the buffer and
+        # how much of the data read has been consumed.
+        self._position = 0
+        self._data = ""
+        self._data_offset = 0
+        self._buffered = 0
+        self._eof = False
+        # Where the range that is being written back starts, and where the data that is
+        # still in the page cache starts.
+        self._write_back_start = 0
+        self._cached_start = 0
+
+    def fileno(self):
+        """Return the file descriptor."""
+        return self._fd
+
+    def tell(self):
+        """Return the current position in the file."""
+        if self._writing:
+            return self._position + self._buffered
+        return self._position - len(self._data) + self._data_offset
+
+    def read(self, size):
+        """Read up to _size_ bytes."""
+        if self._data_offset >= len(self._data):
+            self._fill()
+        data = self._data[self._data_offset:self._data_offset + size]
+        self._data_offset += len(data)
+        return data
+
+    def _fill(self):
+        """Read the next chunk of the file."""
+        position = self._position
+        if self._eof:
+            self._data = ""
+            return
+        try:
+            if self._direct and not position % DIRECT_ALIGNMENT:
+                count = read_into(self._fd, self._address, BULK_CHUNK_SIZE)
+                self._data = self._buffer[:count]
+            else:
+                self._data = os.read(self._fd, BULK_CHUNK_SIZE)
+        except OSERROR, failure:
+            raise IOError, (failure.errno, failure.strerror, self.name)
+        self._data_offset = 0
+        self._position += len(self._data)
+        # Reads of regular files only come up short at the end, where the position might not
+        # be aligned for direct reads any more.
+        self._eof = len(self._data) < BULK_CHUNK_SIZE
+        if not self._direct and self._position - self._cached_start >= BULK_CHUNK_SIZE:
+            # What was read before this chunk has been consumed.
+            advise(self._fd, self._cached_start, position - self._cached_start,
+                   POSIX_FADV_DONTNEED)
+            self._cached_start = position
+
+    def write(self, data):
+        """Write _data_."""
+        if not self._direct:
+            self._write_out(data)
+            return
+        offset = 0
+        while offset < len(data):
+            part = data[offset:offset + BULK_CHUNK_SIZE - self._buffered]
+            self._buffer[self._buffered:self._buffered + len(part)] = part
+            self._buffered += len(part)
+            offset += len(part)
+            if self._buffered == BULK_CHUNK_SIZE:
+                self.flush()
+
+    def flush(self):
+        """Write out the data in the direct I/O buffer."""
+        if not self._buffered:
+            return
+        size = self._buffered
+        self._buffered = 0
+        if self._position % DIRECT_ALIGNMENT or size % DIRECT_ALIGNMENT:
+            # Write the unaligned data through the page cache.
+            fcntl.fcntl(self._fd, fcntl.F_SETFL,
+                        fcntl.fcntl(self._fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+            try:
+                self._write_out(self._buffer[:size])
+            finally:
+                fcntl.fcntl(self._fd, fcntl.F_SETFL,
+                            fcntl.fcntl(self._fd, fcntl.F_GETFL) | os.O_DIRECT)
+            return
+        try:
+            count = write_from(self._fd, self._address, size)
+        except OSERROR, failure:
+            raise IOError, (failure.errno, failure.strerror, self.name)
+        if count != size:
+            raise IOError, (errno.EIO, "Short write", self.name)
+        self._position += size
+
+    def _write_out(self, data):
+        """Write _data_ through the page cache, writing each chunk back to disk and dropping
+           it from the cache as the next one is written."""
+        try:
+            while data:
+                count = os.write(self._fd, data)
+                data = data[count:]
+                self._position += count
+        except OSERROR, failure:
+            raise IOError, (failure.errno, failure.strerror, self.name)
+        if self._position - self._write_back_start >= BULK_CHUNK_SIZE:
+            # Wait for the previous chunk to make it to disk, drop it from the cache and start
+            # writing this one back.
+            if self._write_back_start > self._cached_start:
+                sync_range(self._fd, self._cached_start,
+                           self._write_back_start - self._cached_start,
+                           SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE |
+                           SYNC_FILE_RANGE_WAIT_AFTER)
+                advise(self._fd, self._cached_start,
+                       self._write_back_start - self._cached_start, POSIX_FADV_DONTNEED)
+                self._cached_start = self._write_back_start
+            sync_range(self._fd, self._write_back_start,
+                       self._position - self._write_back_start, SYNC_FILE_RANGE_WRITE)
+            self._write_back_start = self._position
+
+    def seek(self, offset):
+        """Move to _offset_."""
+        self.flush()
+        self._data = ""
+        self._data_offset = 0
+        self._eof = False
+        # Direct reads start at an aligned offset, and skip what's before the one we want.
+        start = offset
+        if self._direct and not self._writing:
+            start -= offset % DIRECT_ALIGNMENT
+        self._position = os.lseek(self._fd, start, os.SEEK_SET)
+        if start != offset:
+            self._fill()
+            self._data_offset = offset - start
+
+    def truncate(self, size):
+        """Cut or extend the file to _size_ bytes."""
+        self.flush()
+        try:
+            os.ftruncate(self._fd, size)
+        except OSERROR, failure:
+            raise IOError, (failure.errno, failure.strerror, self.name)
+
+    def close(self):
+        """Write out what's left, drop the file from the page cache and close it."""
+        try:
+            self.flush()
+            if self._writing and not self._direct:
+                # The data has to be on disk before it can be dropped.
+                sync_range(self._fd, self._cached_start, 0,
+                           SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE |
+                           SYNC_FILE_RANGE_WAIT_AFTER)
+            advise(self._fd, 0, 0, POSIX_FADV_DONTNEED)
+        finally:
+            os.close(self._fd)
+            if self._buffer is not None:
+                self._buffer.close()
+
+
+class _OpenFile(threading.local):
+    """The file a thread has open, so that the transport can be shared by the workers of a
+       multi-threaded copy."""
+    # The file object, whether it is being written, how much space has been allocated for it
+    # and where the data written to it ends.
+    file_handle = None
+    writing = False
+    allocated = 0
+    end = 0
+
+
+def _open_file_property(name):
+    """Return a property for the _name_ attribute of the file the current thread has open."""
+    def get(self):
+        """Return the attribute for the current thread."""
+        return getattr(self._open_file, name)
+
+    def set(self, value):
+        """Set the attribute for the current thread."""
+        setattr(self._open_file, name, value)
+    return property(get, set)
+
 
 class FileTransport(TransportInterface):
     """Plain file access class."""
@@ -28,7 +272,8 @@ class FileTransport(TransportInterface):
     # supports.
     listdir_attributes = set()
     # Conversely, for getattr().
-    getattr_attributes = set(("size", "mtime", "atime", "perms", "owner", "group"))
+    getattr_attributes = set(("size", "mtime", "atime", "perms", "owner", "group", "checksum",
+                              "etag", "inode", "links"))
     # List the attributes setattr() can set.
     if platform.system() == "Windows":
         setattr_attributes = set(("mtime", "atime", "perms"))
@@ -36,12 +281,44 @@ class FileTransport(TransportInterface):
         setattr_attributes = set(("mtime", "atime", "perms", "owner", "group"))
     # Define attributes that can be used to decide whether a file has been changed
     # or not.
-    evaluation_attributes = set(("size", "mtime"))
+    evaluation_attributes = set(("size", "mtime", "checksum", "etag"))
     # The preferred buffer size for reads/writes.
     buffer_size = 2**15
+    # Where to cache the S3 ETags of files, so they only need to be computed when files change.
+    etag_cache = os.path.join("~", ".omnisync", "etags")
+    # When written files are synced to disk: "none" leaves it to the system, "file" syncs each
+    # file as it's closed and "group" syncs the filesystems written to every fsync_group files
+    # and at the end.
+    fsync = "none"
+    fsync_group = 1000
+    # The smallest file read or written in bulk with --bulk-io.
+    bulk_min_size = BULK_MIN_SIZE
+    # Every thread has a file of its own open.
+    thread_safe = True
+    _file_handle = _open_file_property("file_handle")
+    _writing = _open_file_property("writing")
+    _allocated = _open_file_property("allocated")
+    _end = _open_file_property("end")
 
     def __init__(self):
-        self._file_handle = None
+        self._open_file = _OpenFile()
+        self._checksum_algorithm = "sha256"
+        # The part size S3 uploads use, which the ETags of large files depend on.
+        self._part_size = DEFAULT_PART_SIZE * 2**20
+        # The ETag cache, in {filename: (size, mtime, ctime, part_size, etag)} format, opened
+        # when it's first needed.
+        self._etag_cache = None
+        self._etag_lock = threading.Lock()
+        # Whether to allocate the space of written files in advance.
+        self.preallocate = False
+        # Whether to read and write large files in bulk, and with direct I/O.
+        self.bulk_io = False
+        self.direct_io = False
+        # The number of files written since the filesystems were last synced, and a dictionary
+        # of {device: directory} items with a directory on each filesystem they were written to.
+        self._unsynced = 0
+        self._unsynced_directories = {}
+        self._unsynced_lock = threading.Lock()
 
     def _get_filename(self, url):
         """Retrieve the local filename from a given URL."""
@@ -54,24 +331,81 @@ class FileTransport(TransportInterface):
 
            Returns a tuple of ((args), {kwargs}) items for optparse's add_option().
         """
-        return ()
+        return ((("--etag-cache", ), {"dest": "etag_cache_",
+                                      "help": "the file to cache the S3 ETags of files in",
+                                      "metavar": "FILE"}),
+                (("--preallocate", ), {"dest": "preallocate_",
+                                       "action": "store_true",
+                                       "help": "allocate the disk space of files in advance "
+                                               "when their size is known, so they aren't "
+                                               "fragmented, filling in the holes --sparse "
+                                               "leaves"}),
+                (("--fsync", ), {"dest": "fsync_",
+                                 "type": "choice",
+                                 "choices": ("none", "file", "group"),
+                                 "help": "when to sync written files to disk: none leaves it "
+                                         "to the system, file syncs each one and group syncs "
+                                         "the filesystem every --fsync-group files and at the "
+                                         "end (default none)",
+                                 "metavar": "MODE"}),
+                (("--bulk-io", ), {"dest": "bulk_io_",
+                                   "action": "store_true",
+                                   "help": "read and write files of 64 MiB or more without "
+                                           "filling the page cache, by dropping their data "
+                                           "from it as they are copied"}),
+                (("--direct-io", ), {"dest": "direct_io_",
+                                     "action": "store_true",
+                                     "help": "read and write files of 64 MiB or more with "
+                                             "direct I/O, bypassing the page cache, where the "
+                                             "filesystem supports it"}),
+                (("--fsync-group", ), {"dest": "fsync_group_",
+                                       "type": "int",
+                                       "help": "the number of files to write between syncs "
+                                               "with --fsync=group (default 1000)",
+                                       "metavar": "N"}),
+                )
 
     def connect(self, url, config):
-        """This method does nothing, since we don't need to connect to the
-           filesystem."""
+        """We don't need to connect to the filesystem, so just note how to compute
+           checksums."""
+        options = config.full_options
+        self._checksum_algorithm = config.checksum_algorithm
+        self._part_size = (getattr(options, "part_size_s3", None) or DEFAULT_PART_SIZE) * \
+                          2**20
+        self.etag_cache = getattr(options, "etag_cache_file", None) or self.etag_cache
+        self.preallocate = getattr(options, "preallocate_file", None) or self.preallocate
+        self.fsync = getattr(options, "fsync_file", None) or self.fsync
+        self.fsync_group = getattr(options, "fsync_group_file", None) or self.fsync_group
+        self.direct_io = getattr(options, "direct_io_file", None) or self.direct_io
+        self.bulk_io = getattr(options, "bulk_io_file", None) or self.direct_io or self.bulk_io
 
     def disconnect(self):
-        """This method does nothing, since we don't need to disconnect from the
-           filesystem."""
+        """Sync what's left to sync and close the ETag cache, since we don't need to
+           disconnect from the filesystem."""
+        if self._unsynced:
+            self._sync_filesystems()
+        if self._etag_cache is not None:
+            self._etag_cache.close()
+            self._etag_cache = None
 
-    def open(self, url, mode="rb"):
-        """Open a file in _mode_ to prepare for I/O.
+    def open(self, url, mode="rb", size=None):
+        """Open a file in _mode_ to prepare for I/O. _size_ is the expected size of the file,
+           if known.
 
            Raises IOError if anything goes wrong.
         """
         if self._file_handle:
-            raise IOError, "Another file is already open."
-        self._file_handle = open(self._get_filename(url), mode)
+            raise IOError, "Another file is already open in this thread."
+        if self.bulk_io and size and size >= self.bulk_min_size:
+            self._file_handle = _BulkFile(self._get_filename(url), mode, self.direct_io)
+        else:
+            self._file_handle = open(self._get_filename(url), mode)
+        self._writing = not mode.startswith("r")
+        self._allocated = 0
+        self._end = 0
+        if self._writing and self.preallocate and size and \
+           preallocate(self._file_handle.fileno(), size):
+            self._allocated = size
 
     def read(self, size):
         """Read _size_ bytes from the open file."""
@@ -80,6 +414,21 @@ class FileTransport(TransportInterface):
     def write(self, data):
         """Write _data_ to the open file."""
         self._file_handle.write(data)
+        self._end = max(self._end, self._file_handle.tell())
+
+    def seek(self, offset):
+        """Move to _offset_ in the open file. Writing past the end of a file leaves a hole."""
+        self._file_handle.seek(offset)
+
+    def truncate(self, size):
+        """Cut or extend the open file to _size_ bytes."""
+        self._file_handle.truncate(size)
+        self._end = size
+
+    def get_extents(self):
+        """Return the (offset, length) extents of the open file that hold data."""
+        return get_data_extents(self._file_handle.fileno(),
+                                os.fstat(self._file_handle.fileno()).st_size)
 
     def remove(self, url):
         """Remove the specified file."""
@@ -90,6 +439,45 @@ class FileTransport(TransportInterface):
         else:
             return True
 
+    def rename(self, source_url, destination_url):
+        """Move a file to another path on the same filesystem.
+
+           Returns True if the file was moved, False otherwise.
+        """
+        try:
+            os.rename(self._get_filename(source_url), self._get_filename(destination_url))
+        except OSERROR:
+            return False
+        else:
+            return True
+
+    def link(self, source_url, destination_url):
+        """Make a hard link to a file, replacing any file at _destination_url_.
+
+           Returns True if the link was made, False otherwise.
+        """
+        filename = self._get_filename(destination_url)
+        try:
+            if os.path.lexists(filename):
+                os.remove(filename)
+            os.link(self._get_filename(source_url), filename)
+        except OSERROR:
+            return False
+        else:
+            return True
+
+    def copy(self, source_url, destination_url):
+        """Copy a file to another path, replacing any file there.
+
+           Returns True if the file was copied, False otherwise.
+        """
+        try:
+            shutil.copyfile(self._get_filename(source_url), self._get_filename(destination_url))
+        except (IOError, OSERROR):
+            return False
+        else:
+            return True
+
     def rmdir(self, url):
         """Remove the specified directory non-recursively."""
         try:
@@ -99,12 +487,122 @@ class FileTransport(TransportInterface):
         else:
             return True
 
+    def remove_tree(self, url):
+        """Remove a directory and everything under it, unlinking the files from as many
+           threads as there are processors, since the system calls don't hold the
+           interpreter lock.
+
+           Returns True if everything was removed, False otherwise.
+        """
+        file_names = []
+        directory_names = []
+        # Walking bottom-up lists every directory after the ones under it.
+        for path, directories, files in os.walk(self._get_filename(url), topdown=False):
+            for directory in directories:
+                # Symlinks to directories are listed as directories, but are removed as files.
+                if os.path.islink(os.path.join(path, directory)):
+                    file_names.append(os.path.join(path, directory))
+                else:
+                    directory_names.append(os.path.join(path, directory))
+            file_names.extend(os.path.join(path, x) for x in files)
+        directory_names.append(self._get_filename(url))
+        try:
+            thread_count = multiprocessing.cpu_count()
+        except NotImplementedError:
+            thread_count = 1
+        errors = []
+        workers = []
+        for counter in range(min(thread_count, len(file_names))):
+            worker = threading.Thread(target=self._remove_files,
+                                      args=(file_names[counter::thread_count], errors))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        if errors:
+            return False
+        for directory in directory_names:
+            try:
+                os.rmdir(directory)
+            except OSERROR:
+                return False
+        return True
+
+    def _remove_files(self, file_names, errors):
+        """Remove the given files, noting any that couldn't be removed in _errors_."""
+        for file_name in file_names:
+            try:
+                os.remove(file_name)
+            except OSERROR:
+                errors.append(file_name)
+
     def close(self):
-        """Close the open file."""
-        if self._file_handle:
+        """Close the open file, syncing it to disk if asked to.
+
+           Raises IOError if the file couldn't be synced.
+        """
+        if not self._file_handle:
+            return
+        try:
+            if self._writing:
+                self._finish_writing()
+        finally:
             self._file_handle.close()
             self._file_handle = None
 
+    def abort(self):
+        """Close the open file and, if it was being written, remove it, so that no partial
+           file is left behind."""
+        if not self._file_handle:
+            return
+        filename = self._file_handle.name
+        try:
+            self._file_handle.close()
+        except IOError:
+            pass
+        self._file_handle = None
+        if self._writing:
+            try:
+                os.remove(filename)
+            except OSERROR:
+                pass
+
+    def _finish_writing(self):
+        """Give back the space allocated past the end of the written data, and sync the file
+           or, every so often, the filesystem."""
+        if self._allocated > self._end:
+            # The copy must have been cut short.
+            self._file_handle.truncate(self._end)
+        self._file_handle.flush()
+        try:
+            if self.fsync == "file":
+                sync_data(self._file_handle.fileno())
+            elif self.fsync == "group":
+                self._unsynced_lock.acquire()
+                try:
+                    self._unsynced += 1
+                    device = os.fstat(self._file_handle.fileno()).st_dev
+                    self._unsynced_directories[device] = os.path.dirname(os.path.abspath(
+                        self._file_handle.name))
+                    if self._unsynced >= self.fsync_group:
+                        self._sync_filesystems()
+                finally:
+                    self._unsynced_lock.release()
+        except OSERROR, failure:
+            raise IOError, (failure.errno, "Could not sync %s: %s" %
+                            (self._file_handle.name, failure.strerror))
+
+    def _sync_filesystems(self):
+        """Sync every filesystem files have been written to since they were last synced."""
+        for directory in self._unsynced_directories.values():
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                sync_filesystem(fd)
+            finally:
+                os.close(fd)
+        self._unsynced = 0
+        self._unsynced_directories = {}
+
     def mkdir(self, url):
         """Recursively make the given directories at the current URL."""
         # Recursion is not needed for anything but the first directory, so we need to be able to
@@ -156,13 +654,82 @@ class FileTransport(TransportInterface):
         except OSERROR:
             return dict([(x, None) for x in self.getattr_attributes])
         # Turn times to ints because checks fail sometimes due to rounding errors.
-        return {"size": statinfo.st_size,
-                "mtime": int(statinfo.st_mtime),
-                "atime": int(statinfo.st_atime),
-                "perms": statinfo.st_mode,
-                "owner": statinfo.st_uid,
-                "group": statinfo.st_gid,
-                }
+        attribute_dict = {"size": statinfo.st_size,
+                          "mtime": int(statinfo.st_mtime),
+                          "atime": int(statinfo.st_atime),
+                          "perms": statinfo.st_mode,
+                          "owner": statinfo.st_uid,
+                          "group": statinfo.st_gid,
+                          # The files with the same inode on the same device are hard links.
+                          "inode": "%s:%s" % (statinfo.st_dev, statinfo.st_ino),
+                          "links": statinfo.st_nlink,
+                          }
+        # Only read the file if we really have to.
+        if "checksum" in attributes and stat.S_ISREG(statinfo.st_mode):
+            attribute_dict["checksum"] = self._get_checksum(self._get_filename(url))
+        if "etag" in attributes and stat.S_ISREG(statinfo.st_mode):
+            attribute_dict["etag"] = self._get_etag(self._get_filename(url), statinfo)
+        return attribute_dict
+
+    def _open_etag_cache(self):
+        """Open the ETag cache, or return None if it can't be opened."""
+        if self._etag_cache is None:
+            filename = os.path.expanduser(self.etag_cache)
+            try:
+                if not os.path.isdir(os.path.dirname(filename)):
+                    os.makedirs(os.path.dirname(filename))
+                self._etag_cache = shelve.open(filename)
+            except Exception, failure:
+                print "FILE: Could not open the ETag cache %s: %s" % (filename, failure)
+                self._etag_cache = False
+        return self._etag_cache or None
+
+    def _get_etag(self, filename, statinfo):
+        """Return the ETag S3 would give a file, from the cache if the file hasn't changed
+           since it was computed, or None if it can't be read."""
+        filename = os.path.abspath(filename)
+        # Any change to the file changes its ctime, so this catches same-second writes too.
+        signature = (statinfo.st_size, statinfo.st_mtime, statinfo.st_ctime, self._part_size)
+        # Shelves can't be used by several threads at once.
+        self._etag_lock.acquire()
+        try:
+            cache = self._open_etag_cache()
+            cached = cache is not None and cache.get(filename)
+        finally:
+            self._etag_lock.release()
+        if cached and cached[:-1] == signature:
+            return cached[-1]
+        try:
+            checked_file = open(filename, "rb")
+        except IOError:
+            return None
+        try:
+            etag = get_etag(checked_file, statinfo.st_size, self._part_size, self.buffer_size)
+        finally:
+            checked_file.close()
+        if cache is not None:
+            self._etag_lock.acquire()
+            try:
+                cache[filename] = signature + (etag, )
+            finally:
+                self._etag_lock.release()
+        return etag
+
+    def _get_checksum(self, filename):
+        """Return the hex digest of a file's contents, or None if it can't be read."""
+        digest = hashlib.new(self._checksum_algorithm)
+        try:
+            checked_file = open(filename, "rb")
+        except IOError:
+            return None
+        try:
+            data = checked_file.read(self.buffer_size)
+            while data:
+                digest.update(data)
+                data = checked_file.read(self.buffer_size)
+        finally:
+            checked_file.close()
+        return digest.hexdigest()
 
     def setattr(self, url, attributes):
         """Set a file's attributes if possible."""
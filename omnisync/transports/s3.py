@@ -3,8 +3,496 @@
 from omnisync.transportmount import TransportInterface
 from omnisync.fileobject import FileObject
 from omnisync import urlfunctions
+from omnisync.hashing import MAX_PARTS, DEFAULT_PART_SIZE, get_part_size
 
 import getpass
+import threading
+import calendar
+import time
+import math
+import random
+import httplib
+import Queue
+import cStringIO
+from xml.sax.saxutils import escape
+
+# The most keys a multi-object delete request can delete.
+DELETE_BATCH_SIZE = 1000
+# The smallest latency the histograms tell apart, in seconds...
+MIN_LATENCY = 0.001
+# ...and the number of histogram buckets per doubling of the latency after that.
+BUCKETS_PER_DOUBLING = 4
+# The number of latencies an operation needs before they're used to decide when to hedge.
+MIN_HEDGE_SAMPLES = 20
+# The base and cap of the exponential backoff between retries, in seconds.
+BACKOFF_BASE = 0.1
+MAX_BACKOFF = 10
+# The operations that can safely be made more than once, so they are hedged and retried. The
+# others, such as starting and finishing multipart uploads, change what is on the server in a
+# way that a duplicate would undo or leave behind, so they are made once.
+IDEMPOTENT_OPERATIONS = ("LIST", "HEAD", "GET", "GET-range", "PUT", "PUT-part", "COPY",
+                         "DELETE", "DELETE-upload")
+# The attributes of keys that don't exist. Directories are such keys, so these leave out the
+# modification time, which would otherwise be set on the destination.
+MISSING_ATTRIBUTES = {"size": None, "etag": None}
+
+
+def get_key_attributes(key):
+    """Return the attributes of a boto key, from a listing or a HEAD request."""
+    attributes = {"size": key.size}
+    if key.last_modified:
+        attributes["mtime"] = calendar.timegm(
+            parse_ts(key.last_modified).timetuple())
+    if key.etag:
+        attributes["etag"] = key.etag.strip("\"")
+    return attributes
+
+
+class S3Upload(object):
+    """Upload an object to S3 as it is written, with a single PUT if it fits in one part and
+       with a multipart upload whose parts are sent in parallel otherwise.
+
+       At most _threads_ parts are queued while _threads_ others are being sent, so memory use
+       is bounded by about twice as many parts as there are threads.
+    """
+    def __init__(self, transport, name, part_size, threads, size=None):
+        self._transport = transport
+        self.name = name
+        # The number of bytes written so far.
+        self.size = 0
+        self._part_size = get_part_size(size, part_size)
+        # If we don't know the size, grow the parts as we go so we never run out of them.
+        self._grow_parts = size is None
+        self._threads = max(threads, 1)
+        self._buffer = []
+        self._buffered = 0
+        self._upload_id = None
+        self._part_queue = None
+        self._part_number = 0
+        self._workers = []
+        # A dictionary of {part_number: etag} items for the parts that have been sent.
+        self._etags = {}
+        self._errors = []
+        # The ETag of the finished object.
+        self.etag = None
+
+    def write(self, data):
+        """Buffer _data_ and send any full parts."""
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.size += len(data)
+        while self._buffered >= self._part_size:
+            self._send_part(self._take(self._part_size))
+
+    def _take(self, size):
+        """Remove _size_ bytes from the start of the buffer and return them."""
+        data = "".join(self._buffer)
+        self._buffer = [data[size:]]
+        self._buffered = len(data) - size
+        return data[:size]
+
+    def _send_part(self, data):
+        """Queue a part to be sent by the worker threads, starting the upload if needed."""
+        if self._errors:
+            raise IOError, "Could not upload part of %s: %s" % (self.name, self._errors[0])
+        if self._upload_id is None:
+            # Neither starting nor finishing the upload is idempotent, so the runner makes
+            # these requests once, without a deadline, rather than leave an upload behind.
+            try:
+                self._upload_id = self._transport._request("POST-initiate", lambda bucket:
+                    bucket.initiate_multipart_upload(self.name).id)
+            except Exception, failure:
+                raise IOError, "Could not start uploading %s: %s" % (self.name, failure)
+            self._part_queue = Queue.Queue(self._threads)
+            for counter in range(self._threads):
+                worker = threading.Thread(target=self._send_parts)
+                worker.setDaemon(True)
+                worker.start()
+                self._workers.append(worker)
+        self._part_number += 1
+        # This blocks while the queue is full, which keeps the memory we use bounded.
+        self._part_queue.put((self._part_number, data))
+        if self._grow_parts and not self._part_number % (MAX_PARTS // 10):
+            self._part_size *= 2
+
+    def _put(self, bucket, data):
+        """Store the whole object with a single request."""
+        key = Key(bucket, self.name)
+        key.set_contents_from_string(data)
+        return key
+
+    def _put_part(self, bucket, part_number, data):
+        """Send a part of a multipart upload."""
+        upload = MultiPartUpload(bucket)
+        upload.key_name = self.name
+        upload.id = self._upload_id
+        return upload.upload_part_from_file(cStringIO.StringIO(data), part_number)
+
+    def _send_parts(self):
+        """Send queued parts until told to stop."""
+        while True:
+            item = self._part_queue.get()
+            if item is None:
+                break
+            part_number, data = item
+            if self._errors:
+                continue
+            try:
+                key = self._transport._request("PUT-part",
+                    lambda bucket, part_number=part_number, data=data:
+                    self._put_part(bucket, part_number, data))
+            except Exception, failure:
+                self._errors.append(failure)
+            else:
+                self._etags[part_number] = key.etag
+
+    def close(self):
+        """Send the rest of the object and finish the upload.
+
+           Raises IOError if anything went wrong.
+        """
+        data = self._take(self._buffered)
+        if self._upload_id is None:
+            # The whole object fits in a single part, so just PUT it.
+            try:
+                key = self._transport._request("PUT", lambda bucket: self._put(bucket, data))
+            except Exception, failure:
+                raise IOError, "Could not upload %s: %s" % (self.name, failure)
+            self.etag = key.etag.strip("\"")
+            return
+        if data:
+            self._send_part(data)
+        for worker in self._workers:
+            self._part_queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self._errors or len(self._etags) != self._part_number:
+            self._cancel()
+            raise IOError, "Could not upload %s: %s" % (self.name, self._errors[:1])
+        parts = "".join("<Part><PartNumber>%s</PartNumber><ETag>%s</ETag></Part>" %
+                        (number, escape(etag)) for number, etag in sorted(self._etags.items()))
+        try:
+            result = self._transport._request("POST-complete", lambda bucket:
+                bucket.complete_multipart_upload(self.name, self._upload_id,
+                    "<CompleteMultipartUpload>%s</CompleteMultipartUpload>" % parts))
+        except Exception, failure:
+            self._cancel()
+            raise IOError, "Could not finish uploading %s: %s" % (self.name, failure)
+        self.etag = result.etag.strip("\"")
+
+    def abort(self):
+        """Give up on the upload, so no object is stored and the server doesn't keep the
+           parts that were sent."""
+        self._errors.append(IOError("The upload was aborted."))
+        for worker in self._workers:
+            self._part_queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self._upload_id is not None:
+            self._cancel()
+
+    def _cancel(self):
+        """Cancel the multipart upload, so the server doesn't keep its parts."""
+        try:
+            self._transport._request("DELETE-upload", lambda bucket:
+                bucket.cancel_multipart_upload(self.name, self._upload_id))
+        except Exception, failure:
+            print "S3: Could not cancel the upload of %s: %s" % (self.name, failure)
+
+
+class S3Download(object):
+    """Download an object as several concurrent byte-range GETs, handing the data over in
+       order.
+
+       The worker threads never fetch more than twice as many ranges ahead of the reader as
+       there are threads, so memory use is bounded.
+    """
+    def __init__(self, transport, name, size, range_size, threads):
+        self._transport = transport
+        self._name = name
+        self._ranges = [(start, min(start + range_size, size) - 1)
+                        for start in range(0, size, range_size)]
+        self._window = max(threads, 1) * 2
+        # A dictionary of {range_index: data} items, with exceptions for failed ranges.
+        self._results = {}
+        self._condition = threading.Condition()
+        # The next range to give to the reader and the next one to fetch.
+        self._read_index = 0
+        self._fetch_index = 0
+        self._closed = False
+        self._data = ""
+        self._offset = 0
+        for counter in range(min(max(threads, 1), len(self._ranges))):
+            worker = threading.Thread(target=self._fetch_ranges)
+            worker.setDaemon(True)
+            worker.start()
+
+    def _fetch_ranges(self):
+        """Fetch ranges until there are none left or the download is closed."""
+        while True:
+            self._condition.acquire()
+            try:
+                while not self._closed and self._fetch_index < len(self._ranges) and \
+                      self._fetch_index >= self._read_index + self._window:
+                    self._condition.wait()
+                if self._closed or self._fetch_index >= len(self._ranges):
+                    return
+                index = self._fetch_index
+                self._fetch_index += 1
+            finally:
+                self._condition.release()
+            headers = {"Range": "bytes=%s-%s" % self._ranges[index]}
+            try:
+                data = self._transport._request("GET-range", lambda bucket, headers=headers:
+                    Key(bucket, self._name).get_contents_as_string(headers=headers))
+            except Exception, failure:
+                data = failure
+            self._condition.acquire()
+            try:
+                self._results[index] = data
+                self._condition.notifyAll()
+            finally:
+                self._condition.release()
+
+    def read(self, size):
+        """Read _size_ bytes, waiting for the next range if necessary.
+
+           Raises IOError if the range could not be fetched.
+        """
+        if self._offset >= len(self._data):
+            if self._read_index >= len(self._ranges):
+                return ""
+            self._condition.acquire()
+            try:
+                while self._read_index not in self._results:
+                    self._condition.wait()
+                data = self._results.pop(self._read_index)
+                self._read_index += 1
+                self._condition.notifyAll()
+            finally:
+                self._condition.release()
+            if isinstance(data, Exception):
+                raise IOError, "Could not download %s: %s" % (self._name, data)
+            self._data = data
+            self._offset = 0
+        data = self._data[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        """Stop fetching ranges."""
+        self._condition.acquire()
+        try:
+            self._closed = True
+            self._results = {}
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+
+class S3RequestTimeout(IOError):
+    """Raised when a request doesn't finish before its deadline."""
+
+
+def is_retryable(failure):
+    """Return True if a failed request is worth retrying: server errors, throttling,
+       timeouts and connection problems are, but other client errors won't go away."""
+    status = getattr(failure, "status", None)
+    if isinstance(status, int):
+        return status >= 500 or status in (408, 429)
+    return isinstance(failure, (IOError, httplib.HTTPException))
+
+
+class LatencyHistogram(object):
+    """A histogram of request latencies, in logarithmically sized buckets, so that the
+       percentiles are accurate to within a few percent whatever the scale."""
+    def __init__(self):
+        self.count = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        """Add a latency, in seconds."""
+        if latency > MIN_LATENCY:
+            bucket = int(math.log(latency / MIN_LATENCY, 2) * BUCKETS_PER_DOUBLING) + 1
+        else:
+            bucket = 0
+        self._lock.acquire()
+        try:
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+            self.count += 1
+        finally:
+            self._lock.release()
+
+    def percentile(self, percentile):
+        """Return the latency _percentile_ percent of the requests finished within, as the
+           upper bound of its bucket, or None if nothing has been recorded."""
+        self._lock.acquire()
+        try:
+            buckets = sorted(self._buckets.items())
+            count = self.count
+        finally:
+            self._lock.release()
+        if not buckets:
+            return None
+        remaining = count * percentile / 100.0
+        for bucket, bucket_count in buckets:
+            remaining -= bucket_count
+            if remaining <= 0:
+                break
+        return MIN_LATENCY * 2 ** (float(bucket) / BUCKETS_PER_DOUBLING)
+
+
+class S3RequestRunner(object):
+    """Run S3 requests with a deadline, a hedged duplicate if they take longer than most
+       requests of the same kind, and retries with jittered exponential backoff.
+
+       Only the IDEMPOTENT_OPERATIONS get the deadline, hedging and retries. Other requests
+       are made once and waited for, because giving up on one would leave whatever it does
+       on the server untracked.
+
+       Requests are made from a pool of threads with S3 connections of their own, so a
+       request that is stuck or has been given up on doesn't hold up the caller. The pool
+       grows when all its threads are busy.
+    """
+    def __init__(self, transport, retries, deadline, hedge_percentile):
+        self._transport = transport
+        self.retries = retries
+        self.deadline = deadline
+        self.hedge_percentile = hedge_percentile
+        # A dictionary of {operation: LatencyHistogram} items.
+        self.histograms = {}
+        # A dictionary of {operation: {"retries": count, "hedges": count, "timeouts": count}}
+        # items.
+        self.counters = {}
+        self._tasks = Queue.Queue()
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def _get_histogram(self, operation):
+        """Return the latency histogram of an operation."""
+        self._lock.acquire()
+        try:
+            if operation not in self.histograms:
+                self.histograms[operation] = LatencyHistogram()
+                self.counters[operation] = {"retries": 0, "hedges": 0, "timeouts": 0}
+            return self.histograms[operation]
+        finally:
+            self._lock.release()
+
+    def _count(self, operation, counter):
+        """Increment one of an operation's counters."""
+        self._lock.acquire()
+        try:
+            self.counters[operation][counter] += 1
+        finally:
+            self._lock.release()
+
+    def _start(self, function, results):
+        """Have a pool thread call _function_ and put its outcome in the _results_ queue."""
+        self._lock.acquire()
+        try:
+            new_worker = not self._idle
+            if not new_worker:
+                self._idle -= 1
+        finally:
+            self._lock.release()
+        if new_worker:
+            worker = threading.Thread(target=self._work)
+            worker.setDaemon(True)
+            worker.start()
+        self._tasks.put((function, results))
+
+    def _work(self):
+        """Make requests until the program exits."""
+        while True:
+            function, results = self._tasks.get()
+            start = time.time()
+            try:
+                value = function(self._transport._get_bucket())
+            except Exception, failure:
+                results.put((False, failure, time.time() - start))
+            else:
+                results.put((True, value, time.time() - start))
+            self._lock.acquire()
+            try:
+                self._idle += 1
+            finally:
+                self._lock.release()
+
+    def _attempt(self, operation, function):
+        """Make a request, hedging it if it is slow, and return its result.
+
+           Raises the request's exception if it fails and S3RequestTimeout if it doesn't
+           finish before the deadline.
+        """
+        histogram = self._get_histogram(operation)
+        idempotent = operation in IDEMPOTENT_OPERATIONS
+        hedge_at = None
+        if idempotent and self.hedge_percentile and histogram.count >= MIN_HEDGE_SAMPLES:
+            hedge_at = histogram.percentile(self.hedge_percentile)
+        results = Queue.Queue()
+        start = time.time()
+        self._start(function, results)
+        pending = 1
+        failure = None
+        while pending:
+            elapsed = time.time() - start
+            if hedge_at is not None and elapsed >= hedge_at:
+                # The request is slower than most, so race a duplicate against it.
+                self._count(operation, "hedges")
+                self._start(function, results)
+                pending += 1
+                hedge_at = None
+                continue
+            if not idempotent:
+                timeout = None
+            else:
+                timeout = self.deadline - elapsed
+            if hedge_at is not None:
+                timeout = min(timeout, hedge_at - elapsed)
+            if timeout is not None and timeout <= 0:
+                self._count(operation, "timeouts")
+                raise S3RequestTimeout, "%s request took more than %s seconds." % \
+                                        (operation, self.deadline)
+            try:
+                success, value, latency = results.get(timeout=timeout)
+            except Queue.Empty:
+                continue
+            pending -= 1
+            if success:
+                histogram.record(latency)
+                return value
+            failure = value
+        raise failure
+
+    def call(self, operation, function):
+        """Call _function_ with the S3 bucket to use and return its result, retrying it if
+           it fails in a way that might not happen again.
+
+           operation - The kind of request _function_ makes, which latencies are kept
+                       track of by. Requests not in IDEMPOTENT_OPERATIONS aren't retried.
+        """
+        retries = self.retries if operation in IDEMPOTENT_OPERATIONS else 0
+        for attempt in range(retries + 1):
+            if attempt:
+                self._count(operation, "retries")
+                time.sleep(random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * 2 ** attempt)))
+            try:
+                return self._attempt(operation, function)
+            except Exception, failure:
+                if not is_retryable(failure) or attempt == retries:
+                    raise
+
+    def get_stats(self):
+        """Return the request statistics, in {operation: {statistic: value}} format."""
+        stats = {}
+        for operation, histogram in self.histograms.items():
+            stats[operation] = dict(self.counters[operation], count=histogram.count,
+                                    p50=histogram.percentile(50),
+                                    p95=histogram.percentile(95),
+                                    p99=histogram.percentile(99))
+        return stats
 
 
 class S3Transport(TransportInterface):
@@ -18,20 +506,72 @@ class S3Transport(TransportInterface):
     uses_hostname = True
     # listdir_attributes is a set that contains the file attributes that listdir()
     # supports.
-    listdir_attributes = set(("size", ))
+    listdir_attributes = set(("size", "mtime", "etag"))
     # Conversely, for getattr().
-    getattr_attributes = set()
+    getattr_attributes = set(("size", "mtime", "etag"))
     # List the attributes setattr() can set.
     setattr_attributes = set()
     # Define attributes that can be used to decide whether a file has been changed
     # or not.
-    evaluation_attributes = set(("size", ))
+    # The modification time is when the object was uploaded, so it can't be compared with the
+    # source's.
+    evaluation_attributes = set(("size", "etag"))
     # The preferred buffer size for reads/writes.
     buffer_size = 2**15
+    # The default size of the parts of multipart uploads, in megabytes.
+    part_size = DEFAULT_PART_SIZE
+    # The default number of parts to upload in parallel.
+    upload_threads = 4
+    # The default size of the ranges to download large objects in, in megabytes.
+    range_size = 8
+    # The default number of ranges to download in parallel.
+    download_threads = 4
+    # Whether to list the whole tree under the root with one flat listing.
+    flat_listing = False
+    # The default number of times to retry failed requests.
+    retries = 4
+    # The default number of seconds to give up on a request after.
+    deadline = 120
+    # The default percentile of an operation's latencies after which a duplicate request is
+    # sent, or 0 to never send one.
+    hedge_percentile = 95
+    # Every thread has a connection and a file of its own.
+    thread_safe = True
 
     def __init__(self):
         self._bucket = None
         self._connection = None
+        self._bucket_name = None
+        # The arguments to create more S3 connections with, in (args, kwargs) format.
+        self._connection_arguments = None
+        # Worker threads get S3 connections and open files of their own.
+        self._local = threading.local()
+        self._main_thread = None
+        # The key prefix of the URL we connected to, without a trailing slash.
+        self._root = None
+        # The tree index built by the flat listing, in {directory: {name: attributes}} format,
+        # with None as the attributes of directories.
+        self._index = None
+        self._runner = None
+        self._print_stats = False
+
+    def _get_file_handle(self):
+        """Return the file the current thread has open for reading."""
+        return getattr(self._local, "file_handle", None)
+
+    def _set_file_handle(self, file_handle):
+        """Set the file the current thread has open for reading."""
+        self._local.file_handle = file_handle
+    _file_handle = property(_get_file_handle, _set_file_handle)
+
+    def _get_upload(self):
+        """Return the upload of the file the current thread has open for writing."""
+        return getattr(self._local, "upload", None)
+
+    def _set_upload(self, upload):
+        """Set the upload of the file the current thread has open for writing."""
+        self._local.upload = upload
+    _upload = property(_get_upload, _set_upload)
 
     def _get_filename(self, url):
         """Retrieve the local filename from a given URL."""
@@ -45,26 +585,129 @@ class S3Transport(TransportInterface):
 
            Returns a tuple of ((args), {kwargs}) items for optparse's add_option().
         """
-        return ()
+        return ((("--s3-endpoint", ), {"dest": "endpoint_",
+                                       "help": "the URL of an S3-compatible server to use "
+                                               "instead of Amazon S3",
+                                       "metavar": "URL"}),
+                (("--s3-part-size", ), {"dest": "part_size_",
+                                        "type": "int",
+                                        "help": "the minimum size of multipart upload parts, "
+                                                "in megabytes",
+                                        "metavar": "SIZE"}),
+                (("--s3-upload-threads", ), {"dest": "upload_threads_",
+                                             "type": "int",
+                                             "help": "the number of upload parts to send "
+                                                     "in parallel",
+                                             "metavar": "NUMBER"}),
+                (("--s3-range-size", ), {"dest": "range_size_",
+                                         "type": "int",
+                                         "help": "the size of the ranges to download large "
+                                                 "objects in, in megabytes",
+                                         "metavar": "SIZE"}),
+                (("--s3-download-threads", ), {"dest": "download_threads_",
+                                               "type": "int",
+                                               "help": "the number of ranges to download "
+                                                       "in parallel",
+                                               "metavar": "NUMBER"}),
+                (("--s3-flat-listing", ), {"dest": "flat_listing_",
+                                           "action": "store_true",
+                                           "help": "list the whole tree with one paged "
+                                                   "listing instead of one per directory"}),
+                (("--s3-retries", ), {"dest": "retries_",
+                                      "type": "int",
+                                      "help": "the number of times to retry failed requests",
+                                      "metavar": "NUMBER"}),
+                (("--s3-deadline", ), {"dest": "deadline_",
+                                       "type": "float",
+                                       "help": "the number of seconds to give up on a "
+                                               "request and retry it after",
+                                       "metavar": "SECONDS"}),
+                (("--s3-hedge-percentile", ), {"dest": "hedge_percentile_",
+                                               "type": "float",
+                                               "help": "send a duplicate of requests that take "
+                                                       "longer than this percentile of their "
+                                                       "kind, or 0 to never do so",
+                                               "metavar": "PERCENTILE"}),
+                (("--s3-stats", ), {"dest": "stats_",
+                                    "action": "store_true",
+                                    "help": "print request latency statistics when done"}),
+                )
+
+    def _get_bucket(self):
+        """Return the bucket object the current thread should use. Threads other than the
+           one that connected get a connection of their own, since boto's aren't meant to be
+           shared."""
+        if threading.currentThread() is self._main_thread:
+            return self._bucket
+        bucket = getattr(self._local, "bucket", None)
+        if bucket is None:
+            args, kwargs = self._connection_arguments
+            bucket = S3Connection(*args, **kwargs).get_bucket(self._bucket_name,
+                                                              validate=False)
+            self._local.bucket = bucket
+        return bucket
 
     def connect(self, url, config):
         """Initiate a connection to the remote host."""
+        options = config.full_options
         url = urlfunctions.url_split(url)
         if not url.username:
             print "S3: Please enter your AWS access key:",
             url.username = raw_input()
         if not url.password:
             url.password = getpass.getpass("S3: Please enter your AWS secret key:")
-        global S3Connection, Key
+        global boto, S3Connection, Key, MultiPartUpload, parse_ts
         try:
             # We import boto here so the program doesn't crash if the library is not installed.
-            from boto.s3.connection import S3Connection
+            from boto.s3.connection import S3Connection, OrdinaryCallingFormat
             from boto.s3.key import Key
+            from boto.s3.multipart import MultiPartUpload
+            from boto.utils import parse_ts
             import boto
         except ImportError:
             print "S3: You will need to install the boto library to have s3 support."
             raise
-        self._connection = S3Connection(url.username, url.password)
+        kwargs = {}
+        endpoint = getattr(options, "endpoint_s3", None)
+        if endpoint:
+            endpoint = urlfunctions.url_split(endpoint)
+            kwargs["host"] = endpoint.hostname
+            if endpoint.port:
+                kwargs["port"] = endpoint.port
+            kwargs["is_secure"] = endpoint.scheme != "http"
+            # S3-compatible servers don't generally have DNS entries for buckets.
+            kwargs["calling_format"] = OrdinaryCallingFormat()
+        self.part_size = getattr(options, "part_size_s3", None) or self.part_size
+        self.upload_threads = getattr(options, "upload_threads_s3", None) or \
+                              self.upload_threads
+        self.range_size = getattr(options, "range_size_s3", None) or self.range_size
+        self.download_threads = getattr(options, "download_threads_s3", None) or \
+                                self.download_threads
+        self.flat_listing = getattr(options, "flat_listing_s3", None) or self.flat_listing
+        retries = getattr(options, "retries_s3", None)
+        if retries is None:
+            retries = self.retries
+        hedge_percentile = getattr(options, "hedge_percentile_s3", None)
+        if hedge_percentile is None:
+            hedge_percentile = self.hedge_percentile
+        self._runner = S3RequestRunner(self, retries,
+                                       getattr(options, "deadline_s3", None) or self.deadline,
+                                       hedge_percentile)
+        self._print_stats = getattr(options, "stats_s3", None)
+        # We retry requests ourselves, and stuck connections should fail on their own
+        # eventually, unless the boto configuration says otherwise.
+        if not boto.config.has_section("Boto"):
+            boto.config.add_section("Boto")
+        if not boto.config.has_option("Boto", "num_retries"):
+            boto.config.set("Boto", "num_retries", "0")
+        if not boto.config.has_option("Boto", "http_socket_timeout"):
+            boto.config.set("Boto", "http_socket_timeout",
+                            str(int(math.ceil(self._runner.deadline))))
+        self._root = self._get_filename(urlfunctions.url_join(url))
+        self._connection_arguments = ((url.username, url.password), kwargs)
+        self._main_thread = threading.currentThread()
+        self._bucket_name = url.hostname
+        self._connection = S3Connection(url.username, url.password, **kwargs)
         try:
             self._bucket = self._connection.get_bucket(url.hostname)
         except boto.exception.S3ResponseError, failure:
@@ -74,37 +717,177 @@ class S3Transport(TransportInterface):
                 print "S3: Unspecified failure while connecting to the S3 bucket, aborting."
 
     def disconnect(self):
-        """Do nothing, S3 doesn't require anything."""
+        """Print the request statistics if asked to, S3 doesn't require anything else."""
+        if self._print_stats and self._runner is not None:
+            for operation, stats in sorted(self._runner.get_stats().items()):
+                print "S3: %s: %s requests, p50 %.3fs, p95 %.3fs, p99 %.3fs, %s hedged, " \
+                      "%s retried, %s timed out" % (operation, stats["count"],
+                      stats["p50"] or 0, stats["p95"] or 0, stats["p99"] or 0,
+                      stats["hedges"], stats["retries"], stats["timeouts"])
+
+    def _request(self, operation, function):
+        """Make a request with _function_, which is called with the bucket to use, with the
+           request runner's deadline, hedging and retries."""
+        return self._runner.call(operation, function)
 
-    def open(self, url, mode="r"):
-        """Open a file in _mode_ to prepare for I/O.
+    def _list(self, prefix, delimiter=None):
+        """Yield the keys and, with a _delimiter_, the common prefixes under _prefix_, like
+           bucket.list() does, but fetching each page as a separate request."""
+        arguments = {"prefix": prefix}
+        if delimiter:
+            arguments["delimiter"] = delimiter
+        marker = ""
+        while True:
+            page = self._request("LIST", lambda bucket, marker=marker:
+                                 bucket.get_all_keys(marker=marker, **arguments))
+            for item in page:
+                yield item
+            if not page.is_truncated or not len(page):
+                break
+            marker = page.next_marker or page[-1].name
+
+    def open(self, url, mode="r", size=None):
+        """Open a file in _mode_ to prepare for I/O. _size_ is the expected size of the file,
+           if known.
 
            Raises IOError if anything goes wrong.
         """
-        self._file_handle = Key(self._bucket, self._get_filename(url))
-        self._file_handle.open(mode.replace("b", ""))
+        if mode.startswith("r"):
+            range_size = self.range_size * 2**20
+            filename = self._get_filename(url)
+            if size is not None and size > range_size:
+                # Fetch large objects as ranges, several in parallel, so the requests get
+                # retried and hedged.
+                self._file_handle = S3Download(self, filename, size, range_size,
+                                               self.download_threads)
+            elif size is not None:
+                # Small objects take a single GET, which is retried and hedged too.
+                try:
+                    data = self._request("GET", lambda bucket:
+                        Key(bucket, filename).get_contents_as_string())
+                except Exception, failure:
+                    raise IOError, "Could not download %s: %s" % (filename, failure)
+                self._file_handle = cStringIO.StringIO(data)
+            else:
+                self._file_handle = Key(self._get_bucket(), filename)
+                self._file_handle.open(mode.replace("b", ""))
+        else:
+            self._upload = S3Upload(self, self._get_filename(url), self.part_size * 2**20,
+                                    self.upload_threads, size)
 
     def read(self, size):
         """Read _size_ bytes from the open file."""
         return self._file_handle.read(size)
 
-    #def write(self, data):
-    #    """No writes yet for s3 :(."""
-    #    self._file_handle.write(data)
+    def write(self, data):
+        """Write _data_ to the open file."""
+        self._upload.write(data)
 
     def remove(self, url):
         """Remove the specified file."""
-        self._bucket.remove(self._get_filename(url))
+        filename = self._get_filename(url)
+        try:
+            self._request("DELETE", lambda bucket: bucket.delete_key(filename))
+        except Exception, failure:
+            print "S3: Could not delete %s: %s" % (filename, failure)
+            return False
+        self._update_index(filename, False)
+        return True
+
+    def rename(self, source_url, destination_url):
+        """Move a file to another key with a server-side copy, and delete the original.
+
+           Returns True if the file was moved, False otherwise.
+        """
+        return self.copy(source_url, destination_url) and self.remove(source_url)
+
+    def copy(self, source_url, destination_url):
+        """Copy a file to another key on the server.
+
+           Returns True if the file was copied, False otherwise.
+        """
+        source_filename = self._get_filename(source_url)
+        filename = self._get_filename(destination_url)
+        try:
+            key = self._request("COPY", lambda bucket:
+                                bucket.copy_key(filename, bucket.name, source_filename))
+        except Exception, failure:
+            print "S3: Could not copy %s to %s: %s" % (source_filename, filename, failure)
+            return False
+        if self._index is not None:
+            # The source's attributes are in the index, so this doesn't make a request.
+            attributes = self.getattr(source_url, ["size"])
+            attributes.update({"mtime": int(time.time()), "etag": key.etag.strip("\"")})
+            self._update_index(filename, attributes)
+        return True
 
     def rmdir(self, url):
         """Remove the specified directory non-recursively."""
         return True
 
+    def remove_tree(self, url):
+        """Remove a directory and everything under it, with multi-object delete requests of
+           up to a thousand keys each.
+
+           Returns True if everything was removed, False otherwise.
+        """
+        filename = self._get_filename(url)
+        if not filename:
+            # Never empty a whole bucket this way.
+            return False
+        success = True
+        batch = []
+        for item in self._list(filename + "/"):
+            batch.append(item.name)
+            if len(batch) == DELETE_BATCH_SIZE:
+                success = self._delete_keys(batch) and success
+                batch = []
+        if batch:
+            success = self._delete_keys(batch) and success
+        self._update_index(filename, False)
+        if self._index is not None:
+            for directory in [x for x in self._index if x == filename or
+                              x.startswith(filename + "/")]:
+                del self._index[directory]
+        return success
+
+    def _delete_keys(self, key_names):
+        """Delete several keys with a single request, returning True if all were deleted."""
+        try:
+            result = self._request("DELETE", lambda bucket:
+                                   bucket.delete_keys(key_names, quiet=True))
+        except Exception, failure:
+            print "S3: Could not delete keys: %s" % failure
+            return False
+        for error in result.errors:
+            print "S3: Could not delete %s: %s" % (error.key, error.message)
+        return not result.errors
+
     def close(self):
-        """Close the open file."""
+        """Close the open file, finishing any upload.
+
+           Raises IOError if the upload failed.
+        """
+        if self._file_handle:
+            self._file_handle.close()
+            self._file_handle = None
+        if self._upload:
+            upload = self._upload
+            self._upload = None
+            upload.close()
+            self._update_index(upload.name, {"size": upload.size,
+                                             "mtime": int(time.time()),
+                                             "etag": upload.etag})
+
+    def abort(self):
+        """Close the open file, throwing away whatever was written to it."""
         if self._file_handle:
             self._file_handle.close()
             self._file_handle = None
+        if self._upload:
+            upload = self._upload
+            self._upload = None
+            upload.abort()
 
     def mkdir(self, url):
         """Where we're going, we don't *need* directories."""
@@ -117,32 +900,122 @@ class S3Transport(TransportInterface):
         attribute_dict is a dictionary of {key: value} pairs for any applicable
         attributes from ("size", "mtime", "atime", "ctime", "isdir").
         """
+        index = self._get_index(self._get_filename(url))
         url = urlfunctions.append_slash(url, True)
         url = urlfunctions.url_split(url)
         path = urlfunctions.prepend_slash(url.path, False)
-        dir_list = self._bucket.list(prefix=path, delimiter="/")
+        if index is not None:
+            file_list = []
+            for name, attributes in index.get(path.rstrip("/"), {}).items():
+                if attributes is None:
+                    url.path = "/" + path + name + "/"
+                    attributes = {"isdir": True, "size": 0}
+                else:
+                    url.path = "/" + path + name
+                    attributes = dict(attributes, isdir=False)
+                file_list.append(FileObject(self, urlfunctions.url_join(url), attributes))
+            return file_list
+        dir_list = self._list(path, "/")
         file_list = []
         for item in dir_list:
             # Prepend a slash by convention.
             url.path = "/" + item.name
             # list() returns directories ending with a slash.
-            file_obj = FileObject(self, urlfunctions.url_join(url),
-                                        {"isdir": item.name.endswith("/")})
-            if not file_obj.isdir:
-                file_obj.size = item.size
+            if item.name.endswith("/"):
+                attributes = {"isdir": True, "size": 0}
             else:
-                file_obj.size = 0
-            file_list.append(file_obj)
+                attributes = dict(get_key_attributes(item), isdir=False)
+            file_list.append(FileObject(self, urlfunctions.url_join(url), attributes))
         return file_list
 
     def isdir(self, url):
         """Return True if the given URL is a directory, False if it is a file or
            does not exist."""
+        filename = self._get_filename(url)
+        index = self._get_index(filename)
+        if index is not None:
+            return filename in index
         return self.listdir(url) != []
 
+    def _in_root(self, filename):
+        """Return True if a key is under the root we connected to."""
+        return not self._root or filename == self._root or \
+               filename.startswith(self._root + "/")
+
+    def _get_index(self, filename):
+        """Return the tree index if flat listing is on and _filename_ is under the root,
+           building the index with a single paged listing of the root the first time, or None
+           otherwise."""
+        if not self.flat_listing or not self._in_root(filename):
+            return None
+        if self._index is not None:
+            return self._index
+        index = {}
+        if not self._root:
+            # The bucket itself always exists.
+            index[""] = {}
+            prefix = ""
+        else:
+            prefix = self._root + "/"
+        for item in self._list(prefix):
+            # Keys ending in a slash are directory placeholders.
+            if item.name.endswith("/"):
+                self._add_to_index(index, item.name.rstrip("/"), None)
+            else:
+                self._add_to_index(index, item.name, get_key_attributes(item))
+        self._index = index
+        return index
+
+    def _split_filename(self, filename):
+        """Split a key into its parent directory and name."""
+        if "/" in filename:
+            return filename.rsplit("/", 1)
+        return "", filename
+
+    def _add_to_index(self, index, filename, attributes):
+        """Add a file or directory to the tree index, along with the directories above it."""
+        if attributes is None:
+            index.setdefault(filename, {})
+        while self._in_root(filename) and filename != self._root:
+            parent, name = self._split_filename(filename)
+            known_parent = parent in index
+            index.setdefault(parent, {})[name] = attributes
+            if known_parent:
+                # The directories above the parent are already in the index too.
+                break
+            filename = parent
+            attributes = None
+
+    def _update_index(self, filename, attributes):
+        """Record a file we have written or, if _attributes_ is False, removed, in the tree
+           index."""
+        if self._index is None or not self._in_root(filename):
+            return
+        if attributes is False:
+            parent, name = self._split_filename(filename)
+            self._index.get(parent, {}).pop(name, None)
+        else:
+            self._add_to_index(self._index, filename, attributes)
+
     def getattr(self, url, attributes):
-        """Do nothing."""
+        """Retrieve as many file attributes as we can, at the very *least* the requested ones.
+
+        Returns a dictionary of {"attribute": "value"}, or {"attribute": None} if the file does
+        not exist.
+        """
         # TODO: Retrieve ACL.
+        filename = self._get_filename(url)
+        index = self._get_index(filename)
+        if index is not None and filename != self._root:
+            parent, name = self._split_filename(filename)
+            attributes = index.get(parent, {}).get(name)
+            if attributes is None:
+                return dict(MISSING_ATTRIBUTES)
+            return dict(attributes)
+        key = self._request("HEAD", lambda bucket: bucket.get_key(filename))
+        if key is None:
+            return dict(MISSING_ATTRIBUTES)
+        return get_key_attributes(key)
 
     def setattr(self, url, attributes):
         """Do nothing."""
@@ -154,4 +1027,16 @@ class S3Transport(TransportInterface):
         # If we're looking for the root, return True.
         if filename == "":
             return True
-        return Key(self._bucket, filename).exists()
+        index = self._get_index(filename)
+        if index is not None:
+            if filename in index:
+                return True
+            # The root might be a single file, which the listing of its children won't show.
+            if filename != self._root:
+                parent, name = self._split_filename(filename)
+                return name in index.get(parent, {})
+        if self._request("HEAD", lambda bucket: Key(bucket, filename).exists()):
+            return True
+        # Directories only exist as prefixes of other keys.
+        return len(self._request("LIST", lambda bucket:
+                                 bucket.get_all_keys(prefix=filename + "/", max_keys=1))) > 0
@@ -7,6 +7,137 @@ from omnisync import urlfunctions
 import getpass
 import time
 import errno
+import stat
+import threading
+import Queue
+import re
+import pipes
+import binascii
+import tarfile
+import cStringIO
+
+# The commands that compute each checksum algorithm on the server.
+CHECKSUM_COMMANDS = {"md5": "md5sum", "sha1": "sha1sum", "sha256": "sha256sum"}
+# The longest command line to send to the server.
+MAX_COMMAND_LENGTH = 2**16
+
+
+class SFTPSessionPool(object):
+    """A pool of SFTP sessions multiplexed over a single SSH connection.
+
+       Every session is a separate channel on the same authenticated paramiko.Transport, so
+       opening one costs a single round trip rather than a key exchange and authentication.
+    """
+    def __init__(self, transport, size):
+        self._transport = transport
+        self._size = max(size, 1)
+        self._sessions = []
+        self._idle = Queue.Queue()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Return an idle session, opening a new one if the pool is not full yet and
+           blocking until another thread releases one otherwise."""
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        self._lock.acquire()
+        try:
+            if len(self._sessions) < self._size:
+                session = paramiko.SFTPClient.from_transport(self._transport)
+                self._sessions.append(session)
+                return session
+        finally:
+            self._lock.release()
+        return self._idle.get()
+
+    def release(self, session):
+        """Return a session to the pool."""
+        self._idle.put(session)
+
+    def close(self):
+        """Close all the sessions in the pool."""
+        for session in self._sessions:
+            session.close()
+        self._sessions = []
+
+
+class SFTPRequestPipeline(object):
+    """Send a batch of SFTP metadata requests without waiting for each reply and collect the
+       responses afterwards, turning N round trips into roughly one per window."""
+    # The maximum number of requests to keep outstanding on the session.
+    window = 64
+
+    def __init__(self, session):
+        self._session = session
+        self._requests = []
+        self._responses = {}
+
+    def _add(self, request_type, path, *args):
+        """Queue a request and return its index in the results."""
+        self._requests.append((request_type, (self._session._adjust_cwd(path), ) + args))
+        return len(self._requests) - 1
+
+    def stat(self, path):
+        """Queue a stat request."""
+        return self._add(paramiko.sftp.CMD_STAT, path)
+
+    def setstat(self, path, attributes):
+        """Queue a request to set the given paramiko.SFTPAttributes on a path."""
+        return self._add(paramiko.sftp.CMD_SETSTAT, path, attributes)
+
+    def mkdir(self, path, mode=0777):
+        """Queue a directory creation request."""
+        attributes = paramiko.SFTPAttributes()
+        attributes.st_mode = mode
+        return self._add(paramiko.sftp.CMD_MKDIR, path, attributes)
+
+    def remove(self, path):
+        """Queue a file removal request."""
+        return self._add(paramiko.sftp.CMD_REMOVE, path)
+
+    def rmdir(self, path):
+        """Queue a directory removal request."""
+        return self._add(paramiko.sftp.CMD_RMDIR, path)
+
+    def _async_response(self, response_type, message, number):
+        """Store a response paramiko has read for one of our requests."""
+        self._responses[number] = (response_type, message)
+
+    def _parse_response(self, response_type, message):
+        """Turn a response into a paramiko.SFTPAttributes instance for stat requests, None for
+           successful requests and an IOError instance for failed ones."""
+        if response_type == paramiko.sftp.CMD_ATTRS:
+            return paramiko.SFTPAttributes._from_msg(message)
+        elif response_type == paramiko.sftp.CMD_STATUS:
+            try:
+                self._session._convert_status(message)
+            except (IOError, EOFError), failure:
+                return IOError(getattr(failure, "errno", None), str(failure))
+            return None
+        return IOError("Unexpected SFTP response type %s." % response_type)
+
+    def run(self):
+        """Send all the queued requests and return the list of their results, in the order the
+           requests were queued."""
+        results = [None] * len(self._requests)
+        outstanding = {}
+        index = 0
+        while index < len(self._requests) or outstanding:
+            # Keep the window full...
+            while index < len(self._requests) and len(outstanding) < self.window:
+                request_type, args = self._requests[index]
+                number = self._session._async_request(self, request_type, *args)
+                outstanding[number] = index
+                index += 1
+            # ...and read the responses as they arrive.
+            self._session._read_response()
+            for number in [x for x in outstanding if x in self._responses]:
+                results[outstanding.pop(number)] = self._parse_response(
+                    *self._responses.pop(number))
+        self._requests = []
+        return results
 
 
 class SFTPTransport(TransportInterface):
@@ -22,19 +153,69 @@ class SFTPTransport(TransportInterface):
     # supports.
     listdir_attributes = set(("size", "mtime", "atime", "perms", "owner", "group"))
     # Conversely, for getattr().
-    getattr_attributes = set(("size", "mtime", "atime", "perms", "owner", "group"))
+    getattr_attributes = set(("size", "mtime", "atime", "perms", "owner", "group", "checksum"))
     # List the attributes setattr() can set.
     setattr_attributes = set(("mtime", "atime", "perms", "owner", "group"))
     # Define attributes that can be used to decide whether a file has been changed
     # or not.
-    evaluation_attributes = set(("size", "mtime"))
+    evaluation_attributes = set(("size", "mtime", "checksum"))
     # The preferred buffer size for reads/writes.
     buffer_size = 2**15
+    # The default number of SFTP sessions to open over the SSH connection.
+    pool_size = 4
+    # Files up to this size are sent together in a tar stream rather than one by one, if set.
+    small_file_threshold = 0
+    # Every thread has a session and a file of its own.
+    thread_safe = True
 
     def __init__(self):
-        self._file_handle = None
-        self._connection = None
+        # Sessions and open files are bound to the thread that uses them, so that the
+        # transport can be shared by the workers of a multi-threaded copy.
+        self._local = threading.local()
+        self._pool = None
         self._transport = None
+        # A cache of {filename: paramiko.SFTPAttributes} items for this connection, with None
+        # for files that are known not to exist.
+        self._stat_cache = {}
+        # A cache of {filename: checksum} items for this connection.
+        self._checksum_cache = {}
+        self._checksum_algorithm = "sha256"
+        # How the server can compute checksums: None if we haven't found out yet, "exec",
+        # "check-file" or False if it can't.
+        self._checksum_method = None
+        # Whether the server can unpack tar streams, or None if we haven't found out yet.
+        self._tar_available = None
+        # Whether the server can run rm for us, or None if we haven't found out yet.
+        self._rm_available = None
+        # Whether the server lets us run commands at all, or None if we haven't found out yet.
+        self._exec_available = None
+
+    def _get_connection(self):
+        """Return the SFTP session bound to the current thread, acquiring one from the pool
+           if the thread doesn't have one yet."""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._pool.acquire()
+            self._local.session = session
+        return session
+    _connection = property(_get_connection)
+
+    def _get_file_handle(self):
+        """Return the file the current thread has open."""
+        return getattr(self._local, "file_handle", None)
+
+    def _set_file_handle(self, file_handle):
+        """Set the file the current thread has open."""
+        self._local.file_handle = file_handle
+    _file_handle = property(_get_file_handle, _set_file_handle)
+
+    def release_session(self):
+        """Return the current thread's SFTP session to the pool. Worker threads should call
+           this when they are done with the transport so other threads can use the session."""
+        session = getattr(self._local, "session", None)
+        if session is not None:
+            self._local.session = None
+            self._pool.release(session)
 
     def _get_filename(self, url):
         """Retrieve the local filename from a given URL."""
@@ -45,13 +226,86 @@ class SFTPTransport(TransportInterface):
             path = path[1:]
         return path
 
+    def _get_cache_key(self, filename):
+        """Return the metadata cache key for a filename."""
+        if len(filename) > 1:
+            filename = filename.rstrip("/")
+        return filename
+
+    def _stat(self, filename):
+        """Return the paramiko.SFTPAttributes of a file, or None if it does not exist, using the
+           metadata cache where possible."""
+        key = self._get_cache_key(filename)
+        try:
+            return self._stat_cache[key]
+        except KeyError:
+            pass
+        try:
+            statinfo = self._connection.stat(filename)
+        except IOError, failure:
+            if failure.errno != errno.ENOENT:
+                return None
+            statinfo = None
+        self._stat_cache[key] = statinfo
+        return statinfo
+
+    def _invalidate(self, filename):
+        """Drop a file and its parent directory, whose times change along with it, from the
+           metadata cache."""
+        key = self._get_cache_key(filename)
+        self._stat_cache.pop(key, None)
+        self._checksum_cache.pop(key, None)
+        index = key.rfind("/")
+        if index > 0:
+            self._stat_cache.pop(key[:index], None)
+        elif index == 0:
+            self._stat_cache.pop("/", None)
+        else:
+            self._stat_cache.pop("", None)
+
+    def _get_attributes(self, statinfo):
+        """Convert a paramiko.SFTPAttributes instance into an attribute dictionary."""
+        # Turn times to ints because checks fail sometimes due to rounding errors.
+        return {"size": statinfo.st_size,
+                "mtime": int(statinfo.st_mtime),
+                "atime": int(statinfo.st_atime),
+                "perms": statinfo.st_mode,
+                "owner": statinfo.st_uid,
+                "group": statinfo.st_gid,
+                }
+
+    def _get_sftp_attributes(self, attributes, statinfo=None):
+        """Convert an attribute dictionary into a paramiko.SFTPAttributes instance for a
+           setstat request. _statinfo_ supplies the values SFTP needs in pairs but the
+           dictionary lacks."""
+        sftp_attributes = paramiko.SFTPAttributes()
+        if "atime" in attributes or "mtime" in attributes:
+            sftp_attributes.st_atime = attributes.get("atime", time.time())
+            sftp_attributes.st_mtime = attributes.get("mtime", time.time())
+        if "perms" in attributes:
+            sftp_attributes.st_mode = attributes["perms"]
+        if "owner" in attributes or "group" in attributes:
+            sftp_attributes.st_uid = attributes.get("owner", getattr(statinfo, "st_uid", None))
+            sftp_attributes.st_gid = attributes.get("group", getattr(statinfo, "st_gid", None))
+        return sftp_attributes
+
     # Transports should also implement the following methods:
     def add_options(self):
         """Return the desired command-line plugin options.
 
            Returns a tuple of ((args), {kwargs}) items for optparse's add_option().
         """
-        return ()
+        return ((("--sftp-sessions", ), {"dest": "sessions_",
+                                         "type": "int",
+                                         "help": "the number of concurrent SFTP sessions to "
+                                                 "open over the SSH connection",
+                                         "metavar": "NUMBER"}),
+                (("--sftp-tar-threshold", ), {"dest": "tar_threshold_",
+                                              "type": "int",
+                                              "help": "send files up to SIZE bytes together "
+                                                      "in a tar stream over SSH",
+                                              "metavar": "SIZE"}),
+                )
 
     def connect(self, url, config):
         """Initiate a connection to the remote host."""
@@ -86,20 +340,30 @@ class SFTPTransport(TransportInterface):
                     "SFTP: Please enter the password for %s@%s:" % (url.username, url.hostname)
                 )
         self._transport.connect(username=username, password=password)
-        self._connection = paramiko.SFTPClient.from_transport(self._transport)
+        pool_size = getattr(options, "sessions_sftp", None) or self.pool_size
+        self._pool = SFTPSessionPool(self._transport, pool_size)
+        self._checksum_algorithm = config.checksum_algorithm
+        self.small_file_threshold = getattr(options, "tar_threshold_sftp", None) or \
+                                    self.small_file_threshold
 
     def disconnect(self):
         """Disconnect from the remote server."""
+        self._pool.close()
         self._transport.close()
 
-    def open(self, url, mode="rb"):
-        """Open a file in _mode_ to prepare for I/O.
+    def open(self, url, mode="rb", size=None):
+        """Open a file in _mode_ to prepare for I/O. _size_ is the expected size of the file,
+           if known.
 
            Raises IOError if anything goes wrong.
         """
         if self._file_handle:
-            raise IOError, "Another file is already open."
-        self._file_handle = self._connection.open(self._get_filename(url), mode)
+            raise IOError, "Another file is already open in this thread."
+        filename = self._get_filename(url)
+        if not mode.startswith("r"):
+            self._invalidate(filename)
+            self._local.written_filename = filename
+        self._file_handle = self._connection.open(filename, mode)
 
     def read(self, size):
         """Read _size_ bytes from the open file."""
@@ -109,45 +373,206 @@ class SFTPTransport(TransportInterface):
         """Write _data_ to the open file."""
         self._file_handle.write(data)
 
+    def seek(self, offset):
+        """Move to _offset_ in the open file. Writing past the end of a file leaves a hole."""
+        self._file_handle.seek(offset)
+
+    def truncate(self, size):
+        """Cut or extend the open file to _size_ bytes."""
+        # Send what has been written first, so it isn't written after the change.
+        self._file_handle.flush()
+        self._file_handle.truncate(size)
+
     def remove(self, url):
         """Remove the specified file."""
+        filename = self._get_filename(url)
+        self._invalidate(filename)
         try:
-            self._connection.remove(self._get_filename(url))
+            self._connection.remove(filename)
         except IOError:
             return False
         else:
             return True
 
+    def rename(self, source_url, destination_url):
+        """Move a file to another path on the server, with the POSIX rename extension if the
+           server has it.
+
+           Returns True if the file was moved, False otherwise.
+        """
+        source_filename = self._get_filename(source_url)
+        filename = self._get_filename(destination_url)
+        self._invalidate(source_filename)
+        self._invalidate(filename)
+        try:
+            self._connection.posix_rename(source_filename, filename)
+        except IOError:
+            # Plain renames fail if the destination exists, but ours doesn't.
+            try:
+                self._connection.rename(source_filename, filename)
+            except IOError:
+                return False
+        return True
+
+    def link(self, source_url, destination_url):
+        """Make a hard link to a file on the server, replacing any file at _destination_url_,
+           by running ln if the server lets us run commands.
+
+           Returns True if the link was made, False otherwise.
+        """
+        return self._exec_on_files("ln -f --", source_url, destination_url)
+
+    def copy(self, source_url, destination_url):
+        """Copy a file on the server, replacing any file at _destination_url_, by running cp if
+           the server lets us run commands.
+
+           Returns True if the file was copied, False otherwise.
+        """
+        return self._exec_on_files("cp --", source_url, destination_url)
+
+    def _exec_on_files(self, command, source_url, destination_url):
+        """Run a command on a source and destination file on the server, and return True if it
+           succeeded."""
+        if self._exec_available is False:
+            return False
+        source_filename = self._get_filename(source_url)
+        filename = self._get_filename(destination_url)
+        self._invalidate(filename)
+        try:
+            channel = self._exec("%s %s %s" % (command, pipes.quote(source_filename),
+                                               pipes.quote(filename)))
+            channel.makefile("rb").read()
+            status = channel.recv_exit_status()
+        except (IOError, paramiko.SSHException):
+            self._exec_available = False
+            return False
+        return status == 0
+
     def rmdir(self, url):
         """Remove the specified directory non-recursively."""
+        filename = self._get_filename(url)
+        self._invalidate(filename)
         try:
-            self._connection.rmdir(self._get_filename(url))
+            self._connection.rmdir(filename)
         except IOError:
             return False
         else:
             return True
 
+    def remove_tree(self, url):
+        """Remove a directory and everything under it, by running rm on the server if it lets
+           us run commands and by pipelining the removal requests otherwise.
+
+           Returns True if everything was removed, False otherwise.
+        """
+        filename = self._get_cache_key(self._get_filename(url))
+        if filename in ("", ".", "/"):
+            # Never remove the home or root directory this way.
+            return False
+        self._invalidate_tree(filename)
+        if self._rm_available is not False:
+            try:
+                channel = self._exec("rm -rf -- %s" % pipes.quote(filename))
+                output = channel.makefile("rb").read()
+                status = channel.recv_exit_status()
+            except (IOError, paramiko.SSHException):
+                status = 127
+            if status == 0:
+                self._rm_available = True
+                return True
+            # 127 means the shell couldn't find rm.
+            if status == 127:
+                self._rm_available = False
+            else:
+                print "SFTP: Could not remove %s on the server: %s" % (filename, output.strip())
+        # List the whole tree, then remove the files and the directories, deepest first, in one
+        # pipelined batch. The server processes the requests in order, so the directories are
+        # empty by the time they're removed.
+        file_names = []
+        directory_names = []
+        directory_stack = [filename]
+        while directory_stack:
+            directory = directory_stack.pop()
+            directory_names.append(directory)
+            try:
+                dir_list = self._connection.listdir_attr(directory)
+            except IOError:
+                return False
+            for item in dir_list:
+                if stat.S_ISDIR(item.st_mode):
+                    directory_stack.append(directory + "/" + item.filename)
+                else:
+                    file_names.append(directory + "/" + item.filename)
+        pipeline = SFTPRequestPipeline(self._connection)
+        for file_name in file_names:
+            pipeline.remove(file_name)
+        # Directories are listed after the one they're in, so remove them in reverse order.
+        for directory in reversed(directory_names):
+            pipeline.rmdir(directory)
+        return not [x for x in pipeline.run() if x is not None]
+
+    def _invalidate_tree(self, filename):
+        """Drop a directory and everything under it from the metadata cache."""
+        self._invalidate(filename)
+        prefix = filename + "/"
+        for cache in (self._stat_cache, self._checksum_cache):
+            for key in [x for x in cache if x.startswith(prefix)]:
+                del cache[key]
+
     def close(self):
         """Close the open file."""
         if self._file_handle:
             self._file_handle.close()
             self._file_handle = None
+        # The size and times of a file we have written to are now different.
+        filename = getattr(self._local, "written_filename", None)
+        if filename is not None:
+            self._invalidate(filename)
+            self._local.written_filename = None
+
+    def abort(self):
+        """Close the open file and, if it was being written, remove it, so that no partial
+           file is left behind."""
+        if self._file_handle:
+            try:
+                self._file_handle.close()
+            except IOError:
+                pass
+            self._file_handle = None
+        filename = getattr(self._local, "written_filename", None)
+        if filename is not None:
+            try:
+                self._connection.remove(filename)
+            except IOError:
+                pass
+            self._invalidate(filename)
+            self._local.written_filename = None
 
     def mkdir(self, url):
         """Recursively make the given directories at the current URL."""
         # Recursion is not needed for anything but the first directory, so we need to be able to
         # do it.
-        current_path = ""
-        error = False
-        for component in self._get_filename(url).split("/"):
+        # All the components are created in one pipelined batch; the server processes the
+        # requests in order, so the parents exist by the time their children are created.
+        filename = self._get_filename(url)
+        # Absolute paths keep their leading slash.
+        if filename.startswith("/"):
+            current_path = "/"
+        else:
+            current_path = ""
+        pipeline = SFTPRequestPipeline(self._connection)
+        for component in filename.split("/"):
+            if not component:
+                continue
             current_path += component + "/"
-            try:
-                self._connection.mkdir(current_path)
-            except IOError, failure:
-                if failure.errno != errno.EEXIST:
-                    error = True
-            else:
+            self._invalidate(current_path)
+            pipeline.mkdir(current_path)
+        error = False
+        for failure in pipeline.run():
+            if failure is None:
                 error = False
+            elif failure.errno != errno.EEXIST:
+                error = True
 
         return error
 
@@ -166,29 +591,19 @@ class SFTPTransport(TransportInterface):
             return False
         file_list = []
         for item in dir_list:
-            file_list.append(FileObject(self, url + item.filename,
-                {"size": item.st_size,
-                 "mtime": item.st_mtime,
-                 "atime": item.st_atime,
-                 "perms": item.st_mode,
-                 "owner": item.st_uid,
-                 "group": item.st_gid,
-                }))
+            attributes = self._get_attributes(item)
+            # The listing doesn't follow symlinks, so leave it to isdir() to check those.
+            if not stat.S_ISLNK(item.st_mode):
+                self._stat_cache[self._get_filename(url + item.filename)] = item
+                attributes["isdir"] = stat.S_ISDIR(item.st_mode)
+            file_list.append(FileObject(self, url + item.filename, attributes))
         return file_list
 
     def isdir(self, url):
         """Return True if the given URL is a directory, False if it is a file or
            does not exist."""
-        try:
-            # paramiko doesn't allow you to check any other way.
-            self._connection.listdir(self._get_filename(url))
-        except IOError, failure:
-            if failure.errno == errno.ENOENT:
-                return False
-            else:
-                raise
-        else:
-            return True
+        statinfo = self._stat(self._get_filename(url))
+        return statinfo is not None and stat.S_ISDIR(statinfo.st_mode)
 
     def getattr(self, url, attributes):
         """Retrieve as many file attributes as we can, at the very *least* the requested ones.
@@ -196,55 +611,195 @@ class SFTPTransport(TransportInterface):
         Returns a dictionary of {"attribute": "value"}, or {"attribute": None} if the file does
         not exist.
         """
+        return self.getattr_batch([url], attributes)[0]
+
+    def getattr_batch(self, urls, attributes):
+        """Retrieve the attributes of several files at once, pipelining the requests.
+
+        Returns a list of attribute dictionaries in the order of _urls_, as getattr() would.
+        """
         if set(attributes) - self.getattr_attributes:
             raise NotImplementedError, "Some requested attributes are not implemented."
+        filenames = [self._get_cache_key(self._get_filename(url)) for url in urls]
+        # Only ask the server about the files that aren't in the cache.
+        pipeline = SFTPRequestPipeline(self._connection)
+        missing = [x for x in set(filenames) if x not in self._stat_cache]
+        for filename in missing:
+            pipeline.stat(filename)
+        for filename, statinfo in zip(missing, pipeline.run()):
+            if isinstance(statinfo, IOError):
+                if statinfo.errno != errno.ENOENT:
+                    continue
+                statinfo = None
+            self._stat_cache[filename] = statinfo
+        if "checksum" in attributes:
+            self._get_checksums([x for x in set(filenames) if self._stat_cache.get(x) and
+                                 stat.S_ISREG(self._stat_cache[x].st_mode)])
+        attribute_list = []
+        for filename in filenames:
+            statinfo = self._stat_cache.get(filename)
+            if statinfo is None:
+                attribute_list.append(dict([(x, None) for x in self.getattr_attributes]))
+            else:
+                attribute_dict = self._get_attributes(statinfo)
+                # Leave the checksum out if the server couldn't compute it, so it isn't compared.
+                if "checksum" in attributes and filename in self._checksum_cache:
+                    attribute_dict["checksum"] = self._checksum_cache[filename]
+                attribute_list.append(attribute_dict)
+        return attribute_list
+
+    def _exec(self, command):
+        """Run a command on the server over a new channel of the SSH connection.
+
+           Returns the paramiko.Channel, with stderr merged into stdout.
+        """
+        channel = self._transport.open_session()
+        channel.set_combine_stderr(True)
+        channel.exec_command(command)
+        return channel
+
+    def write_small_files(self, items):
+        """Write several small files in one go, by streaming them as a tar archive into tar on
+           the server over an exec channel, which avoids the round trips of writing them one
+           at a time.
+
+           items - A list of (url, data, attribute_dict) tuples.
+
+           Returns True if the files were written, False if the server can't do this, in which
+           case they should be written one by one.
+        """
+        if self._tar_available is False:
+            return False
         try:
-            statinfo = self._connection.stat(self._get_filename(url))
-        except IOError:
-            return dict([(x, None) for x in self.getattr_attributes])
-        # Turn times to ints because checks fail sometimes due to rounding errors.
-        return {"size": statinfo.st_size,
-                "mtime": int(statinfo.st_mtime),
-                "atime": int(statinfo.st_atime),
-                "perms": statinfo.st_mode,
-                "owner": statinfo.st_uid,
-                "group": statinfo.st_gid,
-                }
+            channel = self._exec("tar -x -P -f -")
+            archive = tarfile.open(fileobj=channel.makefile("wb"), mode="w|")
+            for url, data, attributes in items:
+                filename = self._get_filename(url)
+                self._invalidate(filename)
+                info = tarfile.TarInfo(filename)
+                info.size = len(data)
+                info.mtime = attributes.get("mtime") or time.time()
+                if attributes.get("perms") is not None:
+                    info.mode = attributes["perms"] & 07777
+                archive.addfile(info, cStringIO.StringIO(data))
+            archive.close()
+            channel.shutdown_write()
+            output = channel.makefile("rb").read()
+            status = channel.recv_exit_status()
+        except (IOError, paramiko.SSHException):
+            self._tar_available = False
+            return False
+        if status != 0:
+            # 127 means the shell couldn't find tar at all.
+            if status == 127:
+                self._tar_available = False
+            else:
+                print "SFTP: Could not unpack files on the server: %s" % output.strip()
+            return False
+        self._tar_available = True
+        return True
 
-    def setattr(self, url, attributes):
-        """Set a file's attributes if possible."""
-        filename = self._get_filename(url)
-        if "atime" in attributes or "mtime" in attributes:
-            atime = attributes.get("atime", time.time())
-            mtime = attributes.get("mtime", time.time())
+    def _get_checksums(self, filenames):
+        """Compute the checksums of the given files on the server, so that they can be compared
+           without downloading them, and store them in the checksum cache."""
+        filenames = [x for x in filenames if x not in self._checksum_cache]
+        if not filenames or self._checksum_method is False:
+            return
+        if self._checksum_method in (None, "exec"):
             try:
-                self._connection.utime(filename, (atime, mtime))
-            except IOError:
-                print "SFTP: Permission denied, could not set atime/mtime."
-        if "perms" in attributes:
-            try:
-                self._connection.chmod(filename, attributes["perms"])
-            except IOError:
-                print "SFTP: Permission denied, could not set perms."
-        if "owner" in attributes or "group" in attributes:
-            # If we're missing one, get it.
-            if not "owner" in attributes or not "group" in attributes:
-                stat = self._connection.stat(filename)
-                owner = attributes.get("owner", stat.st_uid)
-                group = attributes.get("group", stat.st_gid)
+                self._exec_checksums(list(filenames))
+            except (IOError, paramiko.SSHException):
+                if self._checksum_method is None:
+                    self._checksum_method = "check-file"
             else:
-                owner = attributes["owner"]
-                group = attributes["group"]
-            try:
-                self._connection.chown(filename, owner, group)
-            except IOError:
-                print "SFTP: Permission denied, could not set uid/gid."
+                self._checksum_method = "exec"
+        if self._checksum_method == "check-file":
+            for filename in filenames:
+                try:
+                    checked_file = self._connection.open(filename, "rb")
+                except IOError:
+                    continue
+                try:
+                    try:
+                        self._checksum_cache[filename] = binascii.hexlify(
+                            checked_file.check(self._checksum_algorithm))
+                    except IOError:
+                        # The server doesn't support the check-file extension either.
+                        self._checksum_method = False
+                        return
+                finally:
+                    checked_file.close()
+
+    def _exec_checksums(self, filenames):
+        """Compute the checksums of the given files by running the checksum utility on the
+           server, on as many files at a time as the command line allows."""
+        command = CHECKSUM_COMMANDS[self._checksum_algorithm] + " -b --"
+        output_re = re.compile(r"^([0-9a-fA-F]+) [ *](.*)$")
+        while filenames:
+            command_line = command
+            batch = set()
+            while filenames and len(command_line) < MAX_COMMAND_LENGTH:
+                batch.add(filenames[-1])
+                command_line += " " + pipes.quote(filenames.pop())
+            channel = self._exec(command_line)
+            output = channel.makefile("rb").read()
+            # 127 means the shell couldn't find the command.
+            if channel.recv_exit_status() == 127:
+                raise IOError, "The server can't compute %s checksums." % self._checksum_algorithm
+            for line in output.splitlines():
+                # Errors for missing files are mixed in, so only take the lines we recognise.
+                match = output_re.match(line)
+                if match and match.group(2) in batch:
+                    self._checksum_cache[match.group(2)] = match.group(1).lower()
+
+    def setattr(self, url, attributes):
+        """Set a file's attributes if possible."""
+        self.setattr_batch([(url, attributes)])
+
+    def setattr_batch(self, items):
+        """Set the attributes of several files at once, pipelining the requests.
+
+           items - A list of (url, attributes) tuples.
+        """
+        # Only keep the attributes we know how to set.
+        items = [(self._get_filename(url),
+                  dict([(x, y) for x, y in attributes.items()
+                        if x in self.setattr_attributes and y is not None]))
+                 for url, attributes in items]
+        items = [(filename, attributes) for filename, attributes in items if attributes]
+        for filename, attributes in items:
+            self._invalidate(filename)
+
+        # SFTP can only set the owner and group together, so get the one we're missing.
+        pipeline = SFTPRequestPipeline(self._connection)
+        stat_indices = {}
+        for filename, attributes in items:
+            if ("owner" in attributes) != ("group" in attributes):
+                stat_indices[filename] = pipeline.stat(filename)
+        stat_results = pipeline.run()
+        stat_results = dict([(x, stat_results[y]) for x, y in stat_indices.items()])
+
+        # Set everything for a file with a single request.
+        for filename, attributes in items:
+            pipeline.setstat(filename, self._get_sftp_attributes(attributes,
+                                                                 stat_results.get(filename)))
+        failed = [item for item, failure in zip(items, pipeline.run()) if failure is not None]
+
+        # Some servers refuse the whole request if they can't set one of the attributes (for
+        # example, the owner if we aren't root), so retry the failed ones separately.
+        retries = []
+        for filename, attributes in failed:
+            for keys in (("atime", "mtime"), ("perms", ), ("owner", "group")):
+                subset = dict([(x, attributes[x]) for x in keys if x in attributes])
+                if subset:
+                    retries.append((filename, keys))
+                    pipeline.setstat(filename, self._get_sftp_attributes(
+                        subset, stat_results.get(filename)))
+        for (filename, keys), failure in zip(retries, pipeline.run()):
+            if failure is not None:
+                print "SFTP: Permission denied, could not set %s on %s." % (
+                    "/".join(keys), filename)
 
     def exists(self, url):
         """Return True if a given path exists, False otherwise."""
-        try:
-            self._connection.stat(self._get_filename(url))
-        except IOError:
-            return False
-        else:
-            return True
+        return self._stat(self._get_filename(url)) is not None
@@ -0,0 +1,172 @@
+"""Slow network simulation module."""
+
+from omnisync.transportmount import TransportInterface
+from omnisync.fileobject import FileObject
+
+import time
+import random
+
+# The operations that fail when errors are injected. These are the ones the engine recovers
+# from by skipping the file.
+FAILING_OPERATIONS = ("open", "read", "write")
+
+
+class SlowTransport(TransportInterface):
+    """Slow network simulation class.
+
+       "slow+scheme://..." URLs are handled by the transport for "scheme://...", with every
+       operation delayed as if it was a round trip over a slow network, data transfers limited
+       to a bandwidth and errors injected at random, so that the effect of batching,
+       pipelining and caching can be measured on a single machine. Batched operations count
+       as a single round trip.
+    """
+    # Transports should declare the protocols attribute to specify the protocol(s)
+    # they can handle.
+    protocols = ("slow", )
+    # Everything else, such as the attributes the transport supports and the optional
+    # operations it has, is the wrapped transport's.
+
+    def __init__(self, transport=None):
+        # The transport we are slowing down.
+        self._transport = transport
+        self.latency = 0.05
+        self.jitter = 0.0
+        # The bandwidth in bytes per second, or 0 if it is unlimited.
+        self.bandwidth = 0
+        # The probability of a failing operation raising IOError.
+        self.error_rate = 0.0
+        self._random = random.Random(0)
+        # When the data that has been transferred so far will have made it through the
+        # bandwidth limit.
+        self._transfer_end = 0
+        # The number of operations and the total delay injected into them.
+        self.operations = 0
+        self.delay_total = 0.0
+        self.errors = 0
+
+    def __getattr__(self, name):
+        """Delegate everything we don't wrap explicitly to the wrapped transport, slowing down
+           its methods."""
+        transport = self.__dict__.get("_transport")
+        if transport is None:
+            raise AttributeError, name
+        attribute = getattr(transport, name)
+        if not callable(attribute):
+            return attribute
+
+        if name == "write_small_files":
+            def method(files):
+                """Write small files in one round trip, at the limited bandwidth."""
+                self._round_trip(name)
+                self._transfer(sum(len(data) for url, data, attributes in files))
+                return attribute([(self._unwrap(url), data, attributes)
+                                  for url, data, attributes in files])
+        else:
+            def method(*args):
+                """Call the wrapped transport's method after a round trip."""
+                self._round_trip(name)
+                return self._wrap(attribute(*[self._unwrap(arg) for arg in args]))
+        return method
+
+    def _sleep(self, delay):
+        """Sleep for _delay_ seconds and account for it."""
+        if delay > 0:
+            time.sleep(delay)
+            self.delay_total += delay
+
+    def _round_trip(self, operation):
+        """Wait for a round trip to complete, and fail it at random if _operation_ can
+           fail."""
+        self.operations += 1
+        self._sleep(self.latency + self._random.uniform(-self.jitter, self.jitter))
+        self._fail(operation)
+
+    def _fail(self, operation):
+        """Raise IOError at random if _operation_ can fail."""
+        if operation in FAILING_OPERATIONS and self.error_rate and \
+           self._random.random() < self.error_rate:
+            self.errors += 1
+            raise IOError, "Injected error in %s." % operation
+
+    def _transfer(self, size):
+        """Wait for _size_ bytes to make it through the bandwidth limit."""
+        if not self.bandwidth:
+            return
+        now = time.time()
+        self._transfer_end = max(now, self._transfer_end) + float(size) / self.bandwidth
+        self._sleep(self._transfer_end - now)
+
+    def _unwrap(self, item):
+        """Translate our URLs in _item_ into the wrapped transport's."""
+        if isinstance(item, str) and item.startswith("slow+"):
+            return item[5:]
+        elif isinstance(item, (list, tuple)):
+            return type(item)(self._unwrap(x) for x in item)
+        else:
+            return item
+
+    def _wrap(self, item):
+        """Translate the wrapped transport's file objects in _item_ into ours."""
+        if isinstance(item, FileObject):
+            return FileObject(self, "slow+" + item.url, item.attributes)
+        elif isinstance(item, list):
+            return [self._wrap(x) for x in item]
+        else:
+            return item
+
+    # Transports should also implement the following methods:
+    def add_options(self):
+        """Return the desired command-line plugin options.
+
+           Returns a tuple of ((args), {kwargs}) items for optparse's add_option().
+        """
+        return ((("--slow-latency", ), {"dest": "latency_",
+                                        "type": "float",
+                                        "help": "the delay of every operation, in seconds "
+                                                "(default 0.05)",
+                                        "metavar": "SECONDS"}),
+                (("--slow-jitter", ), {"dest": "jitter_",
+                                       "type": "float",
+                                       "help": "the most the delay of an operation varies by, "
+                                               "in seconds",
+                                       "metavar": "SECONDS"}),
+                (("--slow-bandwidth", ), {"dest": "bandwidth_",
+                                          "type": "int",
+                                          "help": "the bandwidth data is transferred at, in "
+                                                  "bytes per second",
+                                          "metavar": "BYTES"}),
+                (("--slow-error-rate", ), {"dest": "error_rate_",
+                                           "type": "float",
+                                           "help": "the probability of opening, reading or "
+                                                   "writing a file failing",
+                                           "metavar": "PROBABILITY"}),
+                (("--slow-seed", ), {"dest": "seed_",
+                                     "type": "int",
+                                     "help": "the seed of the jitter and errors",
+                                     "metavar": "NUMBER"}),
+                )
+
+    def connect(self, url, config):
+        """Connect the wrapped transport."""
+        options = getattr(config, "full_options", None)
+        for name in ("latency", "jitter", "bandwidth", "error_rate"):
+            value = getattr(options, name + "_slow", None)
+            if value is not None:
+                setattr(self, name, value)
+        self._random = random.Random(getattr(options, "seed_slow", None) or 0)
+        self._round_trip("connect")
+        self._transport.connect(self._unwrap(url), config)
+
+    def read(self, size):
+        """Read _size_ bytes from the open file, at the limited bandwidth. Data is streamed,
+           so there is no round trip."""
+        self._fail("read")
+        data = self._transport.read(size)
+        self._transfer(len(data))
+        return data
+
+    def write(self, data):
+        """Write _data_ to the open file, at the limited bandwidth."""
+        self._fail("write")
+        self._transfer(len(data))
+        self._transport.write(data)
@@ -4,11 +4,51 @@ from omnisync.transportmount import TransportInterface
 from omnisync.fileobject import FileObject
 from omnisync import urlfunctions
 
+import os
+import mmap
 import pickle
+import random
+import zlib
+
+# The first line of virtual filesystem snapshots. Older versions pickled the whole filesystem
+# dictionary instead.
+SNAPSHOT_HEADER = "omnisync virtual filesystem 1\n"
+# The number of changes to buffer before appending them to the journal.
+JOURNAL_BUFFER_SIZE = 1000
+# Rewrite the snapshot with the journal's changes when the journal grows to this fraction of
+# the snapshot's size.
+COMPACTION_RATIO = 0.5
+# The length of the pattern that seeded file contents repeat...
+PATTERN_SIZE = 4096
+# ...and the number of places in it that files can start at, which bounds the number of
+# chunks the reads of aligned, pattern-sized multiples have to keep around.
+PATTERN_PHASES = 16
+# The ways of giving files contents: all spaces, pseudo-random data generated from the seed,
+# or whatever was written to them, for as long as the transport is connected.
+CONTENT_MODES = ("blank", "seeded", "stored")
+
+
+def escape(name):
+    """Escape the characters that separate the fields and records of snapshots and
+       journals."""
+    return name.replace("%", "%25").replace("\0", "%00").replace("\n", "%0A")
+
+
+def unescape(name):
+    """Undo escape()."""
+    return name.replace("%0A", "\n").replace("%00", "\0").replace("%25", "%")
 
 
 class VirtualTransport(TransportInterface):
-    """Virtual filesystem access class."""
+    """Virtual filesystem access class.
+
+       Filesystems are stored in a snapshot of "parent\\0name\\0size" lines sorted by parent
+       and name, with "-" as the size of directories, so that the children of a directory
+       are contiguous and can be found with a binary search of the memory-mapped file.
+       Directories are only read from the snapshot when they are first used, and changes are
+       appended to a journal next to it, which is merged into a new snapshot once it grows
+       large enough.
+    """
     # Transports should declare the protocols attribute to specify the protocol(s)
     # they can handle.
     protocols = ("virtual", )
@@ -18,7 +58,7 @@ class VirtualTransport(TransportInterface):
     uses_hostname = True
     # listdir_attributes is a set that contains the file attributes that listdir()
     # supports.
-    listdir_attributes = set()
+    listdir_attributes = set(("size", ))
     # Conversely, for getattr().
     getattr_attributes = set(("size", ))
     # List the attributes setattr() can set.
@@ -31,113 +71,501 @@ class VirtualTransport(TransportInterface):
 
     def __init__(self):
         self._file_handle = None
+        # The entries of the directories that have been loaded, in {filename: attribute_dict}
+        # format, with None for directories.
         self._filesystem = {"/": None}
+        # The index of the loaded directories, in {directory: set(names)} format, so that
+        # directories can be looked at without going through every file.
+        self._children = {"/": set()}
         self._storage = None
         self._bytes_read = None
+        # The memory-mapped snapshot that directories are loaded from, if there is one.
+        self._snapshot = None
+        self._snapshot_file = None
+        self._snapshot_size = 0
+        # Changes that haven't been appended to the journal yet.
+        self._journal = []
+        self._journal_size = 0
+        # Whether changes are being replayed from the journal, rather than made.
+        self._replaying = False
+        # Whether the snapshot needs rewriting whatever the size of the journal.
+        self._compact = False
+        self.content_mode = "blank"
+        self.seed = 0
+        # Whether to check that what is written to files is their seeded contents.
+        self.verify = False
+        # The number of files whose written contents didn't match their seeded contents.
+        self.verify_errors = 0
+        self._pattern = None
+        # Chunks of file contents that reads return as they are, instead of building new
+        # strings, in {(phase, size): data} format.
+        self._chunks = {}
+        # The contents written to files in "stored" mode, in {filename: [data, ...]} format.
+        self._contents = {}
+        # The phase of the seeded contents of the open file, and the position in it.
+        self._phase = 0
+        self._position = 0
+        # The stored chunks of the open file that are left to read.
+        self._stored_chunks = None
 
-    def _get_filename(self, url, remove_slash=True):
-        """Retrieve the local filename from a given URL."""
-        # Remove the trailing slash as a convention unless specified otherwise.
-        if remove_slash:
-            urlfunctions.append_slash(url, False)
-        filename = urlfunctions.url_split(url).path
+    def _get_filename(self, url):
+        """Retrieve the local filename from a given URL, without a trailing slash unless it's
+           the root."""
+        filename = urlfunctions.url_split(url).path.rstrip("/")
         if filename == "":
             filename = "/"
         return filename
 
+    def _split_filename(self, filename):
+        """Split a filename into its parent directory and name."""
+        parent, name = filename.rsplit("/", 1)
+        return parent or "/", name
+
+    def _join_filename(self, directory, name):
+        """Join a directory and a name into a filename."""
+        return directory.rstrip("/") + "/" + name
+
+    def _read_directory(self, directory):
+        """Yield the (name, attribute_dict) items of a directory in the snapshot."""
+        snapshot = self._snapshot
+        key = escape(directory) + "\0"
+        # Find the first line that isn't less than the key.
+        low = len(SNAPSHOT_HEADER)
+        high = len(snapshot)
+        while low < high:
+            middle = (low + high) // 2
+            start = snapshot.rfind("\n", 0, middle) + 1
+            end = snapshot.find("\n", start)
+            if snapshot[start:end] < key:
+                low = end + 1
+            else:
+                high = start
+        while low < len(snapshot):
+            end = snapshot.find("\n", low)
+            line = snapshot[low:end]
+            if not line.startswith(key):
+                break
+            parent, name, size = line.split("\0")
+            if size == "-":
+                yield unescape(name), None
+            else:
+                yield unescape(name), {"size": int(size)}
+            low = end + 1
+
+    def _get_children(self, directory):
+        """Return the set of names in a directory, loading them from the snapshot if needed,
+           or None if it isn't a directory."""
+        if directory in self._children:
+            return self._children[directory]
+        if directory != "/":
+            parent, name = self._split_filename(directory)
+            siblings = self._get_children(parent)
+            if siblings is None or name not in siblings or \
+               self._filesystem[directory] is not None:
+                return None
+        names = set()
+        if self._snapshot is not None:
+            for child, attributes in self._read_directory(directory):
+                names.add(child)
+                self._filesystem[self._join_filename(directory, child)] = attributes
+        self._children[directory] = names
+        return names
+
+    def _get_entry(self, filename):
+        """Return the attributes of a file, None if it's a directory or False if it doesn't
+           exist."""
+        if filename == "/":
+            return None
+        parent, name = self._split_filename(filename)
+        siblings = self._get_children(parent)
+        if siblings is None or name not in siblings:
+            return False
+        return self._filesystem[filename]
+
+    def _has_file_parent(self, filename):
+        """Return True if one of the directories above a file is a file."""
+        while filename != "/":
+            filename = self._split_filename(filename)[0]
+            entry = self._get_entry(filename)
+            if entry is None:
+                return False
+            if entry is not False:
+                return True
+        return False
+
+    def _add_to_parent(self, filename):
+        """Add a file to its parent directory's children, creating the directories above it
+           if they don't exist."""
+        parent, name = self._split_filename(filename)
+        siblings = self._get_children(parent)
+        if siblings is None:
+            self._make_directory(parent)
+            siblings = self._children[parent]
+        siblings.add(name)
+
+    def _set_file(self, filename, attributes, journal=True):
+        """Create or change a file."""
+        self._filesystem[filename] = attributes
+        self._add_to_parent(filename)
+        if journal:
+            self._log("F", filename, str(attributes["size"]))
+
+    def _make_directory(self, filename):
+        """Create a directory, and the directories above it, unless it exists."""
+        if self._get_entry(filename) is None:
+            return
+        self._filesystem[filename] = None
+        self._children[filename] = set()
+        self._add_to_parent(filename)
+        self._log("D", filename)
+
+    def _remove_entry(self, filename):
+        """Remove a file or a directory along with everything under it."""
+        entry = self._get_entry(filename)
+        if entry is False or filename == "/":
+            return
+        parent, name = self._split_filename(filename)
+        self._children[parent].discard(name)
+        del self._filesystem[filename]
+        self._contents.pop(filename, None)
+        # Forget whatever has been loaded under a directory. The rest is never read from the
+        # snapshot, because the directory is gone from its parent.
+        directory_stack = [filename]
+        while entry is None and directory_stack:
+            directory = directory_stack.pop()
+            for child in self._children.pop(directory, ()):
+                child = self._join_filename(directory, child)
+                if self._filesystem.pop(child) is None:
+                    directory_stack.append(child)
+                else:
+                    self._contents.pop(child, None)
+        self._log("R", filename)
+
+    def _log(self, *fields):
+        """Record a change in the journal."""
+        if self._replaying or self._storage in (None, "memory"):
+            return
+        self._journal.append("\0".join(escape(x) for x in fields) + "\n")
+        if len(self._journal) >= JOURNAL_BUFFER_SIZE:
+            self._flush_journal()
+
+    def _flush_journal(self):
+        """Append the buffered changes to the journal, and merge the journal into a new
+           snapshot if it has grown large enough."""
+        if self._journal:
+            data = "".join(self._journal)
+            journal_file = open(self._storage + ".journal", "ab")
+            journal_file.write(data)
+            journal_file.close()
+            self._journal = []
+            self._journal_size += len(data)
+        if self._compact or self._journal_size > self._snapshot_size * COMPACTION_RATIO:
+            self._write_snapshot()
+
+    def _replay_journal(self):
+        """Apply the changes in the journal."""
+        try:
+            journal_file = open(self._storage + ".journal", "rb")
+        except IOError:
+            return
+        self._replaying = True
+        complete_size = 0
+        try:
+            for line in journal_file:
+                if not line.endswith("\n"):
+                    # The last change was cut off while it was being written.
+                    break
+                complete_size += len(line)
+                fields = [unescape(x) for x in line[:-1].split("\0")]
+                if fields[0] == "F":
+                    if not self._has_file_parent(fields[1]) and \
+                       self._get_entry(fields[1]) is not None:
+                        self._set_file(fields[1], {"size": int(fields[2])})
+                elif fields[0] == "D":
+                    if not self._has_file_parent(fields[1]):
+                        self._make_directory(fields[1])
+                elif fields[0] == "R":
+                    self._remove_entry(fields[1])
+        finally:
+            self._replaying = False
+            journal_file.close()
+        if complete_size < os.path.getsize(self._storage + ".journal"):
+            journal_file = open(self._storage + ".journal", "r+b")
+            journal_file.truncate(complete_size)
+            journal_file.close()
+        self._journal_size = complete_size
+
+    def _write_snapshot(self):
+        """Write a new snapshot of the whole filesystem and empty the journal."""
+        records = []
+        directory_stack = ["/"]
+        while directory_stack:
+            directory = directory_stack.pop()
+            prefix = escape(directory) + "\0"
+            for name in self._get_children(directory):
+                filename = self._join_filename(directory, name)
+                attributes = self._filesystem[filename]
+                if attributes is None:
+                    directory_stack.append(filename)
+                    size = "-"
+                else:
+                    size = str(attributes["size"])
+                records.append(prefix + escape(name) + "\0" + size + "\n")
+        records.sort()
+        snapshot_file = open(self._storage + ".new", "wb")
+        snapshot_file.write(SNAPSHOT_HEADER)
+        snapshot_file.writelines(records)
+        snapshot_file.close()
+        # Everything is loaded now, so the old snapshot isn't needed any more.
+        self._close_snapshot()
+        try:
+            os.rename(self._storage + ".new", self._storage)
+        except OSError:
+            # Windows won't rename over an existing file.
+            os.remove(self._storage)
+            os.rename(self._storage + ".new", self._storage)
+        # Replaying the journal over the new snapshot would change nothing, so it doesn't
+        # matter if we stop before removing it.
+        if os.path.exists(self._storage + ".journal"):
+            os.remove(self._storage + ".journal")
+        self._snapshot_size = os.path.getsize(self._storage)
+        self._journal_size = 0
+        self._compact = False
+
+    def _close_snapshot(self):
+        """Unmap the snapshot."""
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot_file.close()
+            self._snapshot = None
+            self._snapshot_file = None
+
+    def _load_pickle(self, filesystem):
+        """Load a filesystem dictionary pickled by an older version."""
+        self._replaying = True
+        try:
+            # Sorting puts directories before what's in them.
+            for filename, attributes in sorted(filesystem.items()):
+                # Older versions could store filenames with trailing slashes.
+                filename = filename.rstrip("/") or "/"
+                if self._has_file_parent(filename):
+                    continue
+                if attributes is None:
+                    self._make_directory(filename)
+                elif self._get_entry(filename) is not None:
+                    self._set_file(filename, {"size": attributes["size"]})
+        finally:
+            self._replaying = False
+
+    def _get_phase(self, filename):
+        """Return where in the pattern a file's seeded contents start. This depends on the
+           file's name but not its directory, so copies of a file have the same contents."""
+        name = self._split_filename(filename)[1]
+        phase = zlib.crc32("%s\0%s" % (self.seed, name)) % PATTERN_PHASES
+        return phase * (PATTERN_SIZE // PATTERN_PHASES)
+
+    def _get_content(self, position, size):
+        """Return _size_ bytes of the open file's contents from _position_, reusing the same
+           string for aligned chunks whose size is a multiple of the pattern's."""
+        if self.content_mode == "blank":
+            start = 0
+        else:
+            start = (self._phase + position) % PATTERN_SIZE
+        aligned = not size % PATTERN_SIZE and not position % PATTERN_SIZE
+        if aligned and (start, size) in self._chunks:
+            return self._chunks[(start, size)]
+        if self.content_mode == "blank":
+            data = " " * size
+        else:
+            if self._pattern is None:
+                pattern_random = random.Random(self.seed)
+                self._pattern = "".join(chr(pattern_random.randrange(256))
+                                        for counter in range(PATTERN_SIZE))
+            repeats = (start + size) // PATTERN_SIZE + 1
+            data = (self._pattern * repeats)[start:start + size]
+        if aligned:
+            self._chunks[(start, size)] = data
+        return data
+
     # Transports should also implement the following methods:
     def add_options(self):
         """Return the desired command-line plugin options.
 
            Returns a tuple of ((args), {kwargs}) items for optparse's add_option().
         """
-        return ()
+        return ((("--virtual-content", ), {"dest": "content_",
+                                           "type": "choice",
+                                           "choices": CONTENT_MODES,
+                                           "help": "what files contain: blank, seeded "
+                                                   "pseudo-random data or what was written to "
+                                                   "them, while connected (%s)" %
+                                                   ", ".join(CONTENT_MODES),
+                                           "metavar": "MODE"}),
+                (("--virtual-seed", ), {"dest": "seed_",
+                                        "type": "int",
+                                        "help": "the seed of the seeded file contents",
+                                        "metavar": "NUMBER"}),
+                (("--virtual-verify", ), {"dest": "verify_",
+                                          "action": "store_true",
+                                          "help": "check that data written to files is their "
+                                                  "seeded contents"}),
+                )
 
     def connect(self, url, config):
-        """Unpickle the filesystem dictionary."""
+        """Map the snapshot of the filesystem and apply the journal."""
+        options = getattr(config, "full_options", None)
+        self.content_mode = getattr(options, "content_virtual", None) or self.content_mode
+        self.seed = getattr(options, "seed_virtual", None) or self.seed
+        self.verify = getattr(options, "verify_virtual", None) or self.verify
+        self._pattern = None
+        self._chunks = {}
         self._storage = urlfunctions.url_split(url).hostname
         # If the storage is in-memory only, don't do anything.
         if self._storage == "memory":
             return
         try:
-            pickled_file = open(self._storage, "rb")
+            snapshot_file = open(self._storage, "rb")
         except IOError:
-            return
-        self._filesystem = pickle.load(pickled_file)
-        pickled_file.close()
+            # There's nothing stored yet, so write the first snapshot when disconnecting.
+            self._compact = True
+        else:
+            if snapshot_file.read(len(SNAPSHOT_HEADER)) == SNAPSHOT_HEADER:
+                self._snapshot_file = snapshot_file
+                self._snapshot = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._snapshot_size = len(self._snapshot)
+                # Even the root is loaded from the snapshot.
+                del self._children["/"]
+            else:
+                snapshot_file.seek(0)
+                filesystem = pickle.load(snapshot_file)
+                snapshot_file.close()
+                self._load_pickle(filesystem)
+                self._compact = True
+        self._replay_journal()
 
     def disconnect(self):
-        """Pickle the filesystem to a file for persistence."""
+        """Write the remaining changes to the journal, compacting it if needed."""
         # If the storage is in-memory only, don't do anything.
         if self._storage == "memory":
             return
-        pickled_file = open(self._storage, "wb")
-        pickle.dump(self._filesystem, pickled_file)
-        pickled_file.close()
+        self._flush_journal()
+        self._close_snapshot()
 
-    def open(self, url, mode="rb"):
-        """Open a file in _mode_ to prepare for I/O.
+    def open(self, url, mode="rb", size=None):
+        """Open a file in _mode_ to prepare for I/O. _size_ is the expected size of the file,
+           if known.
 
            Raises IOError if anything goes wrong.
         """
         filename = self._get_filename(url)
-        if self._filesystem.get(filename, False) is None:
+        entry = self._get_entry(filename)
+        if entry is None:
             raise IOError, "File is a directory."
-        self._file_handle = filename
         if mode.startswith("r"):
-            if filename not in self._filesystem:
+            if entry is False:
                 raise IOError, "File does not exist."
             self._bytes_read = 0
+            if filename in self._contents:
+                self._stored_chunks = list(reversed(self._contents[filename]))
         else:
-            self._filesystem[self._file_handle] = {"size": 0}
+            if self._has_file_parent(filename):
+                raise IOError, "A parent directory is a file."
+            # The size is journalled when the file is closed.
+            self._set_file(filename, {"size": 0}, False)
+            if self.content_mode == "stored":
+                self._contents[filename] = []
+        self._file_handle = filename
+        self._phase = self._get_phase(filename)
+        self._position = 0
 
     def read(self, size):
-        """Read _size_ bytes from the open file."""
+        """Read up to _size_ bytes from the open file.
+
+           Files' contents are handed out as the strings they were written as or as chunks
+           that are reused for every file, so reading doesn't allocate any memory in the
+           common case.
+        """
         if self._file_handle is None:
-            return IOError, "No file is open."
-        if self._bytes_read + size < self._filesystem[self._file_handle]["size"]:
-            self._bytes_read += size
-            return " " * size
-        else:
-            bytes_read = self._bytes_read
-            self._bytes_read = self._filesystem[self._file_handle]["size"]
-            return " " * (self._filesystem[self._file_handle]["size"] - bytes_read)
+            raise IOError, "No file is open."
+        if self._stored_chunks is not None:
+            if not self._stored_chunks:
+                return ""
+            data = self._stored_chunks.pop()
+            if len(data) > size:
+                self._stored_chunks.append(data[size:])
+                data = data[:size]
+            return data
+        size = min(size, self._filesystem[self._file_handle]["size"] - self._position)
+        if size <= 0:
+            return ""
+        data = self._get_content(self._position, size)
+        self._position += size
+        return data
 
     def write(self, data):
-        """Write _data_ to the open file."""
+        """Write _data_ to the open file.
+
+           Raises IOError if verification is on and _data_ is not the file's seeded
+           contents.
+        """
         if self._file_handle is None:
-            return IOError, "No file is open."
+            raise IOError, "No file is open."
+        if self.verify and data != self._get_content(self._position, len(data)):
+            self.verify_errors += 1
+            raise IOError, "The data written to %s at %s is not its seeded contents." % \
+                           (self._file_handle, self._position)
+        self._position += len(data)
         self._filesystem[self._file_handle]["size"] += len(data)
+        if self.content_mode == "stored":
+            self._contents[self._file_handle].append(data)
 
     def close(self):
         """Close the open file."""
+        if self._file_handle is not None and self._bytes_read is None:
+            self._log("F", self._file_handle,
+                      str(self._filesystem[self._file_handle]["size"]))
         self._file_handle = None
+        self._bytes_read = None
+        self._stored_chunks = None
 
     def remove(self, url):
         """Remove the specified file."""
         filename = self._get_filename(url)
-        if filename not in self._filesystem or self._filesystem[filename] is None:
+        entry = self._get_entry(filename)
+        if entry is None or entry is False:
             return False
-        del self._filesystem[filename]
+        self._remove_entry(filename)
         return True
 
     def rmdir(self, url):
         """Remove the specified directory non-recursively."""
         filename = self._get_filename(url)
-        if self._filesystem[filename] is not None:
+        if filename == "/" or self._get_children(filename) != set():
             return False
-        if self.listdir(url):
+        self._remove_entry(filename)
+        return True
+
+    def remove_tree(self, url):
+        """Remove a directory and everything under it."""
+        filename = self._get_filename(url)
+        if filename == "/" or self._get_children(filename) is None:
             return False
-        else:
-            del self._filesystem[filename]
-            return True
+        self._remove_entry(filename)
+        return True
 
     def mkdir(self, url):
-        """Create a directory."""
+        """Recursively make the given directories.
+
+           Returns True if a file is in the way, False otherwise.
+        """
         filename = self._get_filename(url)
-        if filename not in self._filesystem:
-            return IOError, "A directory with the specified name already exists."
-        self._filesystem[filename] = None
+        entry = self._get_entry(filename)
+        if entry is None:
+            return False
+        if entry is not False or self._has_file_parent(filename):
+            return True
+        self._make_directory(filename)
+        return False
 
     def listdir(self, url):
         """Retrieve a directory listing of the given location.
@@ -145,28 +573,25 @@ class VirtualTransport(TransportInterface):
         Returns a list of (url, attribute_dict) tuples if the
         given URL is a directory, False otherwise.
         """
-        # Add a slash so we don't have to remove it from the start of the subpaths.
+        filename = self._get_filename(url)
+        children = self._get_children(filename)
+        if children is None:
+            return False
+        # Add a slash so we can append the names.
         url = urlfunctions.append_slash(url)
-        filename = self._get_filename(url, False)
-        files = set()
-        for key in self._filesystem:
-            # Check the length to prevent returning the directory itself.
-            if key.startswith(filename) and len(key) > len(filename):
-                subpath = key[len(filename):]
-                if "/" not in subpath:
-                    # Add the subpath in the set as is, because there are no lower levels.
-                    files.add(subpath)
-                else:
-                    files.add(subpath[:subpath.find("/")])
-        return [FileObject(self, url + x,) for x in files]
+        file_list = []
+        for name in children:
+            attributes = self._filesystem[self._join_filename(filename, name)]
+            if attributes is None:
+                file_list.append(FileObject(self, url + name, {"isdir": True, "size": 0}))
+            else:
+                file_list.append(FileObject(self, url + name, dict(attributes, isdir=False)))
+        return file_list
 
     def isdir(self, url):
         """Return True if the given URL is a directory, False if it is a file or
            does not exist."""
-        filename = self._get_filename(url)
-        if filename not in self._filesystem:
-            return False
-        return self._filesystem[filename] is None
+        return self._get_entry(self._get_filename(url)) is None
 
     def getattr(self, url, attributes):
         """Retrieve as many file attributes as we can, at the very *least* the requested ones.
@@ -174,19 +599,16 @@ class VirtualTransport(TransportInterface):
         Returns a dictionary of {"attribute": "value"}, or {"attribute": None} if the file does
         not exist.
         """
-        try:
-            attrs = self._filesystem[self._get_filename(url)]
-        except KeyError:
-            return {"size": None}
-        if attrs is None:
+        entry = self._get_entry(self._get_filename(url))
+        if not entry:
             # Directories have no attributes in our virtual FS.
             return {"size": None}
         else:
-            return attrs
+            return entry
 
     def setattr(self, url, attributes):
         """Do nothing."""
 
     def exists(self, url):
         """Return True if a given path exists, False otherwise."""
-        return self._get_filename(url) in self._filesystem
+        return self._get_entry(self._get_filename(url)) is not False
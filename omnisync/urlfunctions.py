@@ -2,7 +2,7 @@
 
 import re
 
-URL_RE_HOSTNAME = re.compile("""^(?:(?P<scheme>\w+)://|)
+URL_RE_HOSTNAME = re.compile("""^(?:(?P<scheme>[\w+.-]+)://|)
                                  (?P<netloc>(?:(?P<username>.*?)(?::(?P<password>.*?)|)@|)
                                  (?P<hostname>[^@/]*?)(?::(?P<port>\d+)|))
                                  (?:(?P<path>/(?:.*?/|))
@@ -11,7 +11,7 @@ URL_RE_HOSTNAME = re.compile("""^(?:(?P<scheme>\w+)://|)
                                  (?:\?(?P<query>.*?)|)
                                  (?:\#(?P<anchor>.*?)|)$""", re.VERBOSE)
 
-URL_RE_PLAIN    = re.compile("""^(?:(?P<scheme>\w+)://|)
+URL_RE_PLAIN    = re.compile("""^(?:(?P<scheme>[\w+.-]+)://|)
                                  (?:(?P<path>(?:.*?/|))
                                  /?(?P<file>[^/]*?|)|)
                                  (?:\;(?P<params>.*?)|)
@@ -103,6 +103,18 @@ def url_join(url):
 
     return "".join(constructed_url)
 
+def strip_credentials(url, uses_hostname=True):
+    """Return _url_ without its username and password, so it can be stored or shown without
+       giving them away. URLs without a hostname don't have any."""
+    if not uses_hostname:
+        return url
+    split_url = url_split(url)
+    if not split_url.username and not split_url.password:
+        return url
+    split_url.username = ""
+    split_url.password = ""
+    return url_join(split_url)
+
 def append_slash(url, append=True):
     """Append a slash to a URL, checking if it already has one."""
     if url.endswith("/"):